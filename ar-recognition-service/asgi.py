@@ -0,0 +1,334 @@
+"""
+خادم ASGI غير متزامن مع تجميع الطلبات المتقاربة ومهل لكل طلب
+Async (ASGI) front end: coalesces bursts of recognition requests into one batch
+
+مسارا التعرف يُخدمان هنا دون حجز خيط لكل طلب؛ باقي المسارات تُمرر لتطبيق Flask نفسه.
+
+التشغيل:
+    gunicorn -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker asgi:app
+"""
+
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from io import BytesIO
+from typing import Callable, Dict, List, Optional, Tuple
+
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.middleware.cors import CORSMiddleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Mount, Route, request_response
+from werkzeug.formparser import parse_form_data
+
+import metrics
+from place_recognition import RECOGNITION_MODES, PlaceRecognizer, RecognitionQuery
+from server import (
+    CORS_ORIGINS, DEBUG_TIMINGS_HEADER, MAX_BATCH_SIZE, MAX_UPLOAD_BYTES, PayloadError,
+    RecognizerLoading, app as flask_app, decode_base64_image, get_recognizer, loaded_recognizer,
+    parse_location, parse_min_confidence, serialize_match, upload_buffer, upload_stream_factory
+)
+from worker_pool import ExtractionUnavailableError, PoolSaturatedError
+
+# نافذة تجميع الطلبات بالملي ثانية، والحد الأقصى لصور الدفعة الواحدة
+COALESCE_WINDOW_MS = float(os.environ.get('COALESCE_WINDOW_MS', 5))
+COALESCE_MAX_BATCH = int(os.environ.get('COALESCE_MAX_BATCH', 16))
+
+# خيوط تشغيل الدفعات (المطابقة؛ الاستخراج يتم في مجمع العمليات)
+MATCH_THREADS = int(os.environ.get('MATCH_THREADS', 2))
+
+# المهلة الافتراضية لكل طلب، ويمكن للعميل تقصيرها بالترويسة
+REQUEST_DEADLINE_MS = float(os.environ.get('REQUEST_DEADLINE_MS', 10000))
+DEADLINE_HEADER = 'X-Request-Deadline-Ms'
+
+
+class RequestCoalescer:
+    """يجمع طلبات التعرف التي تصل خلال نافذة قصيرة في دفعة واحدة لكل وضع
+
+    تُستخدم لقطة مرجعية واحدة لكل دفعة، وتُستبعد الطلبات الملغاة أو المنتهية قبل إرسالها.
+    """
+
+    def __init__(self, get_recognizer: Callable[[], PlaceRecognizer], window_ms: float = COALESCE_WINDOW_MS,
+                 max_batch: int = COALESCE_MAX_BATCH, threads: int = MATCH_THREADS):
+        # المحرك يُطلب عند الاستخدام لأنه يُحمّل بعد استيراد الخادم
+        self._get_recognizer = get_recognizer
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="coalesced-match")
+        self._pending: Dict[str, List] = {}
+        self._timers: Dict[str, asyncio.TimerHandle] = {}
+
+    @property
+    def recognizer(self) -> PlaceRecognizer:
+        return self._get_recognizer()
+
+    def submit(self, queries: List[RecognitionQuery], mode: str) -> asyncio.Future:
+        """إضافة طلبات للدفعة التالية؛ النتيجة (النتائج، رقم اللقطة، أزمنة الطلب، حجم الدفعة، حالة التتبع)"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        batch = self._pending.setdefault(mode, [])
+        batch.append((queries, future, time.perf_counter()))
+
+        if sum(len(entry[0]) for entry in batch) >= self.max_batch:
+            self._flush(mode)
+        elif mode not in self._timers:
+            self._timers[mode] = loop.call_later(self.window, self._flush, mode)
+        return future
+
+    def _flush(self, mode: str):
+        timer = self._timers.pop(mode, None)
+        if timer is not None:
+            timer.cancel()
+
+        live = []
+        for queries, future, submitted in self._pending.pop(mode, []):
+            if future.done():
+                continue
+            if all(query.expired() for query in queries):
+                future.set_result(None)
+                continue
+            live.append((queries, future, submitted))
+        if not live:
+            return
+
+        # زمن الانتظار في النافذة لكل طلب (المؤقت يعمل في سياق أول طلب فقط)
+        dispatched = time.perf_counter()
+        live = [(queries, future, dispatched - submitted) for queries, future, submitted in live]
+        for _, _, waited in live:
+            metrics.STAGE_SECONDS.observe(waited, stage='coalesce_wait')
+
+        snapshot = self.recognizer.snapshot
+        queries = [query for entry in live for query in entry[0]]
+        job = asyncio.get_running_loop().run_in_executor(
+            self._executor, self._run, queries, mode, snapshot
+        )
+        version = self.recognizer.snapshot_version(snapshot)
+        job.add_done_callback(partial(self._complete, live, version, len(queries)))
+
+    def submit_tracked(self, session_id: str, image_bytes: bytes, min_confidence: float,
+                       mode: str, location) -> asyncio.Future:
+        """إطار ضمن جلسة تتبع؛ لا يُجمع مع غيره لأن التتبع يعتمد على ترتيب إطارات الجلسة"""
+        snapshot = self.recognizer.snapshot
+
+        def run():
+            with metrics.collect_timings() as timings:
+                match, state = self.recognizer.recognize_tracked(
+                    session_id, image_bytes, min_confidence, mode, location, snapshot
+                )
+            return [match], self.recognizer.snapshot_version(snapshot), timings, 1, state
+
+        return asyncio.get_running_loop().run_in_executor(self._executor, run)
+
+    def _run(self, queries: List[RecognitionQuery], mode: str, snapshot) -> Tuple[List, Dict]:
+        with metrics.collect_timings() as timings:
+            results = self.recognizer.recognize_queries(queries, mode, snapshot)
+        return results, timings
+
+    @staticmethod
+    def _complete(live: List, version: int, batch_size: int, job: asyncio.Future):
+        if job.exception() is not None:
+            for _, future, _ in live:
+                if not future.done():
+                    future.set_exception(job.exception())
+            return
+
+        results, timings = job.result()
+        offset = 0
+        for queries, future, waited in live:
+            if not future.done():
+                request_timings = dict(timings, coalesce_wait=waited)
+                future.set_result((results[offset:offset + len(queries)], version, request_timings, batch_size, None))
+            offset += len(queries)
+
+
+coalescer = RequestCoalescer(get_recognizer)
+
+
+async def read_body(request: Request) -> bytearray:
+    """قراءة جسم الطلب مع فرض حد الحجم أثناء القراءة"""
+    length = request.headers.get('content-length')
+    if length is not None and int(length) > MAX_UPLOAD_BYTES:
+        raise PayloadError("حجم الطلب أكبر من الحد المسموح", 413)
+    body = bytearray()
+    async for chunk in request.stream():
+        if len(body) + len(chunk) > MAX_UPLOAD_BYTES:
+            raise PayloadError("حجم الطلب أكبر من الحد المسموح", 413)
+        body += chunk
+    return body
+
+
+async def read_image_request(request: Request, field: str) -> Tuple[List, dict]:
+    """نفس صيغ خادم Flask: صورة خام، أو multipart، أو JSON بـ Base64"""
+    with metrics.stage('read'):
+        content_type = request.headers.get('content-type', '')
+        mimetype = content_type.split(';')[0].strip().lower()
+        body = await read_body(request)
+        data = dict(request.query_params)
+
+        if mimetype.startswith('image/') or mimetype == 'application/octet-stream':
+            return ([body] if body else []), data
+
+        if mimetype == 'multipart/form-data':
+            # محلل werkzeug نفسه المستخدم في Flask
+            _, form, files = parse_form_data({
+                'wsgi.input': BytesIO(body),
+                'CONTENT_TYPE': content_type,
+                'CONTENT_LENGTH': str(len(body)),
+                'REQUEST_METHOD': 'POST',
+            }, stream_factory=upload_stream_factory)
+            data.update(form.to_dict())
+            images = [upload_buffer(f) for f in files.getlist(field)]
+            return [image for image in images if image], data
+
+        try:
+            data = json.loads(body) if body else {}
+        except ValueError:
+            data = {}
+        if not isinstance(data, dict):
+            data = {}
+        value = data.get(field)
+        if isinstance(value, str):
+            return [decode_base64_image(value)], data
+        if isinstance(value, list):
+            return [decode_base64_image(item) for item in value], data
+        return [], data
+
+
+def request_deadline(request: Request) -> float:
+    """موعد انتهاء الطلب (time.monotonic) من الترويسة أو القيمة الافتراضية"""
+    deadline_ms = REQUEST_DEADLINE_MS
+    try:
+        deadline_ms = min(float(request.headers.get(DEADLINE_HEADER, deadline_ms)), deadline_ms)
+    except ValueError:
+        pass
+    return time.monotonic() + max(deadline_ms, 0) / 1000
+
+
+async def wait_for_disconnect(request: Request):
+    """ينتهي عندما يغلق العميل الاتصال"""
+    while True:
+        message = await request.receive()
+        if message['type'] == 'http.disconnect':
+            return
+
+
+async def coalesced_recognize(request: Request, field: str) -> Tuple[Optional[Dict], int, Optional[Dict]]:
+    """قراءة الطلب وإرساله للتجميع وانتظار نتيجته حتى المهلة أو انقطاع العميل
+
+    تُرجع (الرد، رمز الحالة، أزمنة الدفعة).
+    """
+    deadline = request_deadline(request)
+    images, data = await read_image_request(request, field)
+    if not images:
+        return {"success": False, "error": "لم يتم تقديم صورة" if field == 'image' else "لم يتم تقديم صور"}, 400, None
+    if len(images) > MAX_BATCH_SIZE:
+        return {"success": False, "error": f"الحد الأقصى لعدد الصور هو {MAX_BATCH_SIZE}"}, 400, None
+
+    mode = data.get('mode') or get_recognizer().default_mode
+    if mode not in RECOGNITION_MODES:
+        return {"success": False, "error": f"وضع التعرف غير مدعوم: {mode}"}, 400, None
+    location = parse_location(data)
+    min_confidence = parse_min_confidence(data)
+
+    queries = [RecognitionQuery(image, min_confidence, location, deadline) for image in images]
+    session_id = data.get('session_id') if field == 'image' else None
+    if session_id:
+        result = coalescer.submit_tracked(str(session_id), images[0], min_confidence, mode, location)
+    else:
+        result = coalescer.submit(queries, mode)
+    disconnect = asyncio.ensure_future(wait_for_disconnect(request))
+    try:
+        done, _ = await asyncio.wait(
+            {result, disconnect},
+            timeout=max(deadline - time.monotonic(), 0),
+            return_when=asyncio.FIRST_COMPLETED
+        )
+    finally:
+        disconnect.cancel()
+
+    if result not in done or result.result() is None:
+        # العميل انقطع أو انتهت المهلة: العمل الذي لم يبدأ يُلغى
+        for query in queries:
+            query.cancel()
+        return {"success": False, "error": "انتهت مهلة الطلب"}, 504, None
+
+    results, version, timings, batch_size, tracking = result.result()
+    timings = dict(timings, batchSize=batch_size)
+    if field == 'image':
+        match = results[0]
+        if match:
+            payload = {"success": True, "recognized": True, "place": serialize_match(match),
+                       "snapshotVersion": version}
+        else:
+            payload = {"success": True, "recognized": False, "message": "لم يتم التعرف على المكان",
+                       "snapshotVersion": version}
+        if tracking is not None:
+            payload["tracking"] = tracking
+        return payload, 200, timings
+    return {
+        "success": True,
+        "results": [
+            {"recognized": True, "place": serialize_match(match)} if match else {"recognized": False}
+            for match in results
+        ],
+        "snapshotVersion": version
+    }, 200, timings
+
+
+def recognition_endpoint(endpoint: str, field: str):
+    """مسار تعرف غير متزامن بنفس ردود Flask ومقاييسه"""
+    async def view(request: Request):
+        if request.method != 'POST':
+            return JSONResponse({"success": False, "error": "Method Not Allowed"}, status_code=405)
+
+        started = time.perf_counter()
+        timings = None
+        headers = {}
+        with metrics.collect_timings() as request_timings:
+            try:
+                # الطلبات قبل اكتمال التحميل تُرفض بـ 503 بدلاً من انتظاره
+                extraction_pool = loaded_recognizer().extraction_pool
+                if extraction_pool is not None:
+                    with extraction_pool.admit():
+                        payload, status, timings = await coalesced_recognize(request, field)
+                else:
+                    payload, status, timings = await coalesced_recognize(request, field)
+            except (RecognizerLoading, PoolSaturatedError, ExtractionUnavailableError) as e:
+                payload, status = {"success": False, "error": str(e)}, 503
+                headers['Retry-After'] = '1'
+            except PayloadError as e:
+                payload, status = {"success": False, "error": str(e)}, e.status
+            except Exception as e:
+                payload, status = {"success": False, "error": str(e)}, 500
+        elapsed = time.perf_counter() - started
+
+        metrics.REQUEST_SECONDS.observe(elapsed, endpoint=endpoint)
+        metrics.REQUESTS.inc(endpoint=endpoint, status=status)
+
+        if request.headers.get(DEBUG_TIMINGS_HEADER):
+            stages = dict(request_timings, **(timings or {}))
+            payload['timings'] = {
+                stage: value if stage == 'batchSize' else round(value * 1000, 2)
+                for stage, value in stages.items()
+            }
+            payload['timings']['total'] = round(elapsed * 1000, 2)
+        return JSONResponse(payload, status_code=status, headers=headers)
+
+    return CORSMiddleware(
+        request_response(view),
+        allow_origins=CORS_ORIGINS,
+        allow_methods=['POST'],
+        allow_headers=['*']
+    )
+
+
+app = Starlette(routes=[
+    Route('/recognize', recognition_endpoint('recognize', 'image'), methods=['POST', 'OPTIONS']),
+    Route('/recognize/batch', recognition_endpoint('recognize_batch', 'images'), methods=['POST', 'OPTIONS']),
+    # باقي المسارات (إضافة الصور، المعالم، المقاييس...) من تطبيق Flask
+    Mount('/', app=WSGIMiddleware(flask_app)),
+])
@@ -0,0 +1,299 @@
+"""
+قياس أداء ودقة PlaceRecognizer على مجموعة اصطناعية قابلة للتكرار
+Reproducible latency/accuracy benchmark built from public/images/places
+
+الاستخدام:
+    python benchmark.py --output results.json
+    python benchmark.py --baseline benchmarks/baseline.json          # مقارنة (رمز خروج 1 عند التراجع)
+    python benchmark.py --baseline benchmarks/baseline.json --save-baseline
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+
+import cv2
+import numpy as np
+
+from place_recognition import PlaceRecognizer
+
+SERVICE_DIR = Path(__file__).resolve().parent
+PLACES_IMAGES_DIR = SERVICE_DIR.parent / "public" / "images" / "places"
+BASELINE_FILE = SERVICE_DIR / "benchmarks" / "baseline.json"
+
+# صور الأماكن في الواجهة مقابل معرفاتها في PLACES_DATA
+PLACE_IMAGES = {
+    "1": "diriyah_turaif.png",
+    "2": "kingdom_tower.png",
+    "3": "boulevard_world.png",
+    "4": "riyadh_park_mall.png",
+    "5": "najd_village.png",
+    "6": "edge_of_world.png",
+    "7": "national_museum.png",
+    "8": "panorama_mall.png",
+    "9": "via_riyadh.png",
+    "10": "wadi_hanifa.png",
+}
+
+# المقاييس التي تُعد زيادتها تراجعاً، والتي يُعد نقصانها تراجعاً
+LOWER_IS_BETTER = ('p50_ms', 'p95_ms', 'p99_ms', 'peak_rss_mb', 'import_ms', 'ready_ms')
+HIGHER_IS_BETTER = ('throughput_per_s',)
+
+# أقل عدد عينات تُقارن عنده p99 (أقل من ذلك تكون ضجيجاً)
+MIN_SAMPLES_FOR_P99 = 100
+
+
+def augment(image: np.ndarray, rng: np.random.Generator) -> Tuple[bytes, Dict]:
+    """قص عشوائي ودوران وتحجيم وتمويه وإعادة ضغط JPEG"""
+    params = {
+        'crop': float(rng.uniform(0.5, 0.8)),
+        'angle': float(rng.uniform(-15, 15)),
+        'scale': float(rng.uniform(0.7, 1.2)),
+        'blur': float(rng.uniform(0, 1.5)),
+        'quality': int(rng.integers(60, 91)),
+    }
+    h, w = image.shape[:2]
+    matrix = cv2.getRotationMatrix2D((w / 2, h / 2), params['angle'], params['scale'])
+    warped = cv2.warpAffine(image, matrix, (w, h), borderMode=cv2.BORDER_REFLECT)
+
+    ch, cw = int(h * params['crop']), int(w * params['crop'])
+    y = int(rng.integers(0, h - ch + 1))
+    x = int(rng.integers(0, w - cw + 1))
+    query = warped[y:y + ch, x:x + cw]
+    if params['blur'] > 0.1:
+        query = cv2.GaussianBlur(query, (0, 0), params['blur'])
+
+    ok, encoded = cv2.imencode('.jpg', query, [cv2.IMWRITE_JPEG_QUALITY, params['quality']])
+    if not ok:
+        raise RuntimeError("فشل ترميز صورة الاستعلام")
+    return encoded.tobytes(), params
+
+
+def make_dataset(images_dir: Path, per_place: int, seed: int) -> List[Tuple[str, bytes]]:
+    """مجموعة استعلامات موسومة (معرف المكان، بايتات JPEG) بنفس البذرة دائماً"""
+    rng = np.random.default_rng(seed)
+    queries = []
+    for place_id, filename in PLACE_IMAGES.items():
+        image = cv2.imread(str(images_dir / filename), cv2.IMREAD_COLOR)
+        if image is None:
+            raise FileNotFoundError(images_dir / filename)
+        for _ in range(per_place):
+            query, _ = augment(image, rng)
+            queries.append((place_id, query))
+    return queries
+
+
+def summarize(latencies: List[float], wall_seconds: float) -> Dict:
+    """النسب المئوية للزمن (ملي ثانية) والإنتاجية"""
+    values = np.asarray(latencies) * 1000
+    return {
+        'n': len(latencies),
+        'mean_ms': round(float(values.mean()), 2),
+        'p50_ms': round(float(np.percentile(values, 50)), 2),
+        'p95_ms': round(float(np.percentile(values, 95)), 2),
+        'p99_ms': round(float(np.percentile(values, 99)), 2),
+        'throughput_per_s': round(len(latencies) / wall_seconds, 2),
+    }
+
+
+def peak_rss_mb() -> float:
+    """ذروة الذاكرة المقيمة للعملية منذ بدايتها"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss بالكيلوبايت على لينكس وبالبايت على macOS
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def timed_run(fn: Callable, items: List, concurrency: int) -> Tuple[List, List[float], float]:
+    """تشغيل fn على العناصر مع قياس زمن كل استدعاء والزمن الكلي"""
+    def call(item):
+        started = time.perf_counter()
+        result = fn(item)
+        return result, time.perf_counter() - started
+
+    started = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            outcomes = list(executor.map(call, items))
+    else:
+        outcomes = [call(item) for item in items]
+    wall = time.perf_counter() - started
+    return [o[0] for o in outcomes], [o[1] for o in outcomes], wall
+
+
+def run_benchmark(images_dir: Path = PLACES_IMAGES_DIR, per_place: int = 5, seed: int = 0,
+                  modes: Tuple[str, ...] = ('sift', 'orb'), min_confidence: float = 0.1,
+                  concurrency: int = 1, warmup: int = 2) -> Dict:
+    """بناء مرجع مؤقت من صور الأماكن وقياس الإضافة والتعرف واكتشاف المعالم وبدء التشغيل"""
+    queries = make_dataset(images_dir, per_place, seed)
+    results: Dict[str, Dict] = {}
+
+    with tempfile.TemporaryDirectory(prefix="ar-benchmark-") as reference_dir:
+        recognizer = PlaceRecognizer(reference_dir)
+
+        # إضافة الصور المرجعية (استخراج + إلحاق بالمخزن)، ثم انتظار نشر اللقطة
+        references = [(place_id, str(images_dir / filename)) for place_id, filename in PLACE_IMAGES.items()]
+        versions, latencies, wall = timed_run(
+            lambda item: recognizer.add_reference_image(*item), references, 1
+        )
+        if any(version is None for version in versions):
+            raise RuntimeError("فشل في إضافة صورة مرجعية")
+        recognizer.wait_for_snapshot(max(versions))
+        results['add_reference'] = summarize(latencies, wall)
+
+        for mode in modes:
+            for _, query in queries[:warmup]:
+                recognizer.recognize(query, min_confidence, mode)
+            matches, latencies, wall = timed_run(
+                lambda item: recognizer.recognize(item[1], min_confidence, mode), queries, concurrency
+            )
+            correct = sum(
+                match is not None and match.place_id == place_id
+                for match, (place_id, _) in zip(matches, queries)
+            )
+            summary = summarize(latencies, wall)
+            summary['top1'] = round(correct / len(queries), 4)
+            results[f'recognize_{mode}'] = summary
+
+        _, latencies, wall = timed_run(
+            lambda item: recognizer.detect_landmarks(item[1]), queries, concurrency
+        )
+        results['detect_landmarks'] = summarize(latencies, wall)
+        results['cold_start'] = measure_cold_start(reference_dir)
+
+    results['memory'] = {'peak_rss_mb': peak_rss_mb()}
+    return {
+        'meta': environment_info({
+            'per_place': per_place,
+            'queries': len(queries),
+            'seed': seed,
+            'min_confidence': min_confidence,
+            'concurrency': concurrency,
+        }),
+        'results': results,
+    }
+
+
+def measure_cold_start(reference_dir: str) -> Dict:
+    """زمن استيراد server وزمن جاهزية المحرك على المرجع في عملية جديدة (بالملي ثانية)"""
+    script = (
+        "import json, time\n"
+        "started = time.perf_counter()\n"
+        "import server\n"
+        "imported = time.perf_counter()\n"
+        "server.get_recognizer()\n"
+        "print(json.dumps({'import_ms': (imported - started) * 1000,"
+        " 'ready_ms': (time.perf_counter() - started) * 1000}))\n"
+    )
+    env = dict(os.environ, REFERENCE_DIR=reference_dir, EXTRACTION_WORKERS='0')
+    output = subprocess.run(
+        [sys.executable, '-c', script], cwd=SERVICE_DIR, env=env,
+        capture_output=True, text=True, check=True
+    ).stdout
+    timings = json.loads(output.strip().splitlines()[-1])
+    return {metric: round(value, 2) for metric, value in timings.items()}
+
+
+def environment_info(params: Dict) -> Dict:
+    """بيانات البيئة لجعل النتائج قابلة للمقارنة"""
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=SERVICE_DIR,
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'opencv': cv2.__version__,
+        'cpu_count': os.cpu_count(),
+        'platform': platform.platform(),
+        'max_image_edge': os.environ.get('MAX_IMAGE_EDGE', 'default'),
+        'params': params,
+    }
+
+
+def compare(current: Dict, baseline: Dict, tolerance: float, accuracy_tolerance: float) -> List[str]:
+    """قائمة التراجعات مقارنة بخط الأساس (فارغة إذا لم يوجد تراجع)"""
+    regressions = []
+    print(f"{'benchmark':<20} {'metric':<18} {'baseline':>10} {'current':>10} {'change':>8}")
+    for name, metrics in current['results'].items():
+        base_metrics = baseline.get('results', {}).get(name, {})
+        for metric, value in metrics.items():
+            base = base_metrics.get(metric)
+            if base is None or metric in ('n', 'mean_ms'):
+                continue
+            if metric == 'p99_ms' and metrics.get('n', 0) < MIN_SAMPLES_FOR_P99:
+                continue
+            change = (value - base) / base if base else 0.0
+            if metric in LOWER_IS_BETTER:
+                regressed = value > base * (1 + tolerance)
+            elif metric in HIGHER_IS_BETTER:
+                regressed = value < base * (1 - tolerance)
+            elif metric == 'top1':
+                regressed = value < base - accuracy_tolerance
+            else:
+                regressed = False
+            marker = '  <-- تراجع' if regressed else ''
+            print(f"{name:<20} {metric:<18} {base:>10} {value:>10} {change:>+8.1%}{marker}")
+            if regressed:
+                regressions.append(f"{name}.{metric}: {base} -> {value}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="قياس أداء ودقة خدمة التعرف")
+    parser.add_argument('--images-dir', default=str(PLACES_IMAGES_DIR), help="مجلد صور الأماكن")
+    parser.add_argument('--per-place', type=int, default=5, help="عدد الاستعلامات الاصطناعية لكل مكان")
+    parser.add_argument('--seed', type=int, default=0, help="بذرة توليد الاستعلامات")
+    parser.add_argument('--modes', default="sift,orb", help="أوضاع التعرف المقاسة")
+    parser.add_argument('--min-confidence', type=float, default=0.1)
+    parser.add_argument('--concurrency', type=int, default=1, help="عدد الخيوط المتزامنة")
+    parser.add_argument('--output', help="ملف JSON لحفظ النتائج")
+    parser.add_argument('--baseline', help="ملف خط الأساس للمقارنة")
+    parser.add_argument('--save-baseline', action='store_true', help="حفظ النتائج كخط أساس جديد")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="نسبة التراجع المسموحة في الزمن والإنتاجية")
+    parser.add_argument('--accuracy-tolerance', type=float, default=0.02, help="التراجع المسموح في دقة Top-1")
+    args = parser.parse_args()
+
+    report = run_benchmark(
+        Path(args.images_dir), args.per_place, args.seed,
+        tuple(mode for mode in args.modes.split(',') if mode),
+        args.min_confidence, args.concurrency
+    )
+    print(json.dumps(report['results'], indent=2))
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2), encoding='utf-8')
+
+    baseline_path = Path(args.baseline) if args.baseline else BASELINE_FILE
+    if args.save_baseline:
+        baseline_path.parent.mkdir(parents=True, exist_ok=True)
+        baseline_path.write_text(json.dumps(report, indent=2) + '\n', encoding='utf-8')
+        print(f"تم حفظ خط الأساس في {baseline_path}")
+        return
+
+    if args.baseline:
+        baseline = json.loads(baseline_path.read_text(encoding='utf-8'))
+        if baseline['meta'].get('params') != report['meta']['params']:
+            print("تحذير: معاملات القياس تختلف عن خط الأساس")
+        regressions = compare(report, baseline, args.tolerance, args.accuracy_tolerance)
+        if regressions:
+            print(f"تراجع في {len(regressions)} مقياس:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print("لا يوجد تراجع مقارنة بخط الأساس")
+
+
+if __name__ == '__main__':
+    main()
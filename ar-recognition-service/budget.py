@@ -0,0 +1,55 @@
+"""
+ميزانية الوصفات لكل مكان: ثوابت ودوال مشتركة بين الخدمة وأدوات الإدخال والضغط
+Per-place descriptor budget shared by the service, ingest.py and compact.py
+"""
+
+import os
+from typing import Tuple
+
+import numpy as np
+
+# ميزانية الوصفات لكل مكان في كل مخزن (0 = بلا حد)
+PLACE_DESCRIPTOR_BUDGET = int(os.environ.get('PLACE_DESCRIPTOR_BUDGET', 0))
+
+# الحد الأدنى لعدد الوصفات لإبقاء صورة مرجعية
+MIN_REFERENCE_ROWS = 10
+
+
+def strongest(features: Tuple[np.ndarray, np.ndarray], limit: int) -> Tuple[np.ndarray, np.ndarray]:
+    """أقوى limit نقطة حسب الاستجابة مع الحفاظ على ترتيبها الأصلي"""
+    keypoints, descriptors = features
+    if len(keypoints) <= limit:
+        return keypoints, descriptors
+    keep = np.sort(np.argsort(-keypoints['response'], kind='stable')[:limit])
+    return keypoints[keep], descriptors[keep]
+
+
+def image_quotas(sizes: np.ndarray, budget: int) -> np.ndarray:
+    """توزيع الميزانية بالتساوي على الصور، وما لا تحتاجه الصور الصغيرة يذهب للباقي"""
+    quotas = np.zeros(len(sizes), dtype=np.int64)
+    remaining = budget
+    pending = list(np.argsort(sizes, kind='stable'))
+    while pending:
+        share = remaining // len(pending)
+        i = pending.pop(0)
+        quotas[i] = min(int(sizes[i]), share)
+        remaining -= quotas[i]
+    return quotas
+
+
+def append_quotas(sizes: np.ndarray, hits: np.ndarray, budget: int) -> np.ndarray:
+    """حصص صور مكان عند إلحاق صورة جديدة أثناء التشغيل (آخر عنصر في sizes هو الصورة الجديدة)
+
+    hits: عدد مطابقات كل صورة قديمة في التعرف. الصورة الجديدة تبقى دائماً، وإذا لم تتسع
+    الميزانية لـ MIN_REFERENCE_ROWS لكل صورة تُحذف الصور الأقل مطابقة ثم الأقدم (حصة 0).
+    """
+    sizes = np.asarray(sizes, dtype=np.int64)
+    if sizes.sum() <= budget:
+        return sizes.copy()
+    old = np.arange(len(sizes) - 1)
+    order = np.lexsort((-old, -np.asarray(hits, dtype=np.float64)))
+    capacity = max(budget // MIN_REFERENCE_ROWS, 1)
+    active = np.sort(np.append(old[order][:capacity - 1], len(sizes) - 1))
+    quotas = np.zeros(len(sizes), dtype=np.int64)
+    quotas[active] = image_quotas(sizes[active], budget)
+    return quotas
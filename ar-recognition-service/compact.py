@@ -0,0 +1,216 @@
+"""
+ضغط المخزن المرجعي إلى ميزانية وصفات لكل مكان
+Per-place descriptor budgets: keep the strongest, most distinctive descriptors of each view
+
+الاستخدام (دون اتصال، والخدمة تقرأ المخزن المضغوط عند إعادة تشغيلها):
+    python compact.py --reference-dir reference_images --budget 5000
+    python compact.py --reference-dir reference_images --dtype uint8     # تحويل نوع تخزين SIFT
+
+لكل وصف في مكان تجاوز الميزانية تُحسب درجة من:
+- التميز: المسافة إلى أقرب وصف من مكان آخر منسوبة إلى وسيط المكان (بين 0 و 1)
+- القوة: ترتيب استجابة النقطة داخل صورتها (بين 0 و 1)
+وتحتفظ كل صورة بأعلى صفوفها درجة ضمن حصتها من الميزانية. التكرار (عدد صور المكان الأخرى
+التي تحتوي وصفاً يطابقه) يحدد الصور التي تُحذف أولاً إذا لم تكفِ الميزانية جميع الصور.
+"""
+
+import argparse
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from budget import MIN_REFERENCE_ROWS, PLACE_DESCRIPTOR_BUDGET, image_quotas
+from descriptor_index import DescriptorIndex
+from reference_snapshot import INDEX_FACTORIES
+from reference_store import ReferenceStore, StoreLock, StoreLockedError
+from vocabulary import VisualVocabulary
+
+# عدد الجيران المفحوصين لكل وصف، وحجم دفعات المطابقة
+COMPACTION_NEIGHBOURS = 8
+MATCH_CHUNK = 4096
+
+
+def row_owners(images: List[Dict], rows: int) -> np.ndarray:
+    """رقم الصورة المرجعية لكل صف في كتلة المكان"""
+    owners = np.full(rows, -1, dtype=np.int64)
+    for i, image in enumerate(images):
+        owners[image['offset']:image['offset'] + image['rows']] = i
+    return owners
+
+
+def score_rows(index: DescriptorIndex, place_id: str, block: np.ndarray, keypoints: np.ndarray,
+               owners: np.ndarray, neighbours: int = COMPACTION_NEIGHBOURS) -> Tuple[np.ndarray, np.ndarray]:
+    """(درجة كل صف، تكراره عبر صور المكان)
+
+    الدرجة = التميز عن الأماكن الأخرى + ترتيب الاستجابة داخل الصورة. التكرار لا يدخل في
+    الدرجة: الوصفات المتكررة تتركز في منطقة التداخل بين الزوايا فتضعف تقدير التماثل.
+    """
+    label = index.place_ids.index(place_id)
+    repeats = np.zeros(len(block), dtype=np.int64)
+    foreign = np.full(len(block), np.inf, dtype=np.float64)
+
+    for start in range(0, len(block), MATCH_CHUNK):
+        labels, rows, distances = index.knn(block[start:start + MATCH_CHUNK], neighbours)
+        for offset in range(len(labels)):
+            row = start + offset
+            same = []
+            # الجيران مرتبون حسب المسافة: ما يسبق أول وصف من مكان آخر هو من المكان نفسه
+            for neighbour_label, neighbour_row, distance in zip(labels[offset], rows[offset], distances[offset]):
+                if neighbour_label < 0:
+                    break
+                if neighbour_label != label:
+                    foreign[row] = distance
+                    break
+                if owners[neighbour_row] != owners[row]:
+                    same.append((neighbour_row, distance))
+            limit = index.ratio * foreign[row]
+            repeats[row] = len({owners[r] for r, distance in same if distance < limit})
+
+    finite = foreign[np.isfinite(foreign)]
+    scale = max(float(np.median(finite)), 1e-6) if len(finite) else 1.0
+    distinctiveness = np.minimum(foreign / scale, 1.0)
+
+    response = np.asarray(keypoints['response'], dtype=np.float64)
+    strength = np.zeros(len(block), dtype=np.float64)
+    for i in np.unique(owners):
+        rows = np.flatnonzero(owners == i)
+        strength[rows[np.argsort(response[rows], kind='stable')]] = np.arange(len(rows)) / max(len(rows) - 1, 1)
+    return distinctiveness + strength, repeats
+
+
+def select_rows(scores: np.ndarray, repeats: np.ndarray, owners: np.ndarray, n_images: int,
+                budget: int) -> Dict[int, np.ndarray]:
+    """أعلى صفوف كل صورة درجة ضمن حصتها: {رقم الصورة: فهارس الصفوف داخل الكتلة}
+
+    التحقق الهندسي يتم مقابل صورة واحدة، فتحتفظ كل زاوية بحصة من الميزانية. إذا كانت الحصة
+    أقل من MIN_REFERENCE_ROWS تُحذف الصور الأكثر تكراراً لغيرها (أعلى متوسط تكرار) أولاً.
+    """
+    if budget < MIN_REFERENCE_ROWS:
+        raise ValueError(f"الميزانية أقل من الحد الأدنى للصورة ({MIN_REFERENCE_ROWS})")
+    sizes = np.bincount(owners, minlength=n_images)
+    active = np.flatnonzero(sizes >= MIN_REFERENCE_ROWS)
+    redundancy = np.bincount(owners, weights=repeats, minlength=n_images) / np.maximum(sizes, 1)
+    active = active[np.argsort(redundancy[active], kind='stable')]
+    active = np.sort(active[:max(budget // MIN_REFERENCE_ROWS, 1)])
+
+    keep = {}
+    for i, quota in zip(active, image_quotas(sizes[active], budget)):
+        rows = np.flatnonzero(owners == i)
+        keep[int(i)] = np.sort(rows[np.argsort(-scores[rows], kind='stable')[:quota]])
+    return keep
+
+
+def compact_store(store: ReferenceStore, mode: str, budget: int, dry_run: bool = False) -> Dict[str, Dict]:
+    """ضغط أماكن المخزن التي تتجاوز الميزانية؛ يُرجع تقريراً لكل مكان مضغوط"""
+    blocks = {place_id: store.load_descriptors(place_id) for place_id in store.places()}
+    over = [place_id for place_id, block in blocks.items() if block is not None and len(block) > budget]
+    if not over:
+        return {}
+
+    # فهرس واحد لجميع الأماكن كما في الخدمة حتى يُقاس التميز أمام نفس المنافسين
+    index = INDEX_FACTORIES[mode]()
+    index.build(blocks)
+
+    report = {}
+    stale = []
+    for place_id in over:
+        images = store.images(place_id)
+        block = blocks[place_id]
+        owners = row_owners(images, len(block))
+        scores, repeats = score_rows(index, place_id, block, store.load_keypoints(place_id), owners)
+        keep = select_rows(scores, repeats, owners, len(images), budget)
+        report[place_id] = {
+            'rows': len(block),
+            'kept': int(sum(len(rows) for rows in keep.values())),
+            'images': len(images),
+            'droppedImages': len(images) - len(keep)
+        }
+        print(f"[{mode}] المكان {place_id}: {report[place_id]['rows']} ← {report[place_id]['kept']} وصف، "
+              f"حُذفت {report[place_id]['droppedImages']} من {len(images)} صورة")
+        if not dry_run:
+            stale += store.rewrite_place(
+                place_id, {i: rows - images[i]['offset'] for i, rows in keep.items()}
+            )
+
+    if not dry_run:
+        # الجيل الجديد يُنشر بكتابة ملف الفهرس، وبعدها فقط تُحذف ملفات الجيل السابق
+        store.commit()
+        for path in stale:
+            path.unlink()
+    return report
+
+
+def convert_store(store: ReferenceStore, dtype, dry_run: bool = False) -> bool:
+    """تحويل نوع وصفات المخزن (مثلاً float32 إلى uint8)؛ يُرجع True إذا تغير"""
+    dtype = np.dtype(dtype)
+    if store.dtype == dtype:
+        return False
+    print(f"تحويل {store.root} من {store.dtype.name} إلى {dtype.name}")
+    if not dry_run:
+        stale = store.convert(dtype)
+        store.commit()
+        for path in stale:
+            path.unlink()
+    return True
+
+
+def compact_references(reference_images_dir: Path, budget: Optional[int], orb_budget: Optional[int] = None,
+                       dry_run: bool = False, dtype=None) -> Dict[str, Dict]:
+    """ضغط مخزني SIFT و ORB (وتحويل نوع SIFT إن طُلب) ثم إعادة بناء متجهات المفردات البصرية
+
+    يرفض العمل (StoreLockedError) بينما تستخدم الخدمة أو أداة أخرى المجلد؛ التجربة
+    دون تعديل تكتفي بقفل مشترك.
+    """
+    reference_images_dir = Path(reference_images_dir)
+    with StoreLock(reference_images_dir, exclusive=not dry_run):
+        stores = {
+            'sift': (ReferenceStore(reference_images_dir / "store"), budget),
+            'orb': (ReferenceStore(reference_images_dir / "store_orb", dim=32, dtype=np.uint8),
+                    orb_budget or budget)
+        }
+        report = {
+            mode: compact_store(store, mode, mode_budget, dry_run) if mode_budget else {}
+            for mode, (store, mode_budget) in stores.items()
+        }
+        if dtype is not None:
+            convert_store(stores['sift'][0], dtype, dry_run)
+
+        # مقاطع الصور في المفردات تشير إلى صفوف الجيل السابق
+        vocabulary = VisualVocabulary.load(reference_images_dir)
+        if vocabulary is not None and report['sift'] and not dry_run:
+            vocabulary.reindex(stores['sift'][0])
+            print(f"تمت إعادة بناء متجهات {len(vocabulary.images)} صورة في المفردات البصرية")
+        return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ضغط المخزن المرجعي إلى ميزانية وصفات لكل مكان")
+    parser.add_argument('--reference-dir', default="reference_images", help="مجلد الصور المرجعية")
+    parser.add_argument('--budget', type=int, default=PLACE_DESCRIPTOR_BUDGET or None,
+                        help="الحد الأقصى لوصفات كل مكان (الافتراضي: PLACE_DESCRIPTOR_BUDGET)")
+    parser.add_argument('--orb-budget', type=int, default=None,
+                        help="ميزانية مخزن ORB إن اختلفت (الافتراضي: نفس --budget)")
+    parser.add_argument('--dtype', choices=['float32', 'float16', 'uint8'], default=None,
+                        help="تحويل نوع تخزين وصفات SIFT (uint8 و float16 بلا فقد لوصفات OpenCV)")
+    parser.add_argument('--dry-run', action='store_true', help="عرض النتيجة دون تعديل المخزن")
+    args = parser.parse_args()
+
+    if not args.budget and not args.dtype:
+        parser.error("حدد --budget أو المتغير PLACE_DESCRIPTOR_BUDGET أو --dtype")
+    for budget in (args.budget, args.orb_budget):
+        if budget is not None and budget < MIN_REFERENCE_ROWS:
+            parser.error(f"الميزانية يجب ألا تقل عن {MIN_REFERENCE_ROWS}")
+
+    try:
+        report = compact_references(Path(args.reference_dir), args.budget, args.orb_budget, args.dry_run, args.dtype)
+    except StoreLockedError as e:
+        parser.exit(1, f"{e}\n")
+    for mode, places in report.items():
+        before = sum(place['rows'] for place in places.values())
+        after = sum(place['kept'] for place in places.values())
+        print(f"[{mode}] {len(places)} مكان مضغوط: {before} ← {after} وصف"
+              + (" (تجربة دون تعديل)" if args.dry_run else ""))
+
+
+if __name__ == '__main__':
+    main()
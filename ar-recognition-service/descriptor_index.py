@@ -0,0 +1,245 @@
+"""
+فهرس موحد للوصفات المرجعية لجميع الأماكن
+Single descriptor index over all places with per-place voting
+"""
+
+from typing import Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+FLANN_INDEX_KDTREE = 1
+FLANN_INDEX_LSH = 6
+
+
+class DescriptorIndex:
+    """فهرس FLANN واحد (كتلة لكل مكان) مع تصويت حسب المكان
+
+    الكتل تبقى كما وردت من المخزن (memmap بنوع التخزين)؛ FLANN يحتفظ بنسخته الوحيدة بنوع
+    الفهرس، ومطابق المرشحين يحوّل مقاطعهم فقط عند الطلب.
+    """
+
+    def __init__(self, index_params: Dict, search_params: Dict, ratio: float,
+                 dtype=np.float32, min_rows: int = 10):
+        self.index_params = index_params
+        self.search_params = search_params
+        self.ratio = ratio
+        self.dtype = np.dtype(dtype)
+        self.min_rows = min_rows
+        self.flann: Optional[cv2.flann_Index] = None
+        self.place_ids: List[str] = []
+        self.place_sizes: np.ndarray = np.empty(0, dtype=np.int64)
+        self._place_starts = np.zeros(1, dtype=np.int64)
+        self._blocks: List[np.ndarray] = []
+        self._labels: Dict[str, int] = {}
+
+    @classmethod
+    def kdtree(cls, trees: int = 5, checks: int = 50, ratio: float = 0.7) -> 'DescriptorIndex':
+        """فهرس KD-tree لوصفات SIFT العائمة"""
+        return cls(
+            dict(algorithm=FLANN_INDEX_KDTREE, trees=trees),
+            dict(checks=checks),
+            ratio,
+            dtype=np.float32
+        )
+
+    @classmethod
+    def lsh(cls, table_number: int = 6, key_size: int = 12, multi_probe_level: int = 1,
+            ratio: float = 0.75) -> 'DescriptorIndex':
+        """فهرس LSH بمسافة Hamming للوصفات الثنائية (ORB)"""
+        return cls(
+            dict(algorithm=FLANN_INDEX_LSH, table_number=table_number,
+                 key_size=key_size, multi_probe_level=multi_probe_level),
+            dict(checks=50),
+            ratio,
+            dtype=np.uint8
+        )
+
+    def is_empty(self) -> bool:
+        return not self.place_ids
+
+    @property
+    def nbytes(self) -> int:
+        """حجم الوصفات داخل الفهرس (نسخة FLANN المدمجة بنوع الفهرس؛ الكتل نفسها memmap)"""
+        if self.flann is None:
+            return 0
+        return int(self.place_sizes.sum()) * self._blocks[0].shape[1] * self.dtype.itemsize
+
+    def _collect(self, descriptors: Dict[str, Optional[np.ndarray]]) -> Tuple[List[str], List[np.ndarray]]:
+        """الأماكن التي لديها صفوف كافية مع كتلها كما هي"""
+        place_ids = []
+        blocks = []
+        for place_id, ref_descriptors in descriptors.items():
+            if ref_descriptors is None or len(ref_descriptors) < self.min_rows:
+                continue
+            place_ids.append(place_id)
+            blocks.append(ref_descriptors)
+        self._labels = {place_id: label for label, place_id in enumerate(place_ids)}
+        self.place_ids = place_ids
+        self.place_sizes = np.array([len(block) for block in blocks], dtype=np.int64)
+        self._place_starts = np.concatenate([[0], np.cumsum(self.place_sizes)]).astype(np.int64)
+        return place_ids, blocks
+
+    def build(self, descriptors: Dict[str, Optional[np.ndarray]]):
+        """بناء الفهرس مرة واحدة لجميع الأماكن"""
+        _, blocks = self._collect(descriptors)
+        self._blocks = blocks
+        self.flann = None
+        if not blocks:
+            return
+
+        # FLANN ينسخ البيانات إلى فهرسه، فالنسخة المدمجة (بنوع الفهرس) مؤقتة وتُحرر بعد البناء
+        merged = np.empty((int(self.place_sizes.sum()), blocks[0].shape[1]), dtype=self.dtype)
+        for block, start in zip(blocks, self._place_starts):
+            merged[start:start + len(block)] = block
+        self.flann = cv2.flann_Index(merged, self.index_params)
+
+    def knn(self, stacked: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """أقرب k جار في الفهرس الكامل: (أرقام الأماكن، الصفوف داخل كتلها، المسافات)
+
+        كل مصفوفة بشكل (len(stacked), k) مرتبة حسب المسافة؛ الجار غير الموجود رقم مكانه -1.
+        المسافات إقليدية (أو Hamming لـ LSH) بنفس مقياس BFMatcher.
+        """
+        k = min(k, int(self.place_sizes.sum()))
+        indices, distances = self.flann.knnSearch(np.asarray(stacked, dtype=self.dtype), k,
+                                                  params=self.search_params)
+        indices = indices.astype(np.int64).reshape(len(stacked), k)
+        distances = distances.astype(np.float64).reshape(len(stacked), k)
+        if self.dtype != np.uint8:
+            # KD-tree يُرجع مربع المسافة
+            distances = np.sqrt(np.maximum(distances, 0.0))
+        missing = indices < 0
+        labels = np.searchsorted(self._place_starts, np.maximum(indices, 0), side='right') - 1
+        rows = indices - self._place_starts[labels]
+        labels[missing] = -1
+        distances[missing] = np.inf
+        return labels, rows, distances
+
+    def _segments(self, candidates: List) -> List[Tuple[int, int, int]]:
+        """تحويل المرشحين (معرفات أماكن أو (مكان، بداية، عدد صفوف)) إلى مقاطع من الكتل"""
+        segments = []
+        for candidate in candidates:
+            if isinstance(candidate, str):
+                place_id, start, rows = candidate, 0, None
+            else:
+                place_id, start, rows = candidate
+            label = self._labels.get(place_id)
+            if label is None:
+                continue
+            rows = int(self.place_sizes[label]) - start if rows is None else rows
+            segments.append((label, start, rows))
+        return segments
+
+    def _candidate_matcher(self, segments: List[Tuple[int, int, int]]):
+        """مطابق قوة غاشمة على مقاطع المرشحين فقط (مُحوّلة لنوع الفهرس لمدة الاستعلام)"""
+        norm = cv2.NORM_HAMMING if self.dtype == np.uint8 else cv2.NORM_L2
+        matcher = cv2.BFMatcher(norm)
+        matcher.add([
+            np.asarray(self._blocks[label][start:start + rows], dtype=self.dtype)
+            for label, start, rows in segments
+        ])
+        return matcher
+
+    def _ratio_matches(self, stacked: np.ndarray, candidates: Optional[List]) -> Optional[np.ndarray]:
+        """أقرب جارين لكل وصف مع اختبار النسبة (Lowe's ratio test)
+
+        تُرجع صفوف [رقم الوصف في stacked، رقم المكان، رقم الصف في كتلة المكان]،
+        أو None إذا لم يبقَ أي مرشح.
+        """
+        if candidates is None:
+            if self.place_sizes.sum() < 2:
+                return None
+            labels, rows, distances = self.knn(stacked, 2)
+            passed = np.flatnonzero((labels[:, 1] >= 0) & (distances[:, 0] < self.ratio * distances[:, 1]))
+            if len(passed) == 0:
+                return None
+            return np.column_stack([passed, labels[passed, 0], rows[passed, 0]]).astype(np.int64)
+
+        segments = self._segments(candidates)
+        if not segments:
+            return None
+        matcher = self._candidate_matcher(segments)
+        label_map = np.asarray([segment[0] for segment in segments], dtype=np.int64)
+        offset_map = np.asarray([segment[1] for segment in segments], dtype=np.int64)
+
+        matches = matcher.knnMatch(stacked, k=2)
+        good = [
+            (pair[0].queryIdx, pair[0].imgIdx, pair[0].trainIdx) for pair in matches
+            if len(pair) == 2 and pair[0].distance < self.ratio * pair[1].distance
+        ]
+        if not good:
+            return None
+
+        good = np.asarray(good, dtype=np.int64)
+        good[:, 2] += offset_map[good[:, 1]]
+        good[:, 1] = label_map[good[:, 1]]
+        return good
+
+    def _grouped_ratio_matches(self, stacked: np.ndarray, groups: np.ndarray,
+                               group_candidates: List[Optional[List]]) -> Optional[np.ndarray]:
+        """اختبار النسبة لكل مجموعة وصفات على مرشحي مجموعتها فقط (نفس صيغة _ratio_matches)
+
+        groups: رقم المجموعة لكل وصف في stacked، و group_candidates مرشحو كل مجموعة.
+        """
+        found = []
+        for group, candidates in enumerate(group_candidates):
+            rows = np.flatnonzero(groups == group)
+            good = self._ratio_matches(stacked[rows], candidates)
+            if good is not None:
+                good[:, 0] = rows[good[:, 0]]
+                found.append(good)
+        if not found:
+            return None
+        good = np.vstack(found)
+        return good[np.argsort(good[:, 0], kind='stable')]
+
+    def vote(self, query_descriptors: List[Optional[np.ndarray]],
+             candidates: Optional[List[str]] = None,
+             query_candidates: Optional[List[Optional[List]]] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """مطابقة عدة استعلامات في استدعاء knn واحد
+
+        تُرجع (الأصوات، عدد الوصفات، المطابقات الجيدة) حيث كل مطابقة جيدة صف
+        [رقم الاستعلام، رقم الوصف في الاستعلام، رقم المكان، رقم الصف في كتلة المكان].
+        إذا حُدد مرشحون (أماكن أو مقاطع صور) تتم المطابقة عليهم فقط بدلاً من الفهرس الكامل.
+        query_candidates (بدلاً من candidates): مرشحو كل استعلام على حدة، فلا يصوت استعلام
+        لمرشحي غيره؛ الاستعلامات ذات المرشحين أنفسهم تُطابق معاً.
+        """
+        votes = np.zeros((len(query_descriptors), len(self.place_ids)), dtype=np.int64)
+        counts = np.array(
+            [len(d) if d is not None else 0 for d in query_descriptors],
+            dtype=np.int64
+        )
+        valid = [i for i, d in enumerate(query_descriptors) if d is not None]
+        no_matches = np.empty((0, 4), dtype=np.int64)
+
+        if not valid or self.is_empty():
+            return votes, counts, no_matches
+
+        # تجميع وصفات جميع الصور في مصفوفة واحدة مع حدود كل صورة
+        bounds = np.concatenate([[0], np.cumsum(counts[valid])])
+        stacked = np.vstack([np.asarray(query_descriptors[i], dtype=self.dtype) for i in valid])
+
+        if query_candidates is None:
+            good = self._ratio_matches(stacked, candidates)
+        else:
+            query_keys = [None if query_candidates[i] is None else tuple(query_candidates[i]) for i in valid]
+            keys = list(dict.fromkeys(query_keys))
+            groups = np.repeat([keys.index(key) for key in query_keys], counts[valid])
+            good = self._grouped_ratio_matches(
+                stacked, groups, [None if key is None else list(key) for key in keys]
+            )
+        if good is None or len(good) == 0:
+            return votes, counts, no_matches
+
+        positions = np.searchsorted(bounds, good[:, 0], side='right') - 1
+        query_rows = np.asarray(valid, dtype=np.int64)[positions]
+        place_labels, place_rows = good[:, 1], good[:, 2]
+        np.add.at(votes, (query_rows, place_labels), 1)
+
+        good_matches = np.column_stack([
+            query_rows,
+            good[:, 0] - bounds[positions],
+            place_labels,
+            place_rows
+        ])
+        return votes, counts, good_matches
@@ -0,0 +1,284 @@
+"""
+دوال استخراج الميزات (خفيفة وقابلة للتشغيل في عمليات منفصلة)
+Feature extraction functions, safe to run inside worker processes
+"""
+
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from reference_store import keypoints_to_array
+
+SIFT_FEATURES = 500
+ORB_FEATURES = 1000
+
+# الطول الأقصى لضلع الصورة قبل الاستخراج (0 لتعطيل التصغير)
+MAX_IMAGE_EDGE = int(os.environ.get('MAX_IMAGE_EDGE', 1024))
+
+# معاملات فك الترميز المصغّر من الأكبر للأصغر
+_REDUCED_GRAYSCALE = (
+    (8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+    (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+    (2, cv2.IMREAD_REDUCED_GRAYSCALE_2),
+)
+
+# تحليل المعالم: أطول ضلع، وحدود الزوايا والخطوط في الرد، والمسافة بين الزوايا، وطول الخط الأدنى كنسبة من الضلع
+LANDMARK_MAX_EDGE = int(os.environ.get('LANDMARK_MAX_EDGE', 640))
+LANDMARK_MAX_CORNERS = int(os.environ.get('LANDMARK_MAX_CORNERS', 200))
+LANDMARK_MAX_LINES = int(os.environ.get('LANDMARK_MAX_LINES', 100))
+LANDMARK_MIN_CORNER_DISTANCE = 8
+LANDMARK_MIN_LINE_RATIO = 50 / 1024
+LANDMARK_ORIENTATION_BINS = 36
+
+_JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+_local = threading.local()
+
+
+def _sift():
+    """كاشف SIFT خاص بكل خيط/عملية"""
+    sift = getattr(_local, 'sift', None)
+    if sift is None:
+        sift = cv2.SIFT_create(nfeatures=SIFT_FEATURES)
+        _local.sift = sift
+    return sift
+
+
+def _orb():
+    """كاشف ORB خاص بكل خيط/عملية"""
+    orb = getattr(_local, 'orb', None)
+    if orb is None:
+        orb = cv2.ORB_create(nfeatures=ORB_FEATURES)
+        _local.orb = orb
+    return orb
+
+
+def _detectors():
+    return {'sift': _sift, 'orb': _orb}
+
+
+def image_size(image_bytes: bytes) -> Optional[Tuple[int, int]]:
+    """قراءة (العرض، الارتفاع) من ترويسة JPEG أو PNG دون فك ترميز الصورة"""
+    data = memoryview(image_bytes)
+    if len(data) >= 24 and bytes(data[:8]) == b'\x89PNG\r\n\x1a\n':
+        return int.from_bytes(data[16:20], 'big'), int.from_bytes(data[20:24], 'big')
+
+    if len(data) < 4 or bytes(data[:2]) != b'\xff\xd8':
+        return None
+    i = 2
+    while i + 9 < len(data):
+        if data[i] != 0xFF:
+            i += 1
+            continue
+        marker = data[i + 1]
+        if marker in _JPEG_SOF_MARKERS:
+            return int.from_bytes(data[i + 7:i + 9], 'big'), int.from_bytes(data[i + 5:i + 7], 'big')
+        if marker == 0xFF or marker == 0x01 or 0xD0 <= marker <= 0xD9:
+            i += 2 if marker != 0xFF else 1
+            continue
+        i += 2 + int.from_bytes(data[i + 2:i + 4], 'big')
+    return None
+
+
+def decode_gray(image_bytes: bytes, max_edge: Optional[int] = None) -> Optional[np.ndarray]:
+    """فك ترميز الصورة مباشرة إلى تدرج رمادي مع تصغيرها لطول ضلع أقصى
+
+    يُستخدم فك الترميز المصغّر (IMREAD_REDUCED_GRAYSCALE_*) عندما تسمح أبعاد الصورة،
+    ثم INTER_AREA للوصول إلى max_edge بالضبط. الصور المرجعية وصور الاستعلام تمر بنفس المعالجة.
+    """
+    max_edge = MAX_IMAGE_EDGE if max_edge is None else max_edge
+    nparr = np.frombuffer(image_bytes, np.uint8)
+
+    flag = cv2.IMREAD_GRAYSCALE
+    if max_edge > 0:
+        size = image_size(image_bytes)
+        if size is not None:
+            long_edge = max(size)
+            for factor, reduced_flag in _REDUCED_GRAYSCALE:
+                if long_edge // factor >= max_edge:
+                    flag = reduced_flag
+                    break
+
+    gray = cv2.imdecode(nparr, flag)
+    if gray is None:
+        return None
+
+    long_edge = max(gray.shape[:2])
+    if max_edge > 0 and long_edge > max_edge:
+        scale = max_edge / long_edge
+        gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return gray
+
+
+def decoded_long_edge(image_bytes: bytes, max_edge: Optional[int] = None) -> Optional[int]:
+    """أطول ضلع للصورة كما تُرجعها decode_gray (من الترويسة دون فك الترميز)"""
+    size = image_size(image_bytes)
+    if size is None:
+        return None
+    max_edge = MAX_IMAGE_EDGE if max_edge is None else max_edge
+    long_edge = max(size)
+    return min(long_edge, max_edge) if max_edge > 0 else long_edge
+
+
+def dhash(image_bytes: bytes, hash_size: int = 8) -> Optional[int]:
+    """بصمة إدراكية (dHash) من نسخة مصغرة من الصورة"""
+    nparr = np.frombuffer(image_bytes, np.uint8)
+    small = cv2.imdecode(nparr, cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    if small is None:
+        return None
+
+    resized = cv2.resize(small, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    bits = (resized[:, 1:] > resized[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def _detect(gray: np.ndarray, mode: str) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+    keypoints, descriptors = _detectors()[mode]().detectAndCompute(gray, None)
+    if descriptors is None:
+        return None
+    return keypoints_to_array(keypoints), descriptors
+
+
+def extract_features(image_bytes: bytes, mode: str = 'sift') -> Optional[Tuple[np.ndarray, np.ndarray]]:
+    """استخراج النقاط والوصفات (SIFT أو ORB) من بايتات صورة"""
+    return extract_features_timed(image_bytes, mode)[0]
+
+
+def extract_features_timed(image_bytes: bytes, mode: str = 'sift') -> Tuple[Optional[Tuple[np.ndarray, np.ndarray]], Dict[str, float]]:
+    """مثل extract_features مع زمن كل مرحلة بالثواني {"decode", "detect"}
+
+    تُقاس الأزمنة داخل عملية الاستخراج وتُعاد مع النتيجة لأن المقاييس تُجمع في عملية الخادم.
+    """
+    started = time.perf_counter()
+    gray = decode_gray(image_bytes)
+    decoded = time.perf_counter()
+    if gray is None:
+        return None, {'decode': decoded - started}
+    features = _detect(gray, mode)
+    return features, {'decode': decoded - started, 'detect': time.perf_counter() - decoded}
+
+
+def extract_sift(image_bytes: bytes) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+    """استخراج نقاط ووصفات SIFT من بايتات صورة"""
+    return extract_features(image_bytes, 'sift')
+
+
+def extract_reference_features(image_bytes: bytes) -> Optional[Dict]:
+    """استخراج ميزات جميع الأوضاع لصورة مرجعية بفك ترميز واحد"""
+    gray = decode_gray(image_bytes)
+    if gray is None:
+        return None
+    return {mode: _detect(gray, mode) for mode in _detectors()}
+
+
+def _landmark_buffers(shape: Tuple[int, int]) -> Dict[str, np.ndarray]:
+    """مخازن تحليل المعالم لكل خيط/عملية، تُعاد بين الاستدعاءات ما دام حجم الإطار نفسه"""
+    buffers = getattr(_local, 'landmark_buffers', None)
+    if buffers is None or buffers['shape'] != shape:
+        level = ((shape[0] + 1) // 2, (shape[1] + 1) // 2)
+        buffers = {
+            'shape': shape,
+            'level': np.empty(level, np.uint8),
+            'edges': np.empty(level, np.uint8),
+            'dx': np.empty(level, np.float32),
+            'dy': np.empty(level, np.float32),
+            'magnitude': np.empty(level, np.float32),
+            'angle': np.empty(level, np.float32),
+        }
+        _local.landmark_buffers = buffers
+    return buffers
+
+
+def _dominant_orientations(buffers: Dict[str, np.ndarray], limit: int = 3) -> Tuple[List[float], List[float]]:
+    """أقوى اتجاهات الحواف (بالدرجات 0-180) من مدرج التدرج على بكسلات Canny فقط"""
+    cv2.Sobel(buffers['level'], cv2.CV_32F, 1, 0, dst=buffers['dx'], ksize=3)
+    cv2.Sobel(buffers['level'], cv2.CV_32F, 0, 1, dst=buffers['dy'], ksize=3)
+    cv2.cartToPolar(buffers['dx'], buffers['dy'], magnitude=buffers['magnitude'],
+                    angle=buffers['angle'], angleInDegrees=True)
+    on_edge = np.flatnonzero(buffers['edges'])
+    if not len(on_edge):
+        return [], []
+
+    # اتجاه الحافة عمودي على اتجاه التدرج
+    angles = (buffers['angle'].ravel()[on_edge] + 90) % 180
+    weights = buffers['magnitude'].ravel()[on_edge]
+    bins = (angles * (LANDMARK_ORIENTATION_BINS / 180)).astype(np.intp) % LANDMARK_ORIENTATION_BINS
+    histogram = np.bincount(bins, weights, minlength=LANDMARK_ORIENTATION_BINS)
+
+    # القمم المحلية في المدرج الدائري
+    peaks = np.flatnonzero(
+        (histogram >= np.roll(histogram, 1)) & (histogram > np.roll(histogram, -1)) & (histogram > 0)
+    )
+    peaks = peaks[np.argsort(-histogram[peaks])][:limit]
+    width = 180 / LANDMARK_ORIENTATION_BINS
+    total = histogram.sum()
+    return ([round(float((peak + 0.5) * width), 1) for peak in peaks],
+            [round(float(histogram[peak] / total), 4) for peak in peaks])
+
+
+def detect_landmarks(image_bytes: bytes, max_edge: Optional[int] = None,
+                     max_corners: Optional[int] = None) -> List[Dict]:
+    """اكتشاف المعالم في الصورة: الزوايا والخطوط واتجاهات الحواف السائدة
+
+    الزوايا تُكتشف على نسخة مصغرة (LANDMARK_MAX_EDGE)، والحواف والخطوط والاتجاهات على المستوى
+    التالي من الهرم (نصف الدقة). تُعاد الإحداثيات بدقة الصورة الأصلية.
+    """
+    max_edge = LANDMARK_MAX_EDGE if max_edge is None else max_edge
+    max_corners = LANDMARK_MAX_CORNERS if max_corners is None else max_corners
+    gray = decode_gray(image_bytes, max_edge)
+    if gray is None:
+        return []
+
+    size = image_size(image_bytes)
+    scale = max(size) / max(gray.shape) if size else 1.0
+    buffers = _landmark_buffers(gray.shape)
+
+    # الزوايا كنقاط متفرقة (Shi-Tomasi) بدل خريطة Harris كاملة، دون حد حتى يبقى العدد الكلي معروفاً
+    # (النقاط مرتبة حسب القوة فتُعاد أقوى max_corners منها)
+    corners = cv2.goodFeaturesToTrack(gray, 0, 0.01, LANDMARK_MIN_CORNER_DISTANCE)
+
+    # الحواف بـ Canny ثم الخطوط بـ Hough على مستوى الهرم التالي (الطول الأدنى نسبة من حجم الصورة)
+    level = buffers['level']
+    cv2.pyrDown(gray, dst=level, dstsize=(level.shape[1], level.shape[0]))
+    cv2.Canny(level, 50, 150, edges=buffers['edges'])
+    min_line_length = max(int(max(level.shape) * LANDMARK_MIN_LINE_RATIO), 10)
+    lines = cv2.HoughLinesP(buffers['edges'], 1, np.pi / 180, min_line_length,
+                            minLineLength=min_line_length, maxLineGap=5)
+
+    angles, strengths = _dominant_orientations(buffers)
+
+    landmarks = []
+
+    if corners is not None:
+        points = corners.reshape(-1, 2)[:max_corners].astype(np.float64) * scale
+        landmarks.append({
+            "type": "corners",
+            "count": len(corners),
+            "returned": len(points),
+            "points": np.round(points, 1).tolist()
+        })
+
+    if lines is not None:
+        # أطول الخطوط فقط في الرد، والعدد الكلي في count
+        segments = lines.reshape(-1, 4).astype(np.float64)
+        lengths = np.hypot(segments[:, 2] - segments[:, 0], segments[:, 3] - segments[:, 1])
+        longest = segments[np.argsort(-lengths, kind='stable')[:LANDMARK_MAX_LINES]] * (scale * 2)
+        landmarks.append({
+            "type": "lines",
+            "count": len(segments),
+            "returned": len(longest),
+            "segments": np.round(longest, 1).tolist()
+        })
+
+    if angles:
+        landmarks.append({
+            "type": "orientations",
+            "angles": angles,
+            "strengths": strengths
+        })
+
+    return landmarks
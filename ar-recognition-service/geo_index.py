@@ -0,0 +1,54 @@
+"""
+فهرس مكاني لمواقع الأماكن لتقليص المرشحين حسب موقع المستخدم
+Spatial index over place locations for GPS-based candidate pruning
+"""
+
+from typing import Dict, Iterator, List, Optional
+
+import numpy as np
+
+EARTH_RADIUS_M = 6371000.0
+
+# نصف قطر البحث الأدنى والأقصى، ومعامل التوسيع عند عدم وجود نتيجة
+MIN_RADIUS_M = 1000.0
+MAX_RADIUS_M = 50000.0
+WIDEN_FACTOR = 4.0
+
+
+class GeoIndex:
+    """شجرة BallTree بمسافة haversine فوق مواقع الأماكن"""
+
+    def __init__(self, places: Dict[str, Dict]):
+        self.place_ids: List[str] = [
+            place_id for place_id, data in places.items() if data.get('location')
+        ]
+        coords = np.radians([
+            [places[place_id]['location']['lat'], places[place_id]['location']['lng']]
+            for place_id in self.place_ids
+        ]).reshape(-1, 2)
+        # استيراد متأخر: sklearn يضيف أكثر من ثانية لاستيراد الخدمة
+        from sklearn.neighbors import BallTree
+        self.tree = BallTree(coords, metric='haversine') if self.place_ids else None
+
+    def within(self, lat: float, lng: float, radius_m: float) -> List[str]:
+        """الأماكن الواقعة ضمن نصف قطر (بالأمتار) من نقطة"""
+        if self.tree is None:
+            return []
+        point = np.radians([[lat, lng]])
+        indices = self.tree.query_radius(point, r=radius_m / EARTH_RADIUS_M)[0]
+        return [self.place_ids[i] for i in sorted(indices)]
+
+    def candidate_sets(self, location: Optional[Dict]) -> Iterator[Optional[List[str]]]:
+        """مجموعات مرشحين متسعة تدريجياً، تنتهي بـ None (جميع الأماكن)"""
+        if location:
+            radius = max(float(location.get('accuracy') or 0) * 2, MIN_RADIUS_M)
+            previous: List[str] = []
+            while radius <= MAX_RADIUS_M:
+                candidates = self.within(location['lat'], location['lng'], radius)
+                if len(candidates) == len(self.place_ids):
+                    break
+                if candidates and candidates != previous:
+                    yield candidates
+                    previous = candidates
+                radius *= WIDEN_FACTOR
+        yield None
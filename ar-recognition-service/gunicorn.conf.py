@@ -0,0 +1,24 @@
+"""
+إعدادات Gunicorn لتشغيل الخدمة في الإنتاج
+Gunicorn production configuration
+"""
+
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5001)}"
+
+# عامل ويب واحد بخيوط متعددة: العمل الثقيل يتم في مجمع عمليات الاستخراج
+workers = int(os.environ.get('WEB_WORKERS', 1))
+worker_class = 'gthread'
+threads = int(os.environ.get('WEB_THREADS', 8))
+
+timeout = int(os.environ.get('WEB_TIMEOUT', 60))
+graceful_timeout = 30
+accesslog = '-'
+
+
+def post_worker_init(worker):
+    # تحميل محرك التعرف في الخلفية فور بدء العامل؛ /health/live تجيب مباشرة
+    # و /health/ready تُرجع 503 حتى يكتمل التحميل
+    import server
+    server.start_loading()
@@ -0,0 +1,240 @@
+"""
+إدخال مجمّع للصور المرجعية من مجلد منظم حسب المكان
+Bulk reference ingestion: parallel extraction, near-duplicate removal and one commit
+
+الاستخدام (دون اتصال، والخدمة تقرأ المخزن الجديد عند إعادة تشغيلها):
+    python ingest.py photos/ --reference-dir reference_images --max-descriptors 5000
+
+حيث يحتوي photos/ على مجلد لكل مكان: photos/<place_id>/*.jpg
+"""
+
+import argparse
+import itertools
+import multiprocessing
+import os
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+import feature_extraction
+from budget import MIN_REFERENCE_ROWS, PLACE_DESCRIPTOR_BUDGET, strongest
+from reference_store import SIFT_STORE_DTYPE, ReferenceStore, StoreLock, StoreLockedError
+from vocabulary import VisualVocabulary
+from worker_pool import _init_worker
+
+IMAGE_SUFFIXES = {'.jpg', '.jpeg', '.png'}
+
+# أقصى مسافة Hamming بين بصمتي dHash لاعتبار الصورتين شبه متطابقتين
+DEDUPE_DISTANCE = 6
+
+
+def find_images(source_dir: Path) -> List[Tuple[str, Path]]:
+    """قائمة (معرف المكان، مسار الصورة) مرتبة حسب المكان"""
+    images = []
+    for place_dir in sorted(p for p in Path(source_dir).iterdir() if p.is_dir()):
+        for path in sorted(place_dir.iterdir()):
+            if path.suffix.lower() in IMAGE_SUFFIXES:
+                images.append((place_dir.name, path))
+    return images
+
+
+def extract_file(path: str) -> Optional[Tuple[int, Dict]]:
+    """قراءة صورة واستخراج بصمتها وميزات الوضعين (تعمل داخل عمليات المجمع)"""
+    try:
+        image_bytes = Path(path).read_bytes()
+    except OSError:
+        return None
+    image_hash = feature_extraction.dhash(image_bytes)
+    features = feature_extraction.extract_reference_features(image_bytes)
+    if image_hash is None or features is None:
+        return None
+    return image_hash, features
+
+
+def _hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count('1')
+
+
+def _budget(images: List, existing_rows: int, max_descriptors: Optional[int]) -> List[Optional[int]]:
+    """توزيع ميزانية الوصفات المتبقية للمكان بالتساوي على الصور الجديدة"""
+    if max_descriptors is None:
+        return [None] * len(images)
+    remaining = max(max_descriptors - existing_rows, 0)
+    share = remaining // max(len(images), 1)
+    if share >= MIN_REFERENCE_ROWS:
+        return [share] * len(images)
+    # الميزانية لا تكفي جميع الصور: أول الصور بالحد الأدنى فقط
+    fits = remaining // MIN_REFERENCE_ROWS
+    return [MIN_REFERENCE_ROWS if i < fits else 0 for i in range(len(images))]
+
+
+def _select_place(store: ReferenceStore, place_id: str, results: List[Tuple[Path, Optional[Tuple[int, Dict]]]],
+                  dedupe_distance: int, report: Dict) -> List[Tuple[Path, int, Dict]]:
+    """استبعاد الصور الفاشلة وشبه المكررة (مع الصور الموجودة في المخزن أيضاً)"""
+    seen = [image['dhash'] for image in store.images(place_id) if 'dhash' in image]
+    selected = []
+    for path, result in results:
+        if result is None or result[1]['sift'] is None or len(result[1]['sift'][1]) < MIN_REFERENCE_ROWS:
+            report['failed'].append(str(path))
+            continue
+        image_hash, features = result
+        if dedupe_distance >= 0 and any(_hamming(image_hash, other) <= dedupe_distance for other in seen):
+            report['duplicates'] += 1
+            continue
+        seen.append(image_hash)
+        selected.append((path, image_hash, features))
+    return selected
+
+
+def _image_key(image: Dict) -> Tuple[str, Optional[int]]:
+    return image['image_path'], image.get('dhash')
+
+
+def recover(store: ReferenceStore, orb_store: ReferenceStore,
+            vocabulary: Optional[VisualVocabulary]) -> Dict[str, int]:
+    """إكمال إدخال سابق توقف بين نشر ملفات الفهرس
+
+    ORB يُنشر قبل SIFT، فصور ORB التي لا تقابلها صورة SIFT (نفس المسار والبصمة) بقايا
+    إدخال لم يكتمل وتُحذف ليعيد الإدخال التالي إضافتها كاملة؛ وصور SIFT الناقصة من
+    المفردات تُضاف إليها. تكرار الاستدعاء لا يغير شيئاً.
+    """
+    dropped = 0
+    stale = []
+    for place_id in orb_store.places():
+        remaining = Counter(_image_key(image) for image in store.images(place_id))
+        keep = {}
+        for i, image in enumerate(orb_store.images(place_id)):
+            key = _image_key(image)
+            if remaining[key] > 0:
+                remaining[key] -= 1
+                keep[i] = np.arange(image['rows'])
+        extra = len(orb_store.images(place_id)) - len(keep)
+        if extra:
+            stale += orb_store.rewrite_place(place_id, keep)
+            dropped += extra
+    if dropped:
+        orb_store.commit()
+        for path in stale:
+            path.unlink()
+    added = vocabulary.sync(store) if vocabulary is not None else 0
+    return {'orb_dropped': dropped, 'vocabulary_added': added}
+
+
+def ingest_directory(source_dir: Path, reference_images_dir: Path, workers: Optional[int] = None,
+                     max_descriptors: Optional[int] = None,
+                     dedupe_distance: int = DEDUPE_DISTANCE) -> Dict:
+    """إدخال جميع صور source_dir/<place_id>/ في المخزن المرجعي
+
+    تُكتب الكتل أثناء المعالجة لكن ملفات الفهرس لا تُكتب إلا في النهاية (ORB ثم SIFT
+    ثم المفردات البصرية)، فإذا توقف الإدخال قبل ذلك يبقى المخزن كما كان، وإذا توقف
+    بينها يكمله recover() في بداية الإدخال التالي. يرفض مجلدات الأماكن غير المعروفة
+    (ValueError) ويرفض العمل بينما تستخدم الخدمة المجلد (StoreLockedError).
+    """
+    # استيراد متأخر: عمليات الاستخراج تستورد هذا الملف ولا تحتاج المحرك
+    from place_recognition import PLACES_DATA
+
+    reference_images_dir = Path(reference_images_dir)
+    images = find_images(source_dir)
+    unknown = sorted({place_id for place_id, _ in images} - PLACES_DATA.keys())
+    if unknown:
+        raise ValueError(f"أماكن غير معروفة في {source_dir}: {', '.join(unknown)}")
+
+    with StoreLock(reference_images_dir):
+        store = ReferenceStore(reference_images_dir / "store", dtype=SIFT_STORE_DTYPE)
+        orb_store = ReferenceStore(reference_images_dir / "store_orb", dim=32, dtype=np.uint8)
+        vocabulary = VisualVocabulary.load(reference_images_dir)
+        recovered = recover(store, orb_store, vocabulary)
+        if any(recovered.values()):
+            print(f"إكمال إدخال سابق: حذف {recovered['orb_dropped']} صورة ORB غير منشورة، "
+                  f"وإضافة {recovered['vocabulary_added']} صورة إلى المفردات")
+
+        report = {
+            'images': len(images),
+            'added': 0,
+            'duplicates': 0,
+            'failed': [],
+            'places': {}
+        }
+        vocabulary_entries = []
+        started = time.monotonic()
+
+        executor = ProcessPoolExecutor(
+            max_workers=workers or os.cpu_count() or 1,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker
+        )
+        try:
+            # النتائج تصل بالترتيب فتُعالج كل مجموعة مكان فور اكتمالها دون الاحتفاظ بالدفعة كاملة
+            results = executor.map(extract_file, [str(path) for _, path in images], chunksize=4)
+            for place_id, group in itertools.groupby(zip(images, results), key=lambda item: item[0][0]):
+                selected = _select_place(
+                    store, place_id, [(path, result) for (_, path), result in group],
+                    dedupe_distance, report
+                )
+                sift_budget = _budget(selected, store.manifest['places'].get(place_id, {}).get('rows', 0), max_descriptors)
+                orb_budget = _budget(selected, orb_store.manifest['places'].get(place_id, {}).get('rows', 0), max_descriptors)
+
+                added = 0
+                for (path, image_hash, features), sift_limit, orb_limit in zip(selected, sift_budget, orb_budget):
+                    sift = features['sift'] if sift_limit is None else strongest(features['sift'], sift_limit)
+                    if len(sift[1]) < MIN_REFERENCE_ROWS:
+                        continue
+                    record = store.append(place_id, sift[0], sift[1], str(path), image_hash, commit=False)
+                    if vocabulary is not None:
+                        vocabulary_entries.append((place_id, record['offset'], record['rows'], sift[1]))
+
+                    orb = features.get('orb')
+                    if orb is not None and orb_limit is not None:
+                        orb = strongest(orb, orb_limit)
+                    if orb is not None and len(orb[1]) >= MIN_REFERENCE_ROWS:
+                        orb_store.append(place_id, orb[0], orb[1], str(path), image_hash, commit=False)
+                    added += 1
+
+                report['added'] += added
+                report['places'][place_id] = {
+                    'added': added,
+                    'descriptors': store.manifest['places'].get(place_id, {}).get('rows', 0)
+                }
+                print(f"المكان {place_id}: أضيفت {added} صورة")
+        finally:
+            executor.shutdown(cancel_futures=True)
+
+        orb_store.commit()
+        store.commit()
+        if vocabulary is not None:
+            vocabulary.add_images(vocabulary_entries)
+
+        report['seconds'] = round(time.monotonic() - started, 2)
+        return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="إدخال مجمّع للصور المرجعية من مجلد <place_id>/*.jpg")
+    parser.add_argument('source_dir', help="مجلد يحتوي مجلداً لكل مكان")
+    parser.add_argument('--reference-dir', default="reference_images", help="مجلد الصور المرجعية")
+    parser.add_argument('--workers', type=int, default=None, help="عدد عمليات الاستخراج (الافتراضي: عدد الأنوية)")
+    parser.add_argument('--max-descriptors', type=int, default=PLACE_DESCRIPTOR_BUDGET or None,
+                        help="الحد الأقصى لوصفات كل مكان (تُحتفظ بأقوى النقاط؛ الافتراضي: PLACE_DESCRIPTOR_BUDGET)")
+    parser.add_argument('--dedupe-distance', type=int, default=DEDUPE_DISTANCE,
+                        help="أقصى مسافة Hamming بين بصمات الصور المكررة (-1 للتعطيل)")
+    args = parser.parse_args()
+
+    try:
+        report = ingest_directory(
+            Path(args.source_dir), Path(args.reference_dir), args.workers,
+            args.max_descriptors, args.dedupe_distance
+        )
+    except (ValueError, StoreLockedError) as e:
+        parser.exit(1, f"{e}\n")
+    print(f"تمت إضافة {report['added']} من {report['images']} صورة في {report['seconds']} ثانية "
+          f"({report['duplicates']} مكررة، {len(report['failed'])} فاشلة)")
+    for path in report['failed']:
+        print(f"  فشل: {path}")
+
+
+if __name__ == '__main__':
+    main()
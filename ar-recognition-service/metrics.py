@@ -0,0 +1,228 @@
+"""
+مقاييس الأداء بصيغة Prometheus النصية
+Minimal in-process metrics (counters, gauges, histograms) with Prometheus text exposition
+"""
+
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+# حدود مدرجات الزمن بالثواني
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(str(value))}"' for name, value in labels.items()) + '}'
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"تسميات غير صحيحة للمقياس {self.name}: {sorted(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key: Tuple[str, ...]) -> Dict[str, str]:
+        return dict(zip(self.labelnames, key))
+
+    def samples(self) -> Iterable[Tuple[str, Dict[str, str], float]]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        for name, labels, value in self.samples():
+            lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    """عداد تراكمي"""
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            yield self.name, self._labels(key), value
+
+
+class Gauge(_Metric):
+    """قيمة لحظية تُحسب عند القراءة من دالة (تُرجع رقماً أو قاموس {تسميات: قيمة})"""
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 callback: Optional[Callable] = None):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def samples(self):
+        if self.callback is None:
+            return
+        try:
+            values = self.callback()
+        except Exception:
+            return
+        if values is None:
+            return
+        if not isinstance(values, dict):
+            values = {(): values}
+        for key, value in values.items():
+            key = key if isinstance(key, tuple) else (key,)
+            yield self.name, self._labels(key), value
+
+
+class Histogram(_Metric):
+    """مدرج تراكمي بحدود ثابتة مع المجموع والعدد"""
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self._values: Dict[Tuple[str, ...], Tuple[list, list]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, totals = self._values.setdefault(key, ([0] * len(self.buckets), [0.0, 0]))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            totals[0] += value
+            totals[1] += 1
+
+    def samples(self):
+        with self._lock:
+            items = [(key, list(counts), list(totals)) for key, (counts, totals) in self._values.items()]
+        for key, counts, (total, count) in items:
+            labels = self._labels(key)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield f'{self.name}_bucket', {**labels, 'le': _format_value(float(bound))}, cumulative
+            yield f'{self.name}_sum', labels, total
+            yield f'{self.name}_count', labels, count
+
+
+class Registry:
+    """مجموعة المقاييس المعروضة على /metrics"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    'ar_stage_seconds', 'Time spent in each recognition stage', ('stage',)
+))
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    'ar_http_request_seconds', 'HTTP request latency by endpoint', ('endpoint',)
+))
+REQUESTS = REGISTRY.register(Counter(
+    'ar_http_requests_total', 'HTTP requests by endpoint and status code', ('endpoint', 'status')
+))
+RECOGNITIONS = REGISTRY.register(Counter(
+    'ar_recognitions_total', 'Recognized, unrecognized and errored images', ('mode', 'outcome')
+))
+ERRORS = REGISTRY.register(Counter(
+    'ar_errors_total', 'Exceptions caught by operation', ('operation',)
+))
+
+
+def gauge(name: str, documentation: str, callback: Callable, labelnames: Tuple[str, ...] = ()) -> Gauge:
+    """تسجيل مقياس لحظي يُحسب عند كل قراءة"""
+    return REGISTRY.register(Gauge(name, documentation, labelnames, callback))
+
+
+def process_memory_bytes() -> Optional[int]:
+    """الذاكرة المقيمة الحالية (RSS) للعملية"""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+gauge('ar_process_resident_memory_bytes', 'Resident memory of the web process', process_memory_bytes)
+
+
+# أزمنة المراحل للطلب الحالي (تُعاد في الحقل timings عند طلبها)
+_request_timings: ContextVar[Optional[Dict[str, float]]] = ContextVar('request_timings', default=None)
+
+
+@contextmanager
+def collect_timings():
+    """جمع أزمنة المراحل للطلب الجاري في قاموس {المرحلة: ثوانٍ}"""
+    timings: Dict[str, float] = {}
+    token = _request_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _request_timings.reset(token)
+
+
+def observe_stage(stage: str, seconds: float):
+    """تسجيل زمن مرحلة في المدرج وفي أزمنة الطلب الجاري إن وُجد"""
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+
+@contextmanager
+def stage(name: str):
+    """قياس زمن كتلة كمرحلة"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(name, time.perf_counter() - started)
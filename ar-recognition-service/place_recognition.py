@@ -6,12 +6,31 @@ Riyadh Places Recognition Service using OpenCV
 import cv2
 import numpy as np
 from pathlib import Path
-import json
 import os
 from typing import Optional, Dict, List, Tuple
 from dataclasses import dataclass
-from sklearn.neighbors import KNeighborsClassifier
+import copy
 import pickle
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import feature_extraction
+import metrics
+import tracking
+from budget import MIN_REFERENCE_ROWS, PLACE_DESCRIPTOR_BUDGET, append_quotas, strongest
+from geo_index import GeoIndex
+from quantization import ProductQuantizer
+from reference_snapshot import ReferenceSnapshot, build_indexes, capture
+from result_cache import RecognitionCache, is_missing
+from tracking import TrackingSessions
+from vocabulary import VisualVocabulary
+from reference_store import (
+    SIFT_STORE_DTYPE, WRITE_LOCK_FILE, ReferenceStore, StoreLock, keypoint_tuples_to_array
+)
+from sharding import ShardedMatcher
+from worker_pool import ExtractionPool
 
 @dataclass
 class PlaceMatch:
@@ -26,6 +45,36 @@ class PlaceMatch:
     category: str
     location: Dict
 
+@dataclass
+class RecognitionQuery:
+    """طلب تعرف واحد ضمن دفعة (قد تجمع طلبات عملاء مختلفين)"""
+    image_bytes: bytes
+    min_confidence: float = 0.3
+    location: Optional[Dict] = None
+    # موعد انتهاء الطلب حسب time.monotonic() (None بلا مهلة)
+    deadline: Optional[float] = None
+    
+    def expired(self) -> bool:
+        return self.deadline is not None and time.monotonic() >= self.deadline
+    
+    def cancel(self):
+        """إلغاء الطلب (مثلاً عند انقطاع اتصال العميل)"""
+        self.deadline = 0.0
+
+# أوضاع التعرف المدعومة
+RECOGNITION_MODES = ('sift', 'orb')
+
+# التحقق الهندسي: عدد المرشحين، الحد الأدنى للمطابقات، وعتبة خطأ الإسقاط لـ RANSAC (بالبكسل)
+VERIFY_TOP_K = int(os.environ.get('VERIFY_TOP_K', 3))
+MIN_VERIFY_MATCHES = 8
+RANSAC_REPROJ_THRESHOLD = 5.0
+
+# عدد الصور المرجعية في القائمة المختصرة لكل استعلام (تُستخدم فقط عند وجود مفردات بصرية مدربة)
+SHORTLIST_SIZE = int(os.environ.get('SHORTLIST_SIZE', 20))
+
+# فترة فحص ملفات الفهرس بحثاً عن إضافات عمال الخدمة الآخرين بالثواني (0 للتعطيل)
+STORE_POLL_SECONDS = float(os.environ.get('STORE_POLL_SECONDS', 2))
+
 # بيانات الأماكن السياحية
 PLACES_DATA = {
     "1": {
@@ -114,206 +163,793 @@ PLACES_DATA = {
 class PlaceRecognizer:
     """محرك التعرف على الأماكن باستخدام OpenCV"""
     
-    def __init__(self, reference_images_dir: str = "reference_images"):
+    def __init__(self, reference_images_dir: str = "reference_images",
+                 default_mode: Optional[str] = None):
         self.reference_images_dir = Path(reference_images_dir)
         self.reference_images_dir.mkdir(exist_ok=True)
         
-        # SIFT feature detector
-        self.sift = cv2.SIFT_create(nfeatures=500)
+        # وضع التعرف الافتراضي: sift (دقيق) أو orb (سريع)
+        self.default_mode = default_mode or os.environ.get('RECOGNITION_MODE', 'sift')
+        if self.default_mode not in RECOGNITION_MODES:
+            raise ValueError(f"وضع تعرف غير معروف: {self.default_mode}")
+        
+        # فهرس مكاني لمواقع الأماكن
+        self.geo_index = GeoIndex(PLACES_DATA)
+        
+        # الإضافات تُكتب في المخزن تحت قفل الكتابة، ثم تُنشر لقطة جديدة (الصور والوصفات
+        # وفهرس موحد لكل وضع) في الخلفية وتُستبدل بإسناد واحد؛ الاستعلامات لا تنتظر أي قفل
+        self._write_lock = threading.Lock()
+        self._publish_lock = threading.Condition()
+        self._publish_scheduled = False
+        self._written_version = 1
+        self._publisher = ThreadPoolExecutor(max_workers=1, thread_name_prefix="snapshot-publish")
+        self._snapshot: Optional[ReferenceSnapshot] = None
         
-        # FLANN matcher
-        FLANN_INDEX_KDTREE = 1
-        index_params = dict(algorithm=FLANN_INDEX_KDTREE, trees=5)
-        search_params = dict(checks=50)
-        self.flann = cv2.FlannBasedMatcher(index_params, search_params)
+        # عدد مرات مطابقة كل صف مرجعي في نتائج التعرف: {(الوضع، المكان): (الجيل، العدادات)}؛
+        # يحدد الصفوف والصور التي تبقى عند إلحاق صورة تتجاوز ميزانية المكان
+        self._row_hits: Dict[Tuple[str, str], Tuple[int, np.ndarray]] = {}
+        self._hits_lock = threading.Lock()
         
-        # ORB feature detector (faster alternative)
-        self.orb = cv2.ORB_create(nfeatures=1000)
-        self.bf = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
+        # ذاكرة مؤقتة اختيارية لنتائج التعرف (تُبطل عند إضافة صور مرجعية)
+        self.cache: Optional[RecognitionCache] = None
         
-        # مخزن الميزات المرجعية
-        self.reference_features: Dict[str, List] = {}
-        self.reference_descriptors: Dict[str, np.ndarray] = {}
+        # جلسات التتبع الاختيارية لإطارات الكاميرا المتتالية (tracking.py)
+        self.sessions: Optional[TrackingSessions] = None
+        
+        # توزيع المطابقة على shards بعيدة اختياري (sharding.py)؛ المخزن المحلي لا يُستخدم حينها
+        self.shards: Optional[ShardedMatcher] = None
+        
+        # موارد الاستخراج: مجمع عمليات اختياري، أو خيوط محلية للدفعات
+        self.extraction_pool: Optional[ExtractionPool] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
         
         # تحميل الميزات المرجعية
         self._load_reference_features()
+        self._publish_snapshot()
+    
+    @classmethod
+    def from_env(cls) -> 'PlaceRecognizer':
+        """إنشاء المحرك من REFERENCE_DIR (مجلد مختلف لكل عملية، مثل الـ shards)"""
+        return cls(os.environ.get('REFERENCE_DIR', 'reference_images'))
     
     def _load_reference_features(self):
         """تحميل ميزات الصور المرجعية"""
-        features_file = self.reference_images_dir / "features.pkl"
-        
-        if features_file.exists():
-            with open(features_file, 'rb') as f:
-                data = pickle.load(f)
-                self.reference_features = data.get('features', {})
-                self.reference_descriptors = data.get('descriptors', {})
-            print(f"تم تحميل ميزات {len(self.reference_features)} مكان")
+        # قفل مشترك طوال عمر العملية: أدوات الصيانة ترفض العمل بينما الخدمة تقرأ المخزن
+        self.store_lock = StoreLock(self.reference_images_dir, exclusive=False).acquire()
+        self.store = ReferenceStore(self.reference_images_dir / "store", dtype=SIFT_STORE_DTYPE)
+        self.orb_store = ReferenceStore(self.reference_images_dir / "store_orb", dim=32, dtype=np.uint8)
+        self.stores = {'sift': self.store, 'orb': self.orb_store}
+        
+        legacy_file = self.reference_images_dir / "features.pkl"
+        if legacy_file.exists():
+            # عمال gunicorn يبدؤون معاً: عامل واحد يرحّل والباقون يقرؤون نتيجته
+            with self._store_writer():
+                self.store.refresh()
+                if legacy_file.exists() and self.store.is_empty():
+                    self._migrate_legacy_features(legacy_file)
+        
+        # المفردات البصرية المدربة دون اتصال (vocabulary.py) إن وُجدت
+        self.vocabulary = VisualVocabulary.load(self.reference_images_dir)
+        
+        # مكمم PQ المدرب دون اتصال (quantization.py) إن وُجد: فهرس SIFT مضغوط في الذاكرة
+        self.quantizer = ProductQuantizer.load(self.reference_images_dir)
+        
+        if not self.store.is_empty():
+            print(f"تم تحميل ميزات {len(self.store.places())} مكان")
         else:
             print("لا توجد ميزات مرجعية محفوظة")
     
-    def _save_reference_features(self):
-        """حفظ ميزات الصور المرجعية"""
-        features_file = self.reference_images_dir / "features.pkl"
-        with open(features_file, 'wb') as f:
-            pickle.dump({
-                'features': self.reference_features,
-                'descriptors': self.reference_descriptors
-            }, f)
-        print(f"تم حفظ ميزات {len(self.reference_features)} مكان")
-    
-    def add_reference_image(self, place_id: str, image_path: str) -> bool:
-        """إضافة صورة مرجعية لمكان"""
+    def _migrate_legacy_features(self, legacy_file: Path):
+        """ترحيل ملف features.pkl القديم إلى المخزن المقسّم"""
+        with open(legacy_file, 'rb') as f:
+            data = pickle.load(f)
+        
+        for place_id, images in data.get('features', {}).items():
+            descriptors = data.get('descriptors', {}).get(place_id)
+            if descriptors is None:
+                continue
+            offset = 0
+            for image in images:
+                rows = len(image['keypoints'])
+                self.store.append(
+                    place_id,
+                    keypoint_tuples_to_array(image['keypoints']),
+                    descriptors[offset:offset + rows],
+                    image['image_path']
+                )
+                offset += rows
+        
+        legacy_file.rename(legacy_file.with_suffix('.pkl.migrated'))
+        print(f"تم ترحيل الميزات القديمة إلى {self.store.root}")
+    
+    def _store_writer(self, exclusive: bool = True) -> StoreLock:
+        """قفل الكتابة بين عمليات الخدمة على مجلد المراجع (ينتظر بدلاً من الفشل)"""
+        return StoreLock(self.reference_images_dir, exclusive, WRITE_LOCK_FILE, wait=True)
+    
+    def _reload_changed(self) -> bool:
+        """إعادة قراءة ملفات الفهرس والمفردات التي كتبتها عملية أخرى (تحت قفل الكتابة)"""
+        changed = False
+        for store in (self.store, self.orb_store):
+            changed = store.refresh() or changed
+        if self.vocabulary is not None and self.vocabulary.changed():
+            self.vocabulary = VisualVocabulary.load(self.reference_images_dir)
+            changed = True
+        return changed
+    
+    def refresh_from_disk(self) -> bool:
+        """نشر لقطة جديدة إذا أضاف عامل خدمة آخر صوراً مرجعية؛ يُرجع True عند التغيير"""
+        stale = self.store.changed() or self.orb_store.changed() or (
+            self.vocabulary is not None and self.vocabulary.changed()
+        )
+        if not stale:
+            return False
+        with self._write_lock, self._store_writer(exclusive=False):
+            changed = self._reload_changed()
+            if changed:
+                self._written_version += 1
+        if changed:
+            self._schedule_publish()
+        return changed
+    
+    def start_store_watch(self, interval: float = STORE_POLL_SECONDS):
+        """فحص دوري في الخلفية لإضافات العمال الآخرين (كل عامل gunicorn يملك نسخته من الفهرس)"""
+        if interval <= 0:
+            return
+        def watch():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.refresh_from_disk()
+                except Exception as e:
+                    metrics.ERRORS.inc(operation='store_watch')
+                    print(f"خطأ في فحص المخزن المرجعي: {e}")
+        threading.Thread(target=watch, name="store-watch", daemon=True).start()
+    
+    def _append_reference(self, place_id: str, features: Dict, image_path: str) -> int:
+        """إلحاق ميزات صورة مرجعية بالمخزن وجدولة نشر لقطة تتضمنها
+
+        يُرجع رقم اللقطة التي ستظهر فيها الصورة. الإلحاق يتم تحت قفل الكتابة بين العمليات
+        بعد إعادة قراءة ما كتبه العمال الآخرون، فلا تضيع إضافة متزامنة من عامل آخر.
+        """
+        with self._write_lock, self._store_writer():
+            self._reload_changed()
+            (keypoints, descriptors), stale = self._fit_budget('sift', place_id, features['sift'])
+            record = self.store.append(place_id, keypoints, descriptors, image_path)
+            if self.vocabulary is not None:
+                if stale:
+                    # إعادة الكتابة غيّرت مقاطع جميع صور المكان في المخزن
+                    block = self.store.load_descriptors(place_id)
+                    self.vocabulary.replace_place(place_id, [
+                        (place_id, image['offset'], image['rows'],
+                         block[image['offset']:image['offset'] + image['rows']])
+                        for image in self.store.images(place_id)
+                    ])
+                else:
+                    self.vocabulary.add_image(place_id, record['offset'], record['rows'], descriptors)
+            
+            orb_features = features.get('orb')
+            if orb_features is not None and len(orb_features[1]) >= MIN_REFERENCE_ROWS:
+                orb_features, orb_stale = self._fit_budget('orb', place_id, orb_features)
+                self.orb_store.append(place_id, orb_features[0], orb_features[1], image_path)
+                stale += orb_stale
+            
+            # الجيل السابق يبقى مفتوحاً في اللقطات المنشورة، والعمال الآخرون يعيدون قراءة
+            # ملف الفهرس تحت قفل الكتابة قبل فتح أي كتلة
+            for path in stale:
+                path.unlink()
+            
+            self._written_version += 1
+            version = self._written_version
+        
+        self._schedule_publish()
+        return version
+    
+    def _fit_budget(self, mode: str, place_id: str, features: Tuple) -> Tuple[Tuple, List[Path]]:
+        """إبقاء المكان ضمن PLACE_DESCRIPTOR_BUDGET عند إلحاق صورة جديدة
+
+        إذا تجاوز المجموع الميزانية تُوزع حصص متساوية على صور المكان والصورة الجديدة، وتحتفظ
+        كل صورة قديمة بأكثر صفوفها مطابقة في نتائج التعرف ثم أقواها استجابة، وتُحذف الصور الأقل
+        مطابقة إذا لم تتسع الميزانية لها. يُرجع (ميزات الصورة الجديدة ضمن حصتها، ملفات الجيل
+        السابق لحذفها بعد نشر ملف الفهرس)؛ الضغط الكامل حسب التميز يبقى لـ compact.py.
+        """
+        store = self.stores[mode]
+        images = store.images(place_id)
+        sizes = np.array([image['rows'] for image in images] + [len(features[1])], dtype=np.int64)
+        if not PLACE_DESCRIPTOR_BUDGET or sizes.sum() <= PLACE_DESCRIPTOR_BUDGET:
+            return features, []
+        
+        hits = self._place_hits(mode, place_id)
+        image_hits = np.array([hits[image['offset']:image['offset'] + image['rows']].sum() for image in images])
+        quotas = append_quotas(sizes, image_hits, PLACE_DESCRIPTOR_BUDGET)
+        features = strongest(features, int(quotas[-1]))
+        if np.array_equal(quotas[:-1], sizes[:-1]):
+            return features, []
+        
+        response = store.load_keypoints(place_id)['response']
+        keep = {}
+        for i, (image, quota) in enumerate(zip(images, quotas[:-1])):
+            if quota == 0:
+                continue
+            rows = slice(image['offset'], image['offset'] + image['rows'])
+            keep[i] = np.sort(np.lexsort((-response[rows], -hits[rows]))[:quota])
+        stale = store.rewrite_place(place_id, keep)
+        
+        # العدادات تتبع الصفوف المحتفظ بها إلى الجيل الجديد
+        generation = store.manifest['places'][place_id]['generation']
+        kept = [hits[images[i]['offset'] + rows] for i, rows in sorted(keep.items())]
+        with self._hits_lock:
+            self._row_hits[(mode, place_id)] = (
+                generation, np.concatenate(kept) if kept else np.zeros(0, dtype=np.int64)
+            )
+        return features, stale
+    
+    def _place_hits(self, mode: str, place_id: str) -> np.ndarray:
+        """عدادات المطابقة لصفوف المكان في جيله الحالي بالمخزن (أصفار لما لم يُطابق)"""
+        place = self.stores[mode].manifest['places'][place_id]
+        hits = np.zeros(place['rows'], dtype=np.int64)
+        with self._hits_lock:
+            recorded = self._row_hits.get((mode, place_id))
+        if recorded is not None and recorded[0] == place.get('generation', 0):
+            counts = recorded[1][:len(hits)]
+            hits[:len(counts)] = counts
+        return hits
+    
+    def _record_hits(self, snapshot: ReferenceSnapshot, mode: str, place_id: str, rows: np.ndarray):
+        """زيادة عدادات الصفوف المرجعية المتوافقة في نتيجة تعرف مقبولة"""
+        if not PLACE_DESCRIPTOR_BUDGET or len(rows) == 0:
+            return
+        generation = snapshot.generations[mode].get(place_id, 0)
+        with self._hits_lock:
+            recorded = self._row_hits.get((mode, place_id))
+            counts = recorded[1] if recorded is not None and recorded[0] == generation else np.zeros(0, dtype=np.int64)
+            size = int(rows.max()) + 1
+            if len(counts) < size:
+                counts = np.concatenate([counts, np.zeros(size - len(counts), dtype=np.int64)])
+            np.add.at(counts, rows, 1)
+            self._row_hits[(mode, place_id)] = (generation, counts)
+    
+    @property
+    def snapshot(self) -> ReferenceSnapshot:
+        """اللقطة المنشورة حالياً (تُقرأ مرة واحدة في بداية كل طلب)"""
+        return self._snapshot
+    
+    def snapshot_version(self, snapshot: Optional[ReferenceSnapshot] = None) -> int:
+        """رقم اللقطة في الردود؛ في وضع المنسق مجموع آخر أرقام لقطات الـ shards"""
+        if self.shards is not None:
+            return self.shards.version
+        return (snapshot or self.snapshot).version
+    
+    def _schedule_publish(self):
+        """جدولة بناء لقطة جديدة؛ الإضافات المتتالية تُدمج في بناء واحد"""
+        with self._publish_lock:
+            if self._publish_scheduled:
+                return
+            self._publish_scheduled = True
+        self._publisher.submit(self._publish_in_background)
+    
+    def _publish_in_background(self):
         try:
-            img = cv2.imread(image_path)
-            if img is None:
+            self._publish_snapshot()
+        except Exception as e:
+            metrics.ERRORS.inc(operation='publish_snapshot')
+            print(f"خطأ في بناء اللقطة المرجعية: {e}")
+    
+    def _publish_snapshot(self):
+        """بناء لقطة من حالة المخزن الحالية ونشرها باستبدال ذري"""
+        with self._publish_lock:
+            self._publish_scheduled = False
+        
+        # إلحاق يتجاوز الميزانية في عامل آخر يحذف ملفات الجيل السابق، فتُفتح الكتل من
+        # ملف الفهرس الحالي تحت قفل الكتابة المشترك
+        with self._write_lock, self._store_writer(exclusive=False):
+            self._reload_changed()
+            version = self._written_version
+            state = capture(self.stores, self._snapshot)
+            vocabulary = copy.copy(self.vocabulary)
+        
+        # بناء الفهارس خارج القفل: الاستعلامات تستمر على اللقطة السابقة
+        snapshot = ReferenceSnapshot(
+            version=version,
+            images=state['images'],
+            descriptors=state['descriptors'],
+            indexes=build_indexes(state['descriptors'], self.quantizer),
+            vocabulary=vocabulary,
+            keypoint_blocks=state['keypoint_blocks'],
+            generations=state['generations']
+        )
+        
+        with self._publish_lock:
+            self._snapshot = snapshot
+            self._publish_lock.notify_all()
+        if self.cache is not None:
+            self.cache.clear()
+        
+        sift_index = snapshot.indexes['sift']
+        if not sift_index.is_empty():
+            print(f"تم نشر اللقطة {version}: {int(sift_index.place_sizes.sum())} وصف لـ {len(sift_index.place_ids)} مكان")
+    
+    def wait_for_snapshot(self, version: int, timeout: Optional[float] = None) -> bool:
+        """انتظار نشر لقطة لا يقل رقمها عن version"""
+        with self._publish_lock:
+            return self._publish_lock.wait_for(lambda: self._snapshot.version >= version, timeout)
+    
+    def get_reference_keypoints(self, place_id: str, image_index: Optional[int] = None,
+                                mode: str = 'sift') -> Optional[np.ndarray]:
+        """النقاط المميزة لمكان (أو لصورة واحدة منه) بتحميل كسول"""
+        snapshot = self.snapshot
+        keypoints = snapshot.keypoints(mode, place_id)
+        if keypoints is None or image_index is None:
+            return keypoints
+        image = snapshot.place_images(mode, place_id)[image_index]
+        return keypoints[image['offset']:image['offset'] + image['rows']]
+    
+    def add_reference_image(self, place_id: str, image_path: str) -> Optional[int]:
+        """إضافة صورة مرجعية لمكان
+
+        يُرجع رقم اللقطة التي ستتضمن الصورة (تُنشر في الخلفية، انظر wait_for_snapshot)
+        أو None عند الفشل.
+        """
+        try:
+            try:
+                image_bytes = Path(image_path).read_bytes()
+            except OSError:
                 print(f"فشل في قراءة الصورة: {image_path}")
-                return False
-            
-            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+                return None
             
-            # استخراج الميزات باستخدام SIFT
-            keypoints, descriptors = self.sift.detectAndCompute(gray, None)
+            # استخراج الميزات باستخدام SIFT و ORB
+            features = self._run_extraction(feature_extraction.extract_reference_features, image_bytes)
+            if features is None:
+                print(f"فشل في قراءة الصورة: {image_path}")
+                return None
             
-            if descriptors is None or len(descriptors) < 10:
+            if features['sift'] is None or len(features['sift'][1]) < MIN_REFERENCE_ROWS:
                 print(f"لم يتم العثور على ميزات كافية في: {image_path}")
-                return False
+                return None
             
             # حفظ الميزات
-            if place_id not in self.reference_features:
-                self.reference_features[place_id] = []
-                self.reference_descriptors[place_id] = None
-            
-            self.reference_features[place_id].append({
-                'keypoints': [(kp.pt, kp.size, kp.angle, kp.response, kp.octave) for kp in keypoints],
-                'image_path': image_path
-            })
-            
-            # دمج الوصفات
-            if self.reference_descriptors[place_id] is None:
-                self.reference_descriptors[place_id] = descriptors
-            else:
-                self.reference_descriptors[place_id] = np.vstack([
-                    self.reference_descriptors[place_id], 
-                    descriptors
-                ])
-            
-            self._save_reference_features()
+            version = self._append_reference(place_id, features, image_path)
             print(f"تم إضافة صورة مرجعية للمكان {place_id}")
-            return True
+            return version
             
         except Exception as e:
+            metrics.ERRORS.inc(operation='add_reference')
             print(f"خطأ في إضافة الصورة المرجعية: {e}")
-            return False
+            return None
     
-    def add_reference_image_from_bytes(self, place_id: str, image_bytes: bytes) -> bool:
-        """إضافة صورة مرجعية من بايتات"""
+    def add_reference_image_from_bytes(self, place_id: str, image_bytes: bytes) -> Optional[int]:
+        """إضافة صورة مرجعية من بايتات (يُرجع رقم اللقطة التي ستتضمنها أو None)"""
         try:
-            # تحويل البايتات إلى صورة
-            nparr = np.frombuffer(image_bytes, np.uint8)
-            img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-            
-            if img is None:
-                return False
-            
-            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-            keypoints, descriptors = self.sift.detectAndCompute(gray, None)
-            
-            if descriptors is None or len(descriptors) < 10:
-                return False
-            
-            if place_id not in self.reference_features:
-                self.reference_features[place_id] = []
-                self.reference_descriptors[place_id] = None
-            
-            self.reference_features[place_id].append({
-                'keypoints': [(kp.pt, kp.size, kp.angle, kp.response, kp.octave) for kp in keypoints],
-                'image_path': 'uploaded'
-            })
+            features = self._run_extraction(feature_extraction.extract_reference_features, image_bytes)
+            if features is None:
+                return None
             
-            if self.reference_descriptors[place_id] is None:
-                self.reference_descriptors[place_id] = descriptors
-            else:
-                self.reference_descriptors[place_id] = np.vstack([
-                    self.reference_descriptors[place_id], 
-                    descriptors
-                ])
+            if features['sift'] is None or len(features['sift'][1]) < MIN_REFERENCE_ROWS:
+                return None
             
-            self._save_reference_features()
-            return True
+            return self._append_reference(place_id, features, 'uploaded')
             
         except Exception as e:
+            metrics.ERRORS.inc(operation='add_reference')
             print(f"خطأ: {e}")
-            return False
+            return None
     
-    def recognize(self, image_bytes: bytes, min_confidence: float = 0.3) -> Optional[PlaceMatch]:
-        """التعرف على المكان من صورة"""
-        try:
-            # تحويل البايتات إلى صورة
-            nparr = np.frombuffer(image_bytes, np.uint8)
-            img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-            
-            if img is None:
-                return None
+    def _run_extraction(self, fn, *args):
+        """تشغيل دالة استخراج في مجمع العمليات إن وُجد، وإلا في الخيط الحالي"""
+        if self.extraction_pool is not None:
+            return self.extraction_pool.run(fn, *args)
+        return fn(*args)
+    
+    def _map_extraction(self, fn, items: List) -> List:
+        """تشغيل دالة استخراج على عدة عناصر بالتوازي"""
+        if self.extraction_pool is not None:
+            return self.extraction_pool.map(fn, items)
+        if len(items) == 1:
+            return [fn(items[0])]
+        return list(self._batch_executor().map(fn, items))
+    
+    def _resolve_mode(self, mode: Optional[str]) -> str:
+        mode = mode or self.default_mode
+        if mode not in RECOGNITION_MODES:
+            raise ValueError(f"وضع تعرف غير معروف: {mode}")
+        return mode
+    
+    @staticmethod
+    def _query_features(features) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        if features is None or len(features[1]) < 5:
+            return None
+        return features
+    
+    def _match_queries(self, snapshot: ReferenceSnapshot,
+                       query_features: List[Optional[Tuple[np.ndarray, np.ndarray]]],
+                       min_confidence: float, mode: str,
+                       location: Optional[Dict] = None,
+                       anchors: Optional[List[Optional[np.ndarray]]] = None) -> List[Optional[PlaceMatch]]:
+        """مطابقة صور الاستعلام مع الأماكن القريبة أولاً ثم توسيع النطاق عند الحاجة"""
+        if self.shards is not None:
+            return self._match_shards(query_features, min_confidence, mode, location, anchors)
+        
+        results: List[Optional[PlaceMatch]] = [None] * len(query_features)
+        if snapshot.indexes[mode].is_empty():
+            return results
+        
+        pending = [i for i, f in enumerate(query_features) if f is not None]
+        for candidates in self.geo_index.candidate_sets(location):
+            if not pending:
+                break
+            pending_anchors = [None] * len(pending) if anchors is not None else None
+            matched = self._match_candidates(
+                snapshot, [query_features[i] for i in pending], min_confidence, mode, candidates,
+                pending_anchors
+            )
+            for j, (i, match) in enumerate(zip(pending, matched)):
+                results[i] = match
+                if pending_anchors is not None:
+                    anchors[i] = pending_anchors[j]
+            pending = [i for i in pending if results[i] is None]
+        
+        return results
+    
+    def _match_shards(self, query_features: List[Optional[Tuple[np.ndarray, np.ndarray]]],
+                      min_confidence: float, mode: str, location: Optional[Dict] = None,
+                      anchors: Optional[List[Optional[np.ndarray]]] = None) -> List[Optional[PlaceMatch]]:
+        """مطابقة الاستعلامات عبر الـ shards واختيار أعلى ثقة لكل استعلام"""
+        with metrics.stage('scatter'):
+            candidates = self.shards.match(query_features, min_confidence, mode, location,
+                                           with_anchors=anchors is not None)
+        results: List[Optional[PlaceMatch]] = [None] * len(query_features)
+        for i, candidate in enumerate(candidates):
+            if candidate is None:
+                continue
+            results[i] = self._make_match(candidate['placeId'], candidate['confidence'],
+                                          candidate['matchedFeatures'])
+            if anchors is not None and results[i] is not None:
+                anchors[i] = np.asarray(candidate['anchors'], dtype=np.float32).reshape(-1, 4)
+        return results
+    
+    def match_features(self, query_features: List[Optional[Tuple[np.ndarray, np.ndarray]]],
+                       min_confidence: float = 0.3, mode: Optional[str] = None,
+                       location: Optional[Dict] = None, with_anchors: bool = False,
+                       snapshot: Optional[ReferenceSnapshot] = None) -> Tuple[List[Optional[Dict]], int]:
+        """مطابقة ميزات مستخرجة مسبقاً مع المخزن المحلي (جهة الـ shard من /shard/match)
+
+        يُرجع (لكل استعلام {placeId, confidence, matchedFeatures[, anchors]} أو None، رقم اللقطة).
+        """
+        mode = self._resolve_mode(mode)
+        snapshot = snapshot or self.snapshot
+        query_features = [self._query_features(features) for features in query_features]
+        anchors = [None] * len(query_features) if with_anchors else None
+        with metrics.stage('shard_match'):
+            matched = self._match_queries(snapshot, query_features, min_confidence, mode, location, anchors)
+        
+        results = []
+        for i, match in enumerate(matched):
+            if match is None:
+                results.append(None)
+                continue
+            result = {
+                'placeId': match.place_id,
+                'confidence': match.confidence,
+                'matchedFeatures': match.matched_features
+            }
+            if anchors is not None:
+                result['anchors'] = np.round(anchors[i], 2).tolist()
+            results.append(result)
+        return results, snapshot.version
+    
+    def _match_candidates(self, snapshot: ReferenceSnapshot,
+                          query_features: List[Tuple[np.ndarray, np.ndarray]],
+                          min_confidence: float, mode: str,
+                          candidates: Optional[List],
+                          anchors: Optional[List[Optional[np.ndarray]]] = None) -> List[Optional[PlaceMatch]]:
+        """مطابقة على مرحلتين: تصويت رخيص بالوصفات ثم تحقق هندسي لأفضل المرشحين"""
+        results: List[Optional[PlaceMatch]] = [None] * len(query_features)
+        index = snapshot.indexes[mode]
+        vocabulary = snapshot.vocabulary
+        
+        # المرحلة 0: قائمة مختصرة من الصور المرجعية بالكلمات البصرية لكل استعلام (للكتالوجات الكبيرة)
+        shortlists = None
+        if mode == 'sift' and vocabulary is not None and len(vocabulary.images) > SHORTLIST_SIZE:
+            with metrics.stage('shortlist'):
+                shortlists = [
+                    vocabulary.shortlist(query_descriptors, SHORTLIST_SIZE, candidates) or candidates
+                    for _, query_descriptors in query_features
+                ]
+        
+        # المرحلة 1: التصويت حسب الصورة والمكان في استدعاء knn واحد
+        with metrics.stage('vote'):
+            votes, _, good_matches = index.vote([f[1] for f in query_features], candidates, shortlists)
+        
+        # المرحلة 2: التحقق الهندسي لكل صورة على أفضل المرشحين فقط
+        with metrics.stage('verify'):
+            self._verify_queries(snapshot, query_features, votes, good_matches, min_confidence, mode,
+                                 results, anchors)
+        return results
+    
+    def _verify_queries(self, snapshot: ReferenceSnapshot,
+                        query_features: List[Tuple[np.ndarray, np.ndarray]],
+                        votes: np.ndarray, good_matches: np.ndarray, min_confidence: float,
+                        mode: str, results: List[Optional[PlaceMatch]],
+                        anchors: Optional[List[Optional[np.ndarray]]] = None):
+        """التحقق الهندسي لأفضل المرشحين لكل صورة وتعبئة results
+
+        anchors (اختياري): تُعبأ بالنقاط المتوافقة لكل نتيجة (لبدء التتبع).
+        """
+        index = snapshot.indexes[mode]
+        for i, (query_keypoints, query_descriptors) in enumerate(query_features):
+            ranked = [int(label) for label in np.argsort(-votes[i], kind='stable')[:VERIFY_TOP_K]
+                      if votes[i, label] >= MIN_VERIFY_MATCHES]
+            if not ranked:
+                continue
             
-            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+            query_matches = good_matches[good_matches[:, 0] == i]
+            best = None
+            for rank, label in enumerate(ranked):
+                place_id = index.place_ids[label]
+                place_matches = query_matches[query_matches[:, 2] == label]
+                verified = self._verify_place(snapshot, mode, place_id, query_keypoints, place_matches)
+                
+                if verified is not None and (best is None or verified[0] > best[1]):
+                    best = (place_id, *verified)
+                
+                # توقف مبكر: عدد النقاط المتوافقة لا يتجاوز عدد الأصوات، فلا يمكن لمرشح تالٍ أن يتفوق
+                if best is not None and rank + 1 < len(ranked) and best[1] >= votes[i, ranked[rank + 1]]:
+                    break
             
-            # استخراج الميزات
-            keypoints, descriptors = self.sift.detectAndCompute(gray, None)
+            if best is None:
+                continue
             
-            if descriptors is None or len(descriptors) < 5:
-                return None
+            place_id, inliers, reference_rows, inlier_points, inlier_rows = best
+            confidence = min(inliers / min(len(query_descriptors), reference_rows) * 2, 1.0)  # تطبيع
+            if confidence >= min_confidence:
+                results[i] = self._make_match(place_id, confidence, inliers)
+                self._record_hits(snapshot, mode, place_id, inlier_rows)
+                if anchors is not None:
+                    anchors[i] = inlier_points
+    
+    def _verify_place(self, snapshot: ReferenceSnapshot, mode: str, place_id: str,
+                      query_keypoints: np.ndarray,
+                      place_matches: np.ndarray) -> Optional[Tuple[int, int, np.ndarray, np.ndarray]]:
+        """تحقق RANSAC بالتماثل (homography) مع الصورة المرجعية الأكثر مطابقة للمكان
+
+        يُرجع (عدد النقاط المتوافقة، عدد وصفات الصورة المرجعية، النقاط المتوافقة (N, 4)
+        بصيغة [x الاستعلام، y الاستعلام، x المرجع، y المرجع]، صفوفها في كتلة المكان) أو None.
+        """
+        images = snapshot.place_images(mode, place_id)
+        if not images or len(place_matches) < MIN_VERIFY_MATCHES:
+            return None
+        
+        # تجميع المطابقات حسب الصورة المرجعية واختيار أكثرها مطابقة
+        offsets = np.array([image['offset'] for image in images], dtype=np.int64)
+        image_of = np.searchsorted(offsets, place_matches[:, 3], side='right') - 1
+        image_index = int(np.argmax(np.bincount(image_of, minlength=len(images))))
+        image_matches = place_matches[image_of == image_index]
+        if len(image_matches) < MIN_VERIFY_MATCHES:
+            return None
+        
+        reference_keypoints = snapshot.keypoints(mode, place_id)
+        src = np.column_stack([
+            query_keypoints['x'][image_matches[:, 1]],
+            query_keypoints['y'][image_matches[:, 1]]
+        ]).astype(np.float32)
+        dst = np.column_stack([
+            reference_keypoints['x'][image_matches[:, 3]],
+            reference_keypoints['y'][image_matches[:, 3]]
+        ]).astype(np.float32)
+        
+        homography, mask = cv2.findHomography(src, dst, cv2.RANSAC, RANSAC_REPROJ_THRESHOLD)
+        if homography is None or mask is None:
+            return None
+        inliers = mask.ravel().astype(bool)
+        return (int(inliers.sum()), int(images[image_index]['rows']), np.hstack([src[inliers], dst[inliers]]),
+                image_matches[inliers, 3])
+    
+    def _make_match(self, place_id: str, confidence: float, matched_features: int) -> Optional[PlaceMatch]:
+        """بناء نتيجة المطابقة من بيانات المكان"""
+        if place_id not in PLACES_DATA:
+            return None
+        place_data = PLACES_DATA[place_id]
+        return PlaceMatch(
+            place_id=place_id,
+            place_name=place_data["name"],
+            place_name_ar=place_data["name_ar"],
+            confidence=confidence,
+            matched_features=matched_features,
+            description=place_data["description"],
+            description_ar=place_data["description_ar"],
+            category=place_data["category"],
+            location=place_data["location"]
+        )
+    
+    def recognize(self, image_bytes: bytes, min_confidence: float = 0.3,
+                  mode: Optional[str] = None, location: Optional[Dict] = None,
+                  snapshot: Optional[ReferenceSnapshot] = None) -> Optional[PlaceMatch]:
+        """التعرف على المكان من صورة
+
+        location (اختياري): {"lat", "lng", "accuracy"} لمطابقة الأماكن القريبة أولاً.
+        snapshot (اختياري): اللقطة المرجعية المستخدمة (الافتراضي: المنشورة حالياً).
+        """
+        return self.recognize_batch([image_bytes], min_confidence, mode, location, snapshot)[0]
+    
+    def recognize_batch(self, images: List[bytes], min_confidence: float = 0.3,
+                        mode: Optional[str] = None,
+                        location: Optional[Dict] = None,
+                        snapshot: Optional[ReferenceSnapshot] = None) -> List[Optional[PlaceMatch]]:
+        """التعرف على عدة صور: استخراج متوازٍ ثم مطابقة مجمعة"""
+        return self.recognize_queries(
+            [RecognitionQuery(image_bytes, min_confidence, location) for image_bytes in images],
+            mode, snapshot
+        )
+    
+    def recognize_queries(self, queries: List[RecognitionQuery], mode: Optional[str] = None,
+                          snapshot: Optional[ReferenceSnapshot] = None) -> List[Optional[PlaceMatch]]:
+        """التعرف على طلبات مستقلة (لكل منها ثقته وموقعه ومهلته) في دفعة واحدة
+
+        الاستخراج يتم لكل الطلبات معاً، ثم تُطابق الطلبات المتشابهة في المعاملات باستدعاء واحد.
+        الطلبات التي انتهت مهلتها (أو أُلغيت) قبل الاستخراج أو المطابقة تُتخطى وتُرجع None،
+        وكذلك الصور التي تعذر فك ترميزها. أعطال البنية (مهلة المجمع وانهياره وغيرها) تُرفع
+        للمسار ليرد بـ 503 أو 500 بدلاً من "لم يتم التعرف".
+        """
+        mode = self._resolve_mode(mode)
+        snapshot = snapshot or self.snapshot
+        if not queries:
+            return []
+        try:
+            results: List[Optional[PlaceMatch]] = [None] * len(queries)
+            expired = {i for i, query in enumerate(queries) if query.expired()}
             
-            best_match = None
-            best_score = 0
-            best_matches_count = 0
+            # الصور شبه المتطابقة (نفس البصمة الإدراكية) تُخدم من الذاكرة المؤقتة
+            keys = [None] * len(queries)
+            pending = [i for i in range(len(queries)) if i not in expired]
+            if self.cache is not None:
+                with metrics.stage('cache_lookup'):
+                    misses = []
+                    for i in pending:
+                        query = queries[i]
+                        keys[i] = self._cache_key(query.image_bytes, query.min_confidence, mode,
+                                                  query.location, self.snapshot_version(snapshot))
+                        cached = self.cache.get(keys[i]) if keys[i] is not None else None
+                        if keys[i] is None or is_missing(cached):
+                            misses.append(i)
+                        else:
+                            results[i] = cached
+                    pending = misses
             
-            # مقارنة مع جميع الأماكن المرجعية
-            for place_id, ref_descriptors in self.reference_descriptors.items():
-                if ref_descriptors is None or len(ref_descriptors) < 10:
-                    continue
+            if pending:
+                extracted = self._extract_queries([queries[i].image_bytes for i in pending], mode)
+                query_features = dict(zip(pending, extracted))
                 
-                try:
-                    # مطابقة الميزات باستخدام FLANN
-                    matches = self.flann.knnMatch(descriptors, ref_descriptors, k=2)
-                    
-                    # تطبيق اختبار النسبة (Lowe's ratio test)
-                    good_matches = []
-                    for m, n in matches:
-                        if m.distance < 0.7 * n.distance:
-                            good_matches.append(m)
-                    
-                    # حساب درجة الثقة
-                    if len(good_matches) > 0:
-                        confidence = len(good_matches) / min(len(descriptors), len(ref_descriptors))
-                        confidence = min(confidence * 2, 1.0)  # تطبيع
-                        
-                        if confidence > best_score and confidence >= min_confidence:
-                            best_score = confidence
-                            best_match = place_id
-                            best_matches_count = len(good_matches)
-                            
-                except Exception as e:
-                    continue
+                # تجميع الطلبات حسب (الثقة، الموقع) لأن مرشحي المطابقة يعتمدون عليهما
+                groups: Dict[Tuple, List[int]] = {}
+                for i in pending:
+                    query = queries[i]
+                    if query.expired():
+                        expired.add(i)
+                        continue
+                    location_key = tuple(sorted(query.location.items())) if query.location else None
+                    groups.setdefault((query.min_confidence, location_key), []).append(i)
+                
+                for group in groups.values():
+                    first = queries[group[0]]
+                    matched = self._match_queries(
+                        snapshot, [query_features[i] for i in group],
+                        first.min_confidence, mode, first.location
+                    )
+                    for i, match in zip(group, matched):
+                        results[i] = match
+                        if self.cache is not None and keys[i] is not None:
+                            self.cache.put(keys[i], match)
             
-            if best_match and best_match in PLACES_DATA:
-                place_data = PLACES_DATA[best_match]
-                return PlaceMatch(
-                    place_id=best_match,
-                    place_name=place_data["name"],
-                    place_name_ar=place_data["name_ar"],
-                    confidence=best_score,
-                    matched_features=best_matches_count,
-                    description=place_data["description"],
-                    description_ar=place_data["description_ar"],
-                    category=place_data["category"],
-                    location=place_data["location"]
-                )
+            recognized = sum(result is not None for result in results)
+            metrics.RECOGNITIONS.inc(recognized, mode=mode, outcome='recognized')
+            metrics.RECOGNITIONS.inc(len(results) - recognized - len(expired), mode=mode, outcome='unrecognized')
+            metrics.RECOGNITIONS.inc(len(expired), mode=mode, outcome='expired')
+            return results
             
-            return None
+        except Exception as e:
+            metrics.ERRORS.inc(operation='recognize')
+            metrics.RECOGNITIONS.inc(len(queries), mode=mode, outcome='error')
+            print(f"خطأ في التعرف: {e}")
+            raise
+    
+    def _extract_queries(self, images: List[bytes], mode: str) -> List[Optional[Tuple[np.ndarray, np.ndarray]]]:
+        """استخراج ميزات صور الاستعلام بالتوازي مع تسجيل أزمنة المراحل"""
+        # زمن الاستخراج الكلي (مع الانتظار والنقل بين العمليات) ثم مراحله داخل العامل
+        extract = partial(feature_extraction.extract_features_timed, mode=mode)
+        with metrics.stage('extraction'):
+            extracted = self._map_extraction(extract, images)
+        for _, stage_timings in extracted:
+            for stage, seconds in stage_timings.items():
+                metrics.observe_stage(stage, seconds)
+        return [self._query_features(features) for features, _ in extracted]
+    
+    def warm_up(self):
+        """استعلام اصطناعي لكل وضع قبل أول طلب حقيقي
+
+        يبدأ عمليات الاستخراج (مع تحميل OpenCV وإنشاء الكواشف فيها) ويقرأ صفحات المخزن التي
+        تلمسها المطابقة، دون المرور بالذاكرة المؤقتة أو عدادات التعرف. مع الـ shards تُهيأ
+        عمليات الاستخراج فقط.
+        """
+        rng = np.random.default_rng(0)
+        noise = cv2.GaussianBlur(rng.integers(0, 256, (480, 640), dtype=np.uint8), (5, 5), 0)
+        image = cv2.imencode('.jpg', noise)[1].tobytes()
+        workers = self.extraction_pool.workers if self.extraction_pool is not None else 1
+        snapshot = self.snapshot
+        for mode in RECOGNITION_MODES:
+            started = time.perf_counter()
+            extract = partial(feature_extraction.extract_features, mode=mode)
+            features = [self._query_features(f) for f in self._map_extraction(extract, [image] * workers)]
+            if self.shards is None:
+                self._match_queries(snapshot, features[:1], 1.0, mode)
+            print(f"تمت تهيئة وضع {mode} في {(time.perf_counter() - started) * 1000:.0f} ms")
+
+    def recognize_tracked(self, session_id: str, image_bytes: bytes, min_confidence: float = 0.3,
+                          mode: Optional[str] = None, location: Optional[Dict] = None,
+                          snapshot: Optional[ReferenceSnapshot] = None) -> Tuple[Optional[PlaceMatch], str]:
+        """التعرف على إطار ضمن جلسة كاميرا مستمرة
+
+        بعد تعرف واثق تُتتبع نقاط المكان في الإطارات التالية بالتدفق البصري (tracking.py)،
+        ويعود التعرف الكامل عند فقد التتبع أو انخفاض الثقة أو كل TRACKING_KEYFRAME_INTERVAL إطار.
+        يُرجع (النتيجة، "tracked" أو "keyframe").
+        """
+        mode = self._resolve_mode(mode)
+        snapshot = snapshot or self.snapshot
+        if self.sessions is None:
+            return self.recognize(image_bytes, min_confidence, mode, location, snapshot), 'keyframe'
+        
+        try:
+            state = self.sessions.get(session_id)
+            gray = None
+            if state is not None and state.mode == mode and not state.needs_keyframe():
+                with metrics.stage('track'):
+                    gray = tracking.decode_frame(image_bytes)
+                    tracked = tracking.track(state, gray)
+                if tracked is not None and tracked.confidence >= min_confidence:
+                    self.sessions.put(session_id, tracked)
+                    metrics.RECOGNITIONS.inc(mode=mode, outcome='tracked')
+                    return self._make_match(tracked.place_id, tracked.confidence, len(tracked.points)), 'tracked'
+            
+            # إطار مفتاحي: تعرف كامل (دون الذاكرة المؤقتة لأن النقاط تخص هذا الإطار بالذات)
+            query_features = self._extract_queries([image_bytes], mode)
+            anchors = [None]
+            match = self._match_queries(snapshot, query_features, min_confidence, mode, location, anchors)[0]
+            metrics.RECOGNITIONS.inc(mode=mode, outcome='recognized' if match else 'unrecognized')
+            
+            state = None
+            if match is not None:
+                if gray is None:
+                    gray = tracking.decode_frame(image_bytes)
+                state = tracking.seed(match.place_id, mode, match.confidence, gray, anchors[0], image_bytes)
+            if state is not None:
+                self.sessions.put(session_id, state, keyframe=True)
+            else:
+                self.sessions.drop(session_id)
+            return match, 'keyframe'
             
         except Exception as e:
+            metrics.ERRORS.inc(operation='recognize')
+            metrics.RECOGNITIONS.inc(mode=mode, outcome='error')
+            self.sessions.drop(session_id)
             print(f"خطأ في التعرف: {e}")
+            raise
+    
+    @staticmethod
+    def _cache_key(image_bytes: bytes, min_confidence: float, mode: str,
+                   location: Optional[Dict], version: int) -> Optional[Tuple]:
+        """مفتاح الذاكرة المؤقتة: البصمة الإدراكية مع معاملات الطلب (الموقع مقرب لـ ~100م) ورقم اللقطة"""
+        image_hash = feature_extraction.dhash(image_bytes)
+        if image_hash is None:
             return None
+        location_key = (round(location['lat'], 3), round(location['lng'], 3)) if location else None
+        return image_hash, round(float(min_confidence), 3), mode, location_key, version
+    
+    def _batch_executor(self) -> ThreadPoolExecutor:
+        """مجمع خيوط الاستخراج (OpenCV يحرر GIL أثناء المعالجة)"""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=os.cpu_count() or 1,
+                thread_name_prefix="feature-extract"
+            )
+        return self._executor
     
     def recognize_with_color_histogram(self, image_bytes: bytes) -> Optional[PlaceMatch]:
         """التعرف باستخدام مخطط الألوان (طريقة بديلة)"""
@@ -341,60 +977,66 @@ class PlaceRecognizer:
     def detect_landmarks(self, image_bytes: bytes) -> List[Dict]:
         """اكتشاف المعالم في الصورة"""
         try:
-            nparr = np.frombuffer(image_bytes, np.uint8)
-            img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-            
-            if img is None:
-                return []
-            
-            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-            
-            # اكتشاف الزوايا باستخدام Harris
-            corners = cv2.cornerHarris(gray, 2, 3, 0.04)
-            corners = cv2.dilate(corners, None)
-            
-            # اكتشاف الحواف باستخدام Canny
-            edges = cv2.Canny(gray, 50, 150)
-            
-            # اكتشاف الخطوط باستخدام Hough
-            lines = cv2.HoughLinesP(edges, 1, np.pi/180, 50, minLineLength=50, maxLineGap=10)
-            
-            landmarks = []
-            
-            # إضافة معلومات عن الميزات المكتشفة
-            if corners is not None:
-                landmarks.append({
-                    "type": "corners",
-                    "count": np.sum(corners > 0.01 * corners.max())
-                })
-            
-            if lines is not None:
-                landmarks.append({
-                    "type": "lines",
-                    "count": len(lines)
-                })
-            
-            return landmarks
+            with metrics.stage('detect_landmarks'):
+                return self._run_extraction(feature_extraction.detect_landmarks, image_bytes)
             
         except Exception as e:
+            metrics.ERRORS.inc(operation='detect_landmarks')
             print(f"خطأ: {e}")
             return []
     
+    def detect_landmarks_batch(self, images: List[bytes]) -> List[List[Dict]]:
+        """اكتشاف المعالم في عدة صور بالتوازي"""
+        try:
+            with metrics.stage('detect_landmarks'):
+                return self._map_extraction(feature_extraction.detect_landmarks, images)
+            
+        except Exception as e:
+            metrics.ERRORS.inc(operation='detect_landmarks')
+            print(f"خطأ: {e}")
+            return [[] for _ in images]
+    
+    def reference_summary(self, place_id: str, snapshot: Optional[ReferenceSnapshot] = None) -> Dict:
+        """وجود صور مرجعية لمكان وعددها (في وضع المنسق من الـ shard المالك له)"""
+        if self.shards is not None:
+            place = self.shards.place(place_id, PLACES_DATA[place_id]['location'])
+            return {
+                "has_reference_images": place['hasReferenceImages'],
+                "reference_count": place['referenceCount']
+            }
+        snapshot = snapshot or self.snapshot
+        return {
+            "has_reference_images": snapshot.descriptors['sift'].get(place_id) is not None,
+            "reference_count": len(snapshot.place_images('sift', place_id))
+        }
+    
     def get_all_places(self) -> List[Dict]:
-        """الحصول على جميع الأماكن المسجلة"""
+        """الحصول على جميع الأماكن المسجلة
+
+        في وضع المنسق تُجمع الصور المرجعية من قوائم جميع الـ shards (الفاشل منها يُتخطى).
+        """
+        if self.shards is not None:
+            counts: Dict[str, int] = {}
+            for shard_places in self.shards.places():
+                for place in shard_places or []:
+                    counts[place['id']] = counts.get(place['id'], 0) + place['reference_count']
+            summaries = {
+                place_id: {"has_reference_images": counts.get(place_id, 0) > 0,
+                           "reference_count": counts.get(place_id, 0)}
+                for place_id in PLACES_DATA
+            }
+        else:
+            snapshot = self.snapshot
+            summaries = {place_id: self.reference_summary(place_id, snapshot) for place_id in PLACES_DATA}
+        
         places = []
         for place_id, data in PLACES_DATA.items():
-            has_reference = place_id in self.reference_descriptors and self.reference_descriptors[place_id] is not None
             places.append({
                 "id": place_id,
                 "name": data["name"],
                 "name_ar": data["name_ar"],
                 "category": data["category"],
-                "has_reference_images": has_reference,
-                "reference_count": len(self.reference_features.get(place_id, []))
+                **summaries[place_id]
             })
         return places
 
-
-# إنشاء instance عام
-recognizer = PlaceRecognizer()
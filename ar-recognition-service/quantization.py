@@ -0,0 +1,320 @@
+"""
+تكميم الجداء (Product Quantization) لفهرس وصفات SIFT مضغوط في الذاكرة
+Compressed SIFT index: inverted lists + PQ codes with asymmetric distance and exact re-ranking
+
+بدلاً من نسخة float32 كاملة داخل FLANN (512 بايت لكل وصف) يحتفظ الفهرس لكل وصف
+برمز PQ من SUBSPACES بايت ورقم قائمته المقلوبة. البحث:
+1. أقرب PQ_PROBES قائمة (مراكز خشنة) لكل وصف استعلام
+2. مسافة تقريبية غير متماثلة (جداول مسافات الاستعلام إلى مراكز كل فضاء جزئي)
+3. إعادة ترتيب أفضل PQ_RERANK مرشحين بالمسافة الدقيقة من كتل المخزن (memmap) ثم اختبار النسبة
+
+التدريب (دون اتصال؛ الفهرس يُستخدم تلقائياً عند وجود الملفات):
+    python quantization.py --reference-dir reference_images --lists 1024 --subspaces 16
+"""
+
+import argparse
+import os
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import cv2
+import numpy as np
+
+from descriptor_index import DescriptorIndex
+from reference_store import ReferenceStore, StoreLock, StoreLockedError
+
+QUANTIZER_DIR = "quantizer"
+
+# عدد القوائم المفحوصة لكل وصف، وعدد المرشحين المعاد ترتيبهم بالمسافة الدقيقة
+PQ_PROBES = int(os.environ.get('PQ_PROBES', 8))
+PQ_RERANK = int(os.environ.get('PQ_RERANK', 8))
+
+# عدد مراكز كل فضاء جزئي (رمز بايت واحد)
+PQ_CENTROIDS = 256
+
+# حجم دفعات الترميز وحساب المسافات
+ENCODE_CHUNK = 65536
+
+# وصفات الاستعلام في كل دفعة مطابقة: جداول المسافة 1024 × 16 × 256 × 4 بايت = 16MB لكل دفعة
+TABLE_CHUNK = 1024
+
+
+def _squared_distances(vectors: np.ndarray, centroids: np.ndarray, centroid_norms: np.ndarray) -> np.ndarray:
+    """مربع المسافة الإقليدية بين كل متجه وكل مركز"""
+    return (
+        np.einsum('ij,ij->i', vectors, vectors)[:, None]
+        - 2.0 * vectors @ centroids.T
+        + centroid_norms[None, :]
+    )
+
+
+def _grouped_order(groups: np.ndarray, values: np.ndarray) -> np.ndarray:
+    """ترتيب حسب المجموعة ثم القيمة بفرز واحد (أسرع من lexsort على المصفوفات الكبيرة)"""
+    scale = float(values.max()) + 1.0 if len(values) else 1.0
+    return np.argsort(groups * scale + values.astype(np.float64), kind='stable')
+
+
+class ProductQuantizer:
+    """مراكز خشنة للقوائم المقلوبة ومراكز PQ لكل فضاء جزئي"""
+
+    def __init__(self, coarse: np.ndarray, codebooks: np.ndarray):
+        self.coarse = np.ascontiguousarray(coarse, dtype=np.float32)
+        # (SUBSPACES, PQ_CENTROIDS, البعد الجزئي)
+        self.codebooks = np.ascontiguousarray(codebooks, dtype=np.float32)
+        self._coarse_norms = np.einsum('ij,ij->i', self.coarse, self.coarse)
+        self._codebook_norms = np.einsum('mij,mij->mi', self.codebooks, self.codebooks)
+
+    @property
+    def lists(self) -> int:
+        return len(self.coarse)
+
+    @property
+    def subspaces(self) -> int:
+        return self.codebooks.shape[0]
+
+    @property
+    def dim(self) -> int:
+        return self.codebooks.shape[0] * self.codebooks.shape[2]
+
+    @classmethod
+    def load(cls, reference_images_dir: Path) -> Optional['ProductQuantizer']:
+        """تحميل المكمم المدرب إن وُجد"""
+        root = Path(reference_images_dir) / QUANTIZER_DIR
+        if not (root / "coarse.npy").exists() or not (root / "codebooks.npy").exists():
+            return None
+        return cls(np.load(root / "coarse.npy"), np.load(root / "codebooks.npy"))
+
+    def save(self, reference_images_dir: Path):
+        root = Path(reference_images_dir) / QUANTIZER_DIR
+        root.mkdir(parents=True, exist_ok=True)
+        np.save(root / "coarse.npy", self.coarse)
+        np.save(root / "codebooks.npy", self.codebooks)
+
+    def _split(self, vectors: np.ndarray) -> np.ndarray:
+        """(N, 128) ← (SUBSPACES, N, البعد الجزئي)"""
+        return np.asarray(vectors, dtype=np.float32).reshape(len(vectors), self.subspaces, -1).transpose(1, 0, 2)
+
+    def probe(self, vectors: np.ndarray, probes: int) -> np.ndarray:
+        """أقرب probes قائمة لكل متجه (N, probes)"""
+        distances = _squared_distances(np.asarray(vectors, dtype=np.float32), self.coarse, self._coarse_norms)
+        probes = min(probes, self.lists)
+        return np.argpartition(distances, probes - 1, axis=1)[:, :probes]
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        """رموز PQ (N, SUBSPACES) بايت لكل فضاء جزئي"""
+        codes = np.empty((len(vectors), self.subspaces), dtype=np.uint8)
+        for start in range(0, len(vectors), ENCODE_CHUNK):
+            parts = self._split(vectors[start:start + ENCODE_CHUNK])
+            for m, part in enumerate(parts):
+                codes[start:start + len(part), m] = np.argmin(_squared_distances(part, self.codebooks[m], self._codebook_norms[m]), axis=1)
+        return codes
+
+    def tables(self, vectors: np.ndarray) -> np.ndarray:
+        """جداول المسافة غير المتماثلة (N, SUBSPACES, PQ_CENTROIDS)"""
+        parts = self._split(vectors)
+        return np.stack(
+            [_squared_distances(part, self.codebooks[m], self._codebook_norms[m]) for m, part in enumerate(parts)],
+            axis=1
+        ).astype(np.float32)
+
+
+class QuantizedIndex(DescriptorIndex):
+    """فهرس SIFT برموز PQ وقوائم مقلوبة بدلاً من FLANN
+
+    يطابق واجهة DescriptorIndex (الأصوات والمطابقات الجيدة بنفس الصيغة)؛ الكتل الأصلية
+    تبقى memmap من المخزن ولا يُقرأ منها إلا المرشحون المعاد ترتيبهم.
+    """
+
+    def __init__(self, quantizer: ProductQuantizer, probes: int = PQ_PROBES,
+                 rerank: int = PQ_RERANK, ratio: float = 0.7):
+        super().__init__({}, {}, ratio, dtype=np.float32)
+        self.quantizer = quantizer
+        self.probes = probes
+        self.rerank = max(rerank, 2)
+        self._codes = np.empty((0, quantizer.subspaces), dtype=np.uint8)
+        self._list_starts = np.zeros(quantizer.lists + 1, dtype=np.int64)
+        self._list_rows = np.empty(0, dtype=np.int32)
+
+    @property
+    def nbytes(self) -> int:
+        """حجم الفهرس في الذاكرة (الرموز والقوائم)"""
+        return self._codes.nbytes + self._list_rows.nbytes + self._list_starts.nbytes
+
+    def build(self, descriptors: Dict[str, Optional[np.ndarray]]):
+        """ترميز جميع الكتل وتوزيع صفوفها على القوائم المقلوبة"""
+        _, blocks = self._collect(descriptors)
+        self._blocks = blocks
+        if not blocks:
+            return
+
+        codes = []
+        lists = []
+        for block in blocks:
+            for start in range(0, len(block), ENCODE_CHUNK):
+                chunk = np.asarray(block[start:start + ENCODE_CHUNK], dtype=np.float32)
+                codes.append(self.quantizer.encode(chunk))
+                lists.append(self.quantizer.probe(chunk, 1)[:, 0])
+        self._codes = np.vstack(codes)
+        lists = np.concatenate(lists)
+
+        # القوائم بصيغة CSR: صفوف القائمة l هي _list_rows[_list_starts[l]:_list_starts[l + 1]]
+        self._list_rows = np.argsort(lists, kind='stable').astype(np.int32)
+        self._list_starts = np.concatenate(
+            [[0], np.cumsum(np.bincount(lists, minlength=self.quantizer.lists))]
+        ).astype(np.int64)
+
+    def _allowed_rows(self, candidates: List) -> Optional[np.ndarray]:
+        """قناع الصفوف المسموحة لمقاطع المرشحين (None إذا لم يبقَ أي مقطع)"""
+        segments = self._segments(candidates)
+        if not segments:
+            return None
+        allowed = np.zeros(len(self._codes), dtype=bool)
+        for label, start, rows in segments:
+            begin = self._place_starts[label] + start
+            allowed[begin:begin + rows] = True
+        return allowed
+
+    def _exact(self, rows: np.ndarray) -> np.ndarray:
+        """الوصفات الدقيقة لصفوف عامة من كتل المخزن"""
+        labels = np.searchsorted(self._place_starts, rows, side='right') - 1
+        exact = np.empty((len(rows), self.quantizer.dim), dtype=np.float32)
+        for label in np.unique(labels):
+            selected = np.flatnonzero(labels == label)
+            local = rows[selected] - self._place_starts[label]
+            order = np.argsort(local)
+            exact[selected[order]] = self._blocks[label][local[order]]
+        return exact
+
+    def _ratio_matches(self, stacked: np.ndarray, candidates: Optional[List]) -> Optional[np.ndarray]:
+        if candidates is None:
+            return self._masked_matches(stacked, None, None)
+        allowed = self._allowed_rows(candidates)
+        if allowed is None:
+            return None
+        return self._masked_matches(stacked, allowed[np.newaxis], np.zeros(len(stacked), dtype=np.int64))
+
+    def _grouped_ratio_matches(self, stacked: np.ndarray, groups: np.ndarray,
+                               group_candidates: List[Optional[List]]) -> Optional[np.ndarray]:
+        """مرور واحد على القوائم المقلوبة مع قناع صفوف لكل مجموعة بدلاً من مطابقة كل مجموعة وحدها"""
+        allowed = np.ones((len(group_candidates), len(self._codes)), dtype=bool)
+        for group, candidates in enumerate(group_candidates):
+            if candidates is not None:
+                rows = self._allowed_rows(candidates)
+                allowed[group] = rows if rows is not None else False
+        return self._masked_matches(stacked, allowed, groups)
+
+    def _masked_matches(self, stacked: np.ndarray, allowed: Optional[np.ndarray],
+                        groups: Optional[np.ndarray]) -> Optional[np.ndarray]:
+        """مطابقة جميع الوصفات؛ allowed[groups[i]] قناع الصفوف المسموحة للوصف i (None: الكل)"""
+        # الجداول والمرشحون تتناسب مع عدد وصفات الاستعلام، فتُطابق الدفعات المجمعة على أجزاء
+        found = []
+        for start in range(0, len(stacked), TABLE_CHUNK):
+            matches = self._chunk_matches(
+                stacked[start:start + TABLE_CHUNK], allowed,
+                groups[start:start + TABLE_CHUNK] if groups is not None else None
+            )
+            if matches is not None:
+                matches[:, 0] += start
+                found.append(matches)
+        return np.vstack(found) if found else None
+
+    def _chunk_matches(self, stacked: np.ndarray, allowed: Optional[np.ndarray],
+                       groups: Optional[np.ndarray]) -> Optional[np.ndarray]:
+        """مطابقة جزء من وصفات الاستعلام (نفس صيغة _ratio_matches)"""
+        # المرشحون: جميع صفوف القوائم المفحوصة لكل وصف (queries, rows) بشكل مسطح
+        probed = self.quantizer.probe(stacked, self.probes)
+        queries = np.repeat(np.arange(len(stacked)), probed.shape[1])
+        probed = probed.ravel()
+        lengths = self._list_starts[probed + 1] - self._list_starts[probed]
+        total = int(lengths.sum())
+        if total == 0:
+            return None
+        queries = np.repeat(queries, lengths)
+        first = np.repeat(self._list_starts[probed] - np.concatenate([[0], np.cumsum(lengths)[:-1]]), lengths)
+        rows = self._list_rows[first + np.arange(total)].astype(np.int64)
+        if allowed is not None:
+            mask = allowed[groups[queries], rows]
+            queries, rows = queries[mask], rows[mask]
+            if len(rows) == 0:
+                return None
+
+        # مسافة تقريبية غير متماثلة: مجموع جداول الاستعلام عند رموز المرجع (فضاء جزئي في كل مرة)
+        tables = self.quantizer.tables(stacked)
+        codes = self._codes[rows]
+        approximate = np.zeros(len(rows), dtype=np.float32)
+        for m in range(self.quantizer.subspaces):
+            approximate += np.take(tables[:, m, :], queries * PQ_CENTROIDS + codes[:, m])
+
+        # أفضل rerank مرشح لكل وصف: المرشحون مجمعون حسب الوصف فيكفي ترتيب داخل كل مجموعة
+        order = _grouped_order(queries, approximate)
+        queries, rows = queries[order], rows[order]
+        group_starts = np.searchsorted(queries, queries, side='left')
+        keep = (np.arange(len(queries)) - group_starts) < self.rerank
+        queries, rows = queries[keep], rows[keep]
+
+        # إعادة الترتيب بالمسافة الدقيقة ثم اختبار النسبة على أقرب جارين
+        distances = np.linalg.norm(self._exact(rows) - stacked[queries], axis=1)
+        order = _grouped_order(queries, distances)
+        queries, rows, distances = queries[order], rows[order], distances[order]
+        firsts = np.flatnonzero(np.r_[True, queries[1:] != queries[:-1]])
+        pairs = firsts[(firsts + 1 < len(queries))]
+        pairs = pairs[queries[pairs + 1] == queries[pairs]]
+        pairs = pairs[distances[pairs] < self.ratio * distances[pairs + 1]]
+        if len(pairs) == 0:
+            return None
+
+        best = rows[pairs]
+        labels = np.searchsorted(self._place_starts, best, side='right') - 1
+        return np.column_stack([queries[pairs], labels, best - self._place_starts[labels]]).astype(np.int64)
+
+
+def train_quantizer(reference_images_dir: Path, lists: int, subspaces: int, sample_size: int,
+                    seed: int = 0) -> ProductQuantizer:
+    """تدريب المراكز الخشنة ومراكز PQ بـ k-means على عينة من وصفات SIFT المخزنة"""
+    with StoreLock(reference_images_dir):
+        store = ReferenceStore(Path(reference_images_dir) / "store")
+        blocks = [block for block in (store.load_descriptors(p) for p in store.places()) if block is not None]
+        total = sum(len(block) for block in blocks)
+        if total < max(lists, PQ_CENTROIDS):
+            raise ValueError(f"عدد الوصفات ({total}) أقل من عدد المراكز")
+        if store.dim % subspaces:
+            raise ValueError(f"عدد الفضاءات الجزئية يجب أن يقسم {store.dim}")
+
+        rng = np.random.default_rng(seed)
+        fraction = min(1.0, sample_size / total)
+        sample = np.vstack([
+            block[np.sort(rng.choice(len(block), max(1, int(len(block) * fraction)), replace=False))]
+            for block in blocks
+        ]).astype(np.float32)
+
+        cv2.setRNGSeed(seed)
+        criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 20, 1e-3)
+        print(f"تدريب {lists} قائمة و {subspaces}×{PQ_CENTROIDS} مركز على {len(sample)} وصف...")
+        _, _, coarse = cv2.kmeans(sample, lists, None, criteria, 1, cv2.KMEANS_PP_CENTERS)
+        codebooks = np.stack([
+            cv2.kmeans(np.ascontiguousarray(part), PQ_CENTROIDS, None, criteria, 1, cv2.KMEANS_PP_CENTERS)[2]
+            for part in sample.reshape(len(sample), subspaces, -1).transpose(1, 0, 2)
+        ])
+
+        quantizer = ProductQuantizer(coarse, codebooks)
+        quantizer.save(reference_images_dir)
+        print(f"تم حفظ المكمم في {Path(reference_images_dir) / QUANTIZER_DIR} "
+              f"({subspaces} بايت لكل وصف بدلاً من {store.dim * 4})")
+        return quantizer
+
+
+def main():
+    parser = argparse.ArgumentParser(description="تدريب مكمم PQ لفهرس SIFT مضغوط")
+    parser.add_argument('--reference-dir', default="reference_images", help="مجلد الصور المرجعية")
+    parser.add_argument('--lists', type=int, default=1024, help="عدد القوائم المقلوبة (المراكز الخشنة)")
+    parser.add_argument('--subspaces', type=int, default=16, help="عدد الفضاءات الجزئية (بايت لكل وصف)")
+    parser.add_argument('--sample', type=int, default=200000, help="عدد الوصفات المستخدمة في التدريب")
+    args = parser.parse_args()
+    try:
+        train_quantizer(Path(args.reference_dir), args.lists, args.subspaces, args.sample)
+    except StoreLockedError as e:
+        parser.exit(1, f"{e}\n")
+
+
+if __name__ == '__main__':
+    main()
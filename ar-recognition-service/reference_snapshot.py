@@ -0,0 +1,95 @@
+"""
+لقطات ثابتة للصور المرجعية وفهارسها تُستبدل كاملة
+Immutable reference snapshots, published by swapping a single reference
+"""
+
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from descriptor_index import DescriptorIndex
+from quantization import ProductQuantizer, QuantizedIndex
+from reference_store import ReferenceStore
+from vocabulary import VisualVocabulary
+
+# فهرس جديد لكل لقطة حتى لا يُعدّل فهرس يستخدمه استعلام جارٍ
+INDEX_FACTORIES = {
+    'sift': DescriptorIndex.kdtree,
+    'orb': DescriptorIndex.lsh
+}
+
+
+@dataclass(frozen=True)
+class ReferenceSnapshot:
+    """نسخة للقراءة فقط من الصور المرجعية والوصفات والفهارس
+
+    لا تُعدّل اللقطة بعد نشرها؛ الإضافات تبني لقطة جديدة ويستمر كل استعلام
+    على اللقطة التي بدأ بها.
+    """
+    version: int
+    images: Dict[str, Dict[str, List[Dict]]]
+    descriptors: Dict[str, Dict[str, np.ndarray]]
+    indexes: Dict[str, DescriptorIndex]
+    vocabulary: Optional[VisualVocabulary]
+    keypoint_blocks: Dict[str, Dict[str, np.ndarray]]
+    generations: Dict[str, Dict[str, int]]
+
+    def place_images(self, mode: str, place_id: str) -> List[Dict]:
+        return self.images[mode].get(place_id, [])
+
+    def keypoints(self, mode: str, place_id: str) -> Optional[np.ndarray]:
+        """النقاط المميزة لمكان من ملف الجيل نفسه الذي أُخذت منه وصفات اللقطة"""
+        return self.keypoint_blocks[mode].get(place_id)
+
+
+def capture(stores: Dict[str, ReferenceStore], previous: Optional[ReferenceSnapshot] = None) -> Dict:
+    """نسخ حالة المخازن (سجلات الصور وكتل memmap)؛ يُستدعى أثناء حجز قفل الكتابة
+
+    تُفتح كتل الوصفات والنقاط المميزة معاً من الجيل نفسه، فلا يقرأ استعلام نقاط
+    جيل أحدث (بعد الضغط) من وصفات لقطته، ويبقى الملف المفتوح صالحاً حتى بعد حذفه.
+    الكتل التي لم يتغير جيلها وعدد صفوفها تُعاد من اللقطة السابقة دون فتحها من جديد.
+    """
+    images = {}
+    descriptors = {}
+    keypoint_blocks = {}
+    generations = {}
+    for mode, store in stores.items():
+        images[mode] = {}
+        descriptors[mode] = {}
+        keypoint_blocks[mode] = {}
+        generations[mode] = {}
+        for place_id in store.places():
+            place = store.manifest['places'][place_id]
+            generation = place.get('generation', 0)
+            images[mode][place_id] = store.images(place_id)
+            block = keypoints = None
+            if previous is not None and previous.generations[mode].get(place_id) == generation:
+                block = previous.descriptors[mode].get(place_id)
+                keypoints = previous.keypoint_blocks[mode].get(place_id)
+            if block is None or len(block) != place['rows']:
+                block = store.load_descriptors(place_id)
+                keypoints = store.load_keypoints(place_id)
+            descriptors[mode][place_id] = block
+            keypoint_blocks[mode][place_id] = keypoints
+            generations[mode][place_id] = generation
+    return {
+        'images': images,
+        'descriptors': descriptors,
+        'keypoint_blocks': keypoint_blocks,
+        'generations': generations
+    }
+
+
+def build_indexes(descriptors: Dict[str, Dict[str, np.ndarray]],
+                  quantizer: Optional[ProductQuantizer] = None) -> Dict[str, DescriptorIndex]:
+    """بناء فهارس جديدة لجميع الأوضاع (الجزء المكلف، خارج قفل الكتابة)
+
+    مع مكمم مدرب يُبنى فهرس SIFT برموز PQ بدلاً من KD-tree.
+    """
+    indexes = {}
+    for mode, factory in INDEX_FACTORIES.items():
+        index = QuantizedIndex(quantizer) if mode == 'sift' and quantizer is not None else factory()
+        index.build(descriptors.get(mode, {}))
+        indexes[mode] = index
+    return indexes
@@ -0,0 +1,325 @@
+"""
+مخزن الميزات المرجعية المقسّم على القرص
+Segmented, append-only on-disk store for reference features
+"""
+
+import fcntl
+import json
+import os
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+# تخطيط النقاط المميزة على القرص: (x, y, size, angle, response, octave)
+KEYPOINT_DTYPE = np.dtype([
+    ('x', '<f4'),
+    ('y', '<f4'),
+    ('size', '<f4'),
+    ('angle', '<f4'),
+    ('response', '<f4'),
+    ('octave', '<i4'),
+])
+
+MANIFEST_VERSION = 1
+
+# ملف القفل في مجلد الصور المرجعية (يغطي المخزنين والمفردات والمكمم معاً)
+LOCK_FILE = ".lock"
+
+# قفل الكتابة بين عمال الخدمة (الإضافة أثناء التشغيل)؛ منفصل لأن كل عامل يحجز LOCK_FILE مشتركاً
+WRITE_LOCK_FILE = ".write.lock"
+
+# نوع تخزين وصفات SIFT للمخازن الجديدة: float32 أو float16 أو uint8
+# (قيم SIFT في OpenCV أعداد صحيحة بين 0 و 255، فالنوعان المضغوطان بلا فقد)
+SIFT_STORE_DTYPE = np.dtype(os.environ.get('SIFT_STORE_DTYPE', 'float32'))
+
+
+def write_json_atomic(path: Path, data: Dict):
+    """كتابة ملف JSON بشكل ذري (ملف مؤقت ثم استبدال)"""
+    tmp_path = path.with_suffix(path.suffix + '.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def file_signature(path: Path) -> Optional[Tuple[int, int, int]]:
+    """بصمة ملف (inode، زمن التعديل، الحجم) لاكتشاف كتابة عملية أخرى؛ None إذا لم يوجد
+
+    الكتابة الذرية تستبدل الملف، فيتغير الـ inode مع كل نشر.
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+def append_block(path: Path, block: np.ndarray, expected_bytes: int):
+    """إلحاق كتلة بالملف بعد قص أي بقايا كتابة غير مكتملة"""
+    if path.exists() and path.stat().st_size != expected_bytes:
+        os.truncate(path, expected_bytes)
+    with open(path, 'ab') as f:
+        f.write(block.tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+
+
+class StoreLockedError(RuntimeError):
+    """مجلد المراجع محجوز لعملية أخرى"""
+
+
+class StoreLock:
+    """قفل ملف (flock) على مجلد الصور المرجعية بين الخدمة وأدوات الصيانة
+
+    الخدمة تأخذ قفلاً مشتركاً تتشاركه عمليات gunicorn، وأدوات الكتابة دون اتصال
+    (الإدخال والضغط وتدريب المفردات والمكمم) تأخذ قفلاً حصرياً. لا ينتظر أي طرف
+    الآخر: يفشل الحجز فوراً بـ StoreLockedError. يُحرر القفل عند release() أو انتهاء العملية.
+    مع wait=True ينتظر الحجز بدلاً من الفشل (قفل الكتابة القصير بين العمال، WRITE_LOCK_FILE).
+    """
+
+    def __init__(self, root: Path, exclusive: bool = True, name: str = LOCK_FILE, wait: bool = False):
+        self.path = Path(root) / name
+        self.exclusive = exclusive
+        self.wait = wait
+        self._file = None
+
+    def acquire(self) -> 'StoreLock':
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        f = open(self.path, 'a')
+        mode = fcntl.LOCK_EX if self.exclusive else fcntl.LOCK_SH
+        try:
+            fcntl.flock(f.fileno(), mode if self.wait else mode | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.close()
+            raise StoreLockedError(f"مجلد المراجع قيد الاستخدام من عملية أخرى: {self.path.parent}")
+        self._file = f
+        return self
+
+    def release(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self) -> 'StoreLock':
+        return self.acquire()
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class ReferenceStore:
+    """مخزن إلحاقي لكتل الوصفات الخام مع ملف فهرس صغير
+
+    dtype يحدد نوع المخزن الجديد فقط؛ المخزن الموجود يُفتح بالنوع المسجل في ملف فهرسه.
+    """
+
+    def __init__(self, root: Path, dim: int = 128, dtype=np.float32):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        self.manifest_path = self.root / "manifest.json"
+        self.manifest = self._read_manifest()
+        self.dtype = np.dtype(self.manifest['dtype'])
+
+    def _read_manifest(self) -> Dict:
+        """قراءة ملف الفهرس"""
+        self._signature = file_signature(self.manifest_path)
+        if self.manifest_path.exists():
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            if manifest.get('dim') != self.dim or 'dtype' not in manifest:
+                raise ValueError(f"مخزن غير متوافق: {self.root}")
+            return manifest
+        return {
+            'version': MANIFEST_VERSION,
+            'dim': self.dim,
+            'dtype': self.dtype.str,
+            'places': {}
+        }
+
+    def _write_manifest(self):
+        """كتابة ملف الفهرس بشكل ذري"""
+        write_json_atomic(self.manifest_path, self.manifest)
+        self._signature = file_signature(self.manifest_path)
+
+    def changed(self) -> bool:
+        """هل نشرت عملية أخرى ملف فهرس بعد آخر قراءة أو كتابة من هذا الكائن"""
+        return file_signature(self.manifest_path) != self._signature
+
+    def refresh(self) -> bool:
+        """إعادة قراءة ملف الفهرس إذا تغير على القرص؛ يُرجع True إذا أُعيدت القراءة
+
+        يُستدعى تحت قفل الكتابة (WRITE_LOCK_FILE) قبل الإلحاق، فلا يقص الإلحاق كتل
+        عملية أخرى ولا يكتب فوق فهرسها نسخة قديمة.
+        """
+        if not self.changed():
+            return False
+        self.manifest = self._read_manifest()
+        self.dtype = np.dtype(self.manifest['dtype'])
+        return True
+
+    def _place_dir(self, place_id: str) -> Path:
+        return self.root / place_id
+
+    def _files(self, place_id: str, place: Optional[Dict] = None) -> Tuple[Path, Path]:
+        """ملفا الوصفات والنقاط لجيل المكان الحالي (الضغط يكتب جيلاً جديداً بجانب القديم)"""
+        place = place if place is not None else self.manifest['places'].get(place_id, {})
+        generation = place.get('generation', 0)
+        suffix = f".{generation}" if generation else ""
+        place_dir = self._place_dir(place_id)
+        return place_dir / f"descriptors{suffix}.bin", place_dir / f"keypoints{suffix}.bin"
+
+    def is_empty(self) -> bool:
+        return not self.manifest['places']
+
+    def places(self) -> List[str]:
+        """معرفات الأماكن المخزنة"""
+        return list(self.manifest['places'].keys())
+
+    def images(self, place_id: str) -> List[Dict]:
+        """سجلات الصور المرجعية لمكان"""
+        place = self.manifest['places'].get(place_id)
+        return list(place['images']) if place else []
+
+    def load_descriptors(self, place_id: str) -> Optional[np.ndarray]:
+        """تحميل وصفات مكان عبر memmap للقراءة فقط"""
+        place = self.manifest['places'].get(place_id)
+        if not place or place['rows'] == 0:
+            return None
+        return np.memmap(
+            self._files(place_id)[0],
+            dtype=self.dtype,
+            mode='r',
+            shape=(place['rows'], self.dim)
+        )
+
+    def load_keypoints(self, place_id: str) -> Optional[np.ndarray]:
+        """تحميل النقاط المميزة لمكان عبر memmap للقراءة فقط"""
+        place = self.manifest['places'].get(place_id)
+        if not place or place['rows'] == 0:
+            return None
+        return np.memmap(
+            self._files(place_id)[1],
+            dtype=KEYPOINT_DTYPE,
+            mode='r',
+            shape=(place['rows'],)
+        )
+
+    def append(self, place_id: str, keypoints: np.ndarray, descriptors: np.ndarray,
+               image_path: str, image_hash: Optional[int] = None,
+               commit: bool = True) -> Dict:
+        """إلحاق ميزات صورة واحدة دون إعادة كتابة البيانات السابقة
+
+        مع commit=False لا يُكتب ملف الفهرس حتى استدعاء commit()، فتبقى الكتل الملحقة
+        غير مرئية للقراء (وتُقص عند الإلحاق التالي إذا لم يكتمل الإدخال).
+        """
+        descriptors = np.ascontiguousarray(descriptors, dtype=self.dtype)
+        keypoints = np.ascontiguousarray(keypoints, dtype=KEYPOINT_DTYPE)
+        if descriptors.ndim != 2 or descriptors.shape[1] != self.dim:
+            raise ValueError(f"أبعاد الوصفات غير صحيحة: {descriptors.shape}")
+        if len(keypoints) != len(descriptors):
+            raise ValueError("عدد النقاط المميزة لا يطابق عدد الوصفات")
+
+        place = self.manifest['places'].setdefault(place_id, {'rows': 0, 'images': []})
+        self._place_dir(place_id).mkdir(exist_ok=True)
+        descriptors_path, keypoints_path = self._files(place_id, place)
+
+        offset = place['rows']
+        append_block(
+            descriptors_path,
+            descriptors,
+            offset * self.dim * self.dtype.itemsize
+        )
+        append_block(
+            keypoints_path,
+            keypoints,
+            offset * KEYPOINT_DTYPE.itemsize
+        )
+
+        record = {
+            'image_path': image_path,
+            'offset': offset,
+            'rows': len(descriptors)
+        }
+        if image_hash is not None:
+            record['dhash'] = image_hash
+        place['images'].append(record)
+        place['rows'] = offset + len(descriptors)
+        if commit:
+            self._write_manifest()
+        return record
+
+    def commit(self):
+        """نشر الإلحاقات المؤجلة بكتابة ملف الفهرس مرة واحدة"""
+        self._write_manifest()
+
+    def rewrite_place(self, place_id: str, keep: Dict[int, np.ndarray], dtype=None) -> List[Path]:
+        """كتابة جيل جديد من كتل مكان يحتوي الصفوف المختارة فقط
+
+        keep: {رقم الصورة: فهارس الصفوف المحتفظ بها داخل الصورة}؛ الصور غير المذكورة تُحذف.
+        dtype: نوع الوصفات في الجيل الجديد (يستخدمه convert فقط).
+        الجيل الجديد لا يظهر إلا بعد commit()، وتُرجع ملفات الجيل السابق لحذفها بعد ذلك.
+        """
+        place = self.manifest['places'][place_id]
+        descriptors = self.load_descriptors(place_id)
+        keypoints = self.load_keypoints(place_id)
+
+        images = []
+        rows = []
+        offset = 0
+        for i, image in enumerate(place['images']):
+            selected = keep.get(i)
+            if selected is None or len(selected) == 0:
+                continue
+            rows.append(np.sort(np.asarray(selected, dtype=np.int64)) + image['offset'])
+            images.append(dict(image, offset=offset, rows=len(rows[-1])))
+            offset += len(rows[-1])
+        rows = np.concatenate(rows) if rows else np.empty(0, dtype=np.int64)
+
+        compacted = {'rows': offset, 'images': images, 'generation': place.get('generation', 0) + 1}
+        descriptors_path, keypoints_path = self._files(place_id, compacted)
+        blocks = (
+            (descriptors_path, descriptors, dtype or self.dtype),
+            (keypoints_path, keypoints, KEYPOINT_DTYPE)
+        )
+        for path, block, block_dtype in blocks:
+            with open(path, 'wb') as f:
+                if block is not None:
+                    f.write(np.ascontiguousarray(block[rows], dtype=block_dtype).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+
+        previous = self._files(place_id, place)
+        self.manifest['places'][place_id] = compacted
+        return [path for path in previous if path.exists()]
+
+    def convert(self, dtype) -> List[Path]:
+        """إعادة كتابة جميع الأماكن بنوع وصفات آخر؛ يظهر التحويل كاملاً عند commit()"""
+        dtype = np.dtype(dtype)
+        stale = []
+        for place_id in self.places():
+            images = self.manifest['places'][place_id]['images']
+            keep = {i: np.arange(image['rows']) for i, image in enumerate(images)}
+            stale += self.rewrite_place(place_id, keep, dtype)
+        self.dtype = dtype
+        self.manifest['dtype'] = dtype.str
+        return stale
+
+
+def keypoints_to_array(keypoints) -> np.ndarray:
+    """تحويل نقاط OpenCV المميزة إلى مصفوفة مهيكلة"""
+    arr = np.empty(len(keypoints), dtype=KEYPOINT_DTYPE)
+    for i, kp in enumerate(keypoints):
+        arr[i] = (kp.pt[0], kp.pt[1], kp.size, kp.angle, kp.response, kp.octave)
+    return arr
+
+
+def keypoint_tuples_to_array(keypoints: List) -> np.ndarray:
+    """تحويل صيغة features.pkl القديمة إلى مصفوفة مهيكلة"""
+    arr = np.empty(len(keypoints), dtype=KEYPOINT_DTYPE)
+    for i, (pt, size, angle, response, octave) in enumerate(keypoints):
+        arr[i] = (pt[0], pt[1], size, angle, response, octave)
+    return arr
@@ -0,0 +1,113 @@
+"""
+ذاكرة مؤقتة لنتائج التعرف بمفتاح البصمة الإدراكية للصورة
+LRU + TTL cache for recognition results keyed by a perceptual image hash
+"""
+
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import fields, is_dataclass
+from typing import Any, Dict, Hashable, Optional
+
+# تقدير ثابت لحجم المدخل (المفتاح + بنية القاموس المرتب) بالبايت
+ENTRY_OVERHEAD_BYTES = 256
+
+_MISSING = object()
+
+
+def _estimate_size(value: Any) -> int:
+    """تقدير تقريبي لحجم القيمة المخزنة بالبايت"""
+    if value is None:
+        return ENTRY_OVERHEAD_BYTES
+    if is_dataclass(value):
+        return ENTRY_OVERHEAD_BYTES + sum(
+            sys.getsizeof(getattr(value, field.name)) for field in fields(value)
+        )
+    return ENTRY_OVERHEAD_BYTES + sys.getsizeof(value)
+
+
+class RecognitionCache:
+    """ذاكرة LRU مع مدة صلاحية وحدود للعدد والحجم، وعدادات إصابة/إخفاق"""
+
+    def __init__(self, max_entries: int = 256, ttl_seconds: float = 10.0,
+                 max_bytes: int = 1024 * 1024):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @classmethod
+    def from_env(cls) -> Optional['RecognitionCache']:
+        """إنشاء الذاكرة من المتغيرات البيئية (RESULT_CACHE_SIZE=0 للتعطيل)"""
+        max_entries = int(os.environ.get('RESULT_CACHE_SIZE', 256))
+        if max_entries <= 0:
+            return None
+        return cls(
+            max_entries=max_entries,
+            ttl_seconds=float(os.environ.get('RESULT_CACHE_TTL', 10)),
+            max_bytes=int(os.environ.get('RESULT_CACHE_MAX_BYTES', 1024 * 1024))
+        )
+
+    def get(self, key: Hashable) -> Any:
+        """القيمة المخزنة أو _MISSING (القيمة None نتيجة صالحة: لم يتم التعرف)"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < now:
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return _MISSING
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: Hashable, value: Any):
+        size = _estimate_size(value)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, value, size)
+            self._bytes += size
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key: Hashable):
+        _, _, size = self._entries.pop(key)
+        self._bytes -= size
+
+    def clear(self):
+        """إبطال جميع النتائج (عند تغيّر الصور المرجعية)"""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self.invalidations += 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "maxEntries": self.max_entries,
+                "maxBytes": self.max_bytes,
+                "ttlSeconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRate": round(self.hits / total, 4) if total else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations
+            }
+
+
+def is_missing(value: Any) -> bool:
+    return value is _MISSING
@@ -3,73 +3,540 @@
 Flask Server for Place Recognition
 """
 
-from flask import Flask, request, jsonify
+from flask import Flask, Request, Response, request, jsonify, make_response
 from flask_cors import CORS
+from werkzeug.datastructures import FileStorage
+from werkzeug.exceptions import RequestEntityTooLarge
 import base64
+import binascii
+import hmac
 import os
+import threading
+import time
+from functools import wraps
+from io import BytesIO
+from typing import List, Optional, Tuple
+
+import metrics
+from place_recognition import PlaceRecognizer, PLACES_DATA, RECOGNITION_MODES
+from result_cache import RecognitionCache
+from sharding import SHARD_MATCH_PATH, SHARD_SECRET, SHARD_SECRET_HEADER, ShardedMatcher, decode_queries
+from tracking import TrackingSessions
+from worker_pool import ExtractionPool, ExtractionUnavailableError, PoolSaturatedError
+
+# الحد الأقصى لحجم الطلب (JSON أو multipart أو صورة خام)
+MAX_UPLOAD_BYTES = int(os.environ.get('MAX_UPLOAD_BYTES', 20 * 1024 * 1024))
+UPLOAD_CHUNK_BYTES = 64 * 1024
+
+
+
+class UploadStream(BytesIO):
+    """ملف multipart في الذاكرة تبقى عروض memoryview على مخزنه صالحة بعد إغلاق الطلب"""
+
+    def close(self):
+        # BytesIO لا يُغلق وعليه عروض قائمة؛ المخزن يُحرر مع آخر عرض
+        pass
+
+
+def upload_stream_factory(*args, **kwargs) -> UploadStream:
+    """ملفات multipart في الذاكرة بدلاً من ملف مؤقت (الطلب محدود بـ MAX_UPLOAD_BYTES)"""
+    return UploadStream()
+
+
+def upload_buffer(upload: FileStorage) -> memoryview:
+    """محتوى ملف multipart دون نسخه (decode_gray يقرأ المخزن مباشرة)"""
+    return upload.stream.getbuffer()
+
+
+class UploadRequest(Request):
+    def _get_file_stream(self, *args, **kwargs) -> UploadStream:
+        return upload_stream_factory()
 
-from place_recognition import recognizer, PLACES_DATA
 
 app = Flask(__name__)
-CORS(app, origins=["http://localhost:3000", "http://127.0.0.1:3000"])
+app.request_class = UploadRequest
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES
+# الواجهات المسموح لها بالوصول (تُستخدم أيضاً في خادم ASGI)
+CORS_ORIGINS = ["http://localhost:3000", "http://127.0.0.1:3000"]
+CORS(app, origins=CORS_ORIGINS)
+
+# الحد الأقصى لعدد الصور في طلب دفعة واحد
+MAX_BATCH_SIZE = int(os.environ.get('MAX_BATCH_SIZE', 32))
+
+# أقصى انتظار لنشر اللقطة المرجعية عند إضافة صورة مع wait=true
+PUBLISH_WAIT_SECONDS = 30
+
+# تشغيل استعلام اصطناعي بعد التحميل وقبل إعلان الجاهزية (RECOGNIZER_WARMUP=1)
+RECOGNIZER_WARMUP = os.environ.get('RECOGNIZER_WARMUP') == '1'
+
+# محرك التعرف لا يُنشأ عند الاستيراد: يُحمّل في الخلفية عند بدء العامل (start_loading)
+# أو عند أول طلب يحتاجه، وتجيب المسارات بـ 503 حتى يكتمل (و /health/live بـ 200 دائماً)
+recognizer: Optional[PlaceRecognizer] = None
+_load_lock = threading.Lock()
+_load_error: Optional[str] = None
+_loader: Optional[threading.Thread] = None
+_loader_lock = threading.Lock()
+
+
+class RecognizerLoading(RuntimeError):
+    """المحرك لم يكتمل تحميله بعد (أو فشل تحميله وتُعاد المحاولة)"""
+
+
+def create_recognizer() -> PlaceRecognizer:
+    """إنشاء محرك التعرف مع مكوناته الاختيارية من المتغيرات البيئية"""
+    instance = PlaceRecognizer.from_env()
+    # مجمع عمليات استخراج الميزات (EXTRACTION_WORKERS=0 للتعطيل)
+    instance.extraction_pool = ExtractionPool.from_env()
+    # ذاكرة مؤقتة لنتائج التعرف (RESULT_CACHE_SIZE=0 للتعطيل)
+    instance.cache = RecognitionCache.from_env()
+    # جلسات تتبع إطارات الكاميرا (TRACKING_SESSIONS=0 للتعطيل)
+    instance.sessions = TrackingSessions.from_env()
+    # وضع المنسق: توزيع المطابقة على shards بعيدة (SHARD_URLS فارغ = مخزن محلي)
+    instance.shards = ShardedMatcher.from_env()
+    # إضافات عمال gunicorn الآخرين تظهر هنا خلال STORE_POLL_SECONDS (0 للتعطيل)
+    instance.start_store_watch()
+    if RECOGNIZER_WARMUP:
+        instance.warm_up()
+    return instance
+
+
+def get_recognizer() -> PlaceRecognizer:
+    """محرك التعرف، مع تحميله عند أول استدعاء (الاستدعاءات المتزامنة تنتظر نفس التحميل)"""
+    global recognizer, _load_error
+    if recognizer is None:
+        with _load_lock:
+            if recognizer is None:
+                started = time.perf_counter()
+                try:
+                    recognizer = create_recognizer()
+                except Exception as e:
+                    _load_error = str(e)
+                    metrics.ERRORS.inc(operation='startup')
+                    raise
+                _load_error = None
+                print(f"محرك التعرف جاهز بعد {time.perf_counter() - started:.2f} ث")
+    return recognizer
+
+
+def start_loading():
+    """تحميل المحرك في خيط خلفي (من خطاف بدء العامل في gunicorn.conf.py أو عند التشغيل المباشر)
+
+    لا يبدأ خيطاً ثانياً ما دام التحميل جارياً؛ بعد فشل التحميل يعيد المحاولة.
+    """
+    global _loader
+    def load():
+        try:
+            get_recognizer()
+        except Exception as e:
+            print(f"فشل تحميل محرك التعرف: {e}")
+    with _loader_lock:
+        if recognizer is not None or (_loader is not None and _loader.is_alive()):
+            return
+        _loader = threading.Thread(target=load, name="recognizer-load", daemon=True)
+        _loader.start()
+
+
+def loaded_recognizer() -> PlaceRecognizer:
+    """محرك التعرف دون انتظار تحميله: يبدأ التحميل إن لم يبدأ ويرفع RecognizerLoading حتى يكتمل"""
+    if recognizer is None:
+        start_loading()
+        raise RecognizerLoading(_load_error or "محرك التعرف قيد التحميل")
+    return recognizer
+
+
+def service_unavailable(error: str) -> Response:
+    """رد 503 مع Retry-After (تحميل المحرك أو امتلاء طابور الاستخراج)"""
+    response = jsonify({
+        "success": False,
+        "error": error
+    })
+    response.status_code = 503
+    response.headers['Retry-After'] = '1'
+    return response
+
+
+@app.errorhandler(RecognizerLoading)
+def recognizer_loading(e: RecognizerLoading):
+    return service_unavailable(str(e))
+
+
+# ترويسة لإرجاع أزمنة المراحل (بالملي ثانية) في الحقل timings
+DEBUG_TIMINGS_HEADER = 'X-Debug-Timings'
+
+# مقاييس المحرك لا تظهر قبل اكتمال تحميله (الاستثناء في دالة المقياس يُتجاهل)
+metrics.gauge('ar_recognizer_ready', 'Whether the recognizer has finished loading',
+              lambda: int(recognizer is not None))
+metrics.gauge(
+    'ar_reference_descriptors', 'Reference descriptors in the published snapshot',
+    lambda: {mode: int(index.place_sizes.sum()) for mode, index in recognizer.snapshot.indexes.items()},
+    ('mode',)
+)
+metrics.gauge(
+    'ar_reference_descriptor_bytes', 'Size of the memory-mapped reference descriptors',
+    lambda: {
+        mode: sum(block.nbytes for block in blocks.values() if block is not None)
+        for mode, blocks in recognizer.snapshot.descriptors.items()
+    },
+    ('mode',)
+)
+metrics.gauge(
+    'ar_reference_index_bytes', 'Descriptor bytes held in memory by the matching index',
+    lambda: {mode: index.nbytes for mode, index in recognizer.snapshot.indexes.items()},
+    ('mode',)
+)
+metrics.gauge(
+    'ar_reference_images', 'Reference images in the published snapshot',
+    lambda: {mode: sum(len(images) for images in places.values())
+             for mode, places in recognizer.snapshot.images.items()},
+    ('mode',)
+)
+metrics.gauge('ar_snapshot_version', 'Published reference snapshot version',
+              lambda: recognizer.snapshot_version())
+metrics.gauge('ar_result_cache_entries', 'Entries in the recognition result cache',
+              lambda: recognizer.cache.stats()['entries'] if recognizer.cache is not None else None)
+metrics.gauge('ar_result_cache_bytes', 'Estimated size of the recognition result cache',
+              lambda: recognizer.cache.stats()['bytes'] if recognizer.cache is not None else None)
+metrics.gauge('ar_tracking_sessions', 'Active camera tracking sessions',
+              lambda: recognizer.sessions.stats()['sessions'] if recognizer.sessions is not None else None)
+metrics.gauge('ar_extraction_pending', 'Requests admitted to the extraction pool',
+              lambda: recognizer.extraction_pool.pending if recognizer.extraction_pool is not None else None)
+
+
+def with_metrics(endpoint: str):
+    """عدّ الطلبات وقياس زمنها، وإضافة timings للرد عند إرسال ترويسة التصحيح"""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            with metrics.collect_timings() as timings:
+                started = time.perf_counter()
+                response = make_response(view(*args, **kwargs))
+                elapsed = time.perf_counter() - started
+            
+            metrics.REQUEST_SECONDS.observe(elapsed, endpoint=endpoint)
+            metrics.REQUESTS.inc(endpoint=endpoint, status=response.status_code)
+            
+            if request.headers.get(DEBUG_TIMINGS_HEADER) and response.is_json:
+                payload = response.get_json()
+                payload['timings'] = {stage: round(seconds * 1000, 2) for stage, seconds in timings.items()}
+                payload['timings']['total'] = round(elapsed * 1000, 2)
+                response.set_data(app.json.dumps(payload))
+            return response
+        return wrapper
+    return decorator
+
+
+def with_backpressure(view):
+    """رفض الطلبات بـ 503 قبل اكتمال تحميل المحرك أو عندما يمتلئ طابور الاستخراج"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        try:
+            extraction_pool = loaded_recognizer().extraction_pool
+        except RecognizerLoading as e:
+            return service_unavailable(str(e))
+        if extraction_pool is None:
+            return view(*args, **kwargs)
+        try:
+            with extraction_pool.admit():
+                return view(*args, **kwargs)
+        except PoolSaturatedError as e:
+            return service_unavailable(str(e))
+    return wrapper
+
+
+class PayloadError(ValueError):
+    """خطأ في محتوى الطلب مع رمز حالة HTTP"""
+
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.status = status
+
+
+def decode_base64_image(image_data: str) -> bytes:
+    """فك تشفير صورة Base64 (مع أو بدون بادئة data URL)؛ القيمة غير الصالحة خطأ في الطلب (400)"""
+    if not isinstance(image_data, str):
+        raise PayloadError("صورة Base64 غير صالحة")
+    if ',' in image_data:
+        image_data = image_data.split(',')[1]
+    try:
+        return base64.b64decode(image_data)
+    except (binascii.Error, ValueError):
+        raise PayloadError("صورة Base64 غير صالحة")
+
+
+def read_body_stream() -> bytearray:
+    """قراءة جسم الطلب الخام مباشرة إلى مخزن واحد مع فرض حد الحجم أثناء القراءة"""
+    too_large = PayloadError("حجم الصورة أكبر من الحد المسموح", 413)
+    length = request.content_length
+    stream = request.stream
+    
+    if length is not None:
+        if length > MAX_UPLOAD_BYTES:
+            raise too_large
+        # مخزن مسبق الحجم يُملأ في مكانه دون نسخ وسيطة
+        buffer = bytearray(length)
+        view = memoryview(buffer)
+        size = 0
+        while size < length:
+            read = stream.readinto(view[size:])
+            if not read:
+                break
+            size += read
+        view.release()
+        del buffer[size:]
+        return buffer
+    
+    buffer = bytearray()
+    while True:
+        chunk = stream.read(UPLOAD_CHUNK_BYTES)
+        if not chunk:
+            return buffer
+        if len(buffer) + len(chunk) > MAX_UPLOAD_BYTES:
+            raise too_large
+        buffer += chunk
+
+
+def read_image_request(field: str = 'image') -> Tuple[List, dict]:
+    """قراءة الصور ومعاملات الطلب من JSON (Base64) أو multipart أو جسم صورة خام
+
+    تُرجع (قائمة الصور، المعاملات). في الصيغتين الخام و multipart تُقرأ المعاملات من
+    الحقول أو من سلسلة الاستعلام (?min_confidence=0.4&mode=orb&lat=..&lng=..).
+    """
+    with metrics.stage('read'):
+        return _read_image_request(field)
+
+
+def _read_image_request(field: str) -> Tuple[List, dict]:
+    mimetype = request.mimetype or ''
+    try:
+        if mimetype.startswith('image/') or mimetype == 'application/octet-stream':
+            body = read_body_stream()
+            return ([body] if body else []), request.args.to_dict()
+        
+        if mimetype == 'multipart/form-data':
+            data = request.args.to_dict()
+            data.update(request.form.to_dict())
+            images = [upload_buffer(f) for f in request.files.getlist(field)]
+            return [image for image in images if image], data
+        
+        data = request.get_json(silent=True) or {}
+    except RequestEntityTooLarge:
+        raise PayloadError("حجم الطلب أكبر من الحد المسموح", 413)
+    
+    value = data.get(field)
+    if isinstance(value, str):
+        return [decode_base64_image(value)], data
+    if isinstance(value, list):
+        return [decode_base64_image(item) for item in value], data
+    return [], data
+
+
+def parse_min_confidence(data: dict) -> float:
+    try:
+        return float(data.get('min_confidence', 0.3))
+    except (TypeError, ValueError):
+        raise PayloadError("قيمة min_confidence غير صالحة")
+
+
+def parse_location(data: dict):
+    """قراءة موقع العميل الاختياري {"lat", "lng", "accuracy"} من الطلب"""
+    location = data.get('location')
+    if location is None and 'lat' in data:
+        location = data
+    if location is None:
+        return None
+    try:
+        return {
+            "lat": float(location['lat']),
+            "lng": float(location['lng']),
+            "accuracy": float(location.get('accuracy') or 0)
+        }
+    except (KeyError, TypeError, ValueError):
+        raise PayloadError("موقع غير صالح")
+
+
+def serialize_match(result) -> dict:
+    """تحويل نتيجة المطابقة إلى استجابة JSON"""
+    return {
+        "id": result.place_id,
+        "name": result.place_name,
+        "nameAr": result.place_name_ar,
+        "confidence": round(result.confidence * 100, 1),
+        "matchedFeatures": result.matched_features,
+        "description": result.description,
+        "descriptionAr": result.description_ar,
+        "category": result.category,
+        "location": result.location
+    }
+
+
+@app.route('/health/live', methods=['GET'])
+def health_live():
+    """فحص الحياة: العملية تعمل وتستقبل الطلبات (دون انتظار تحميل المحرك)"""
+    return jsonify({
+        "status": "alive",
+        "service": "Riyadh AR Recognition Service"
+    })
 
 
 @app.route('/health', methods=['GET'])
+@app.route('/health/ready', methods=['GET'])
 def health():
-    """فحص صحة الخدمة"""
-    return jsonify({
-        "status": "healthy",
+    """فحص الجاهزية: 503 حتى يكتمل تحميل المخزن ونشر اللقطة الأولى (والتهيئة إن طُلبت)
+
+    في وضع المنسق تُفحص جاهزية الـ shards: degraded إذا فشل بعضها، و 503 إذا فشلت جميعها.
+    """
+    if recognizer is None:
+        start_loading()
+        response = jsonify({
+            "status": "failed" if _load_error else "loading",
+            "service": "Riyadh AR Recognition Service",
+            "error": _load_error
+        })
+        response.status_code = 503
+        response.headers['Retry-After'] = '1'
+        return response
+    
+    status = "healthy"
+    sharding = None
+    if recognizer.shards is not None:
+        shards = recognizer.shards.health()
+        sharding = dict(recognizer.shards.stats(), shards=shards)
+        ready = sum(shard['status'] == 'healthy' for shard in shards)
+        status = "healthy" if ready == len(shards) else "degraded" if ready else "unavailable"
+    response = jsonify({
+        "status": status,
         "service": "Riyadh AR Recognition Service",
-        "version": "1.0.0"
+        "version": "1.0.0",
+        "snapshotVersion": recognizer.snapshot_version(),
+        "sharding": sharding
     })
+    if status == "unavailable":
+        response.status_code = 503
+    return response
 
 
 @app.route('/recognize', methods=['POST'])
+@with_metrics('recognize')
+@with_backpressure
 def recognize_place():
     """التعرف على المكان من صورة"""
+    recognizer = loaded_recognizer()
     try:
-        data = request.get_json()
+        images, data = read_image_request('image')
         
-        if not data or 'image' not in data:
+        if not images:
             return jsonify({
                 "success": False,
                 "error": "لم يتم تقديم صورة"
             }), 400
         
-        # فك تشفير الصورة من Base64
-        image_data = data['image']
-        if ',' in image_data:
-            image_data = image_data.split(',')[1]
+        mode = data.get('mode')
+        if mode is not None and mode not in RECOGNITION_MODES:
+            return jsonify({
+                "success": False,
+                "error": f"وضع التعرف غير مدعوم: {mode}"
+            }), 400
         
-        image_bytes = base64.b64decode(image_data)
+        location = parse_location(data)
         
         # إجراء التعرف
-        min_confidence = data.get('min_confidence', 0.3)
-        result = recognizer.recognize(image_bytes, min_confidence)
+        min_confidence = parse_min_confidence(data)
+        snapshot = recognizer.snapshot
+        session_id = data.get('session_id')
+        tracking = None
+        if session_id:
+            # إطارات كاميرا متتالية: تتبع رخيص بين الإطارات المفتاحية
+            result, tracking = recognizer.recognize_tracked(
+                str(session_id), images[0], min_confidence, mode, location, snapshot
+            )
+        else:
+            result = recognizer.recognize(images[0], min_confidence, mode, location, snapshot)
         
-        if result:
-            return jsonify({
-                "success": True,
-                "recognized": True,
-                "place": {
-                    "id": result.place_id,
-                    "name": result.place_name,
-                    "nameAr": result.place_name_ar,
-                    "confidence": round(result.confidence * 100, 1),
-                    "matchedFeatures": result.matched_features,
-                    "description": result.description,
-                    "descriptionAr": result.description_ar,
-                    "category": result.category,
-                    "location": result.location
+        with metrics.stage('serialize'):
+            if result:
+                payload = {
+                    "success": True,
+                    "recognized": True,
+                    "place": serialize_match(result),
+                    "snapshotVersion": recognizer.snapshot_version(snapshot)
                 }
-            })
-        else:
+            else:
+                payload = {
+                    "success": True,
+                    "recognized": False,
+                    "message": "لم يتم التعرف على المكان",
+                    "snapshotVersion": recognizer.snapshot_version(snapshot)
+                }
+            if tracking is not None:
+                payload["tracking"] = tracking
+            return jsonify(payload)
+            
+    except PayloadError as e:
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), e.status
+    except ExtractionUnavailableError as e:
+        return service_unavailable(str(e))
+    except Exception as e:
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 500
+
+
+@app.route('/recognize/batch', methods=['POST'])
+@with_metrics('recognize_batch')
+@with_backpressure
+def recognize_batch():
+    """التعرف على عدة صور في طلب واحد"""
+    recognizer = loaded_recognizer()
+    try:
+        images, data = read_image_request('images')
+        
+        if not images:
+            return jsonify({
+                "success": False,
+                "error": "لم يتم تقديم صور"
+            }), 400
+        
+        if len(images) > MAX_BATCH_SIZE:
+            return jsonify({
+                "success": False,
+                "error": f"الحد الأقصى لعدد الصور هو {MAX_BATCH_SIZE}"
+            }), 400
+        
+        mode = data.get('mode')
+        if mode is not None and mode not in RECOGNITION_MODES:
+            return jsonify({
+                "success": False,
+                "error": f"وضع التعرف غير مدعوم: {mode}"
+            }), 400
+        
+        location = parse_location(data)
+        
+        min_confidence = parse_min_confidence(data)
+        snapshot = recognizer.snapshot
+        results = recognizer.recognize_batch(images, min_confidence, mode, location, snapshot)
+        
+        with metrics.stage('serialize'):
             return jsonify({
                 "success": True,
-                "recognized": False,
-                "message": "لم يتم التعرف على المكان"
+                "results": [
+                    {"recognized": True, "place": serialize_match(result)} if result
+                    else {"recognized": False}
+                    for result in results
+                ],
+                "snapshotVersion": recognizer.snapshot_version(snapshot)
             })
-            
+        
+    except PayloadError as e:
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), e.status
+    except ExtractionUnavailableError as e:
+        return service_unavailable(str(e))
     except Exception as e:
         return jsonify({
             "success": False,
@@ -78,30 +545,72 @@ def recognize_place():
 
 
 @app.route('/detect-landmarks', methods=['POST'])
+@with_metrics('detect_landmarks')
+@with_backpressure
 def detect_landmarks():
     """اكتشاف المعالم في الصورة"""
+    recognizer = loaded_recognizer()
     try:
-        data = request.get_json()
+        images, _ = read_image_request('image')
         
-        if not data or 'image' not in data:
+        if not images:
             return jsonify({
                 "success": False,
                 "error": "لم يتم تقديم صورة"
             }), 400
         
-        image_data = data['image']
-        if ',' in image_data:
-            image_data = image_data.split(',')[1]
+        landmarks = recognizer.detect_landmarks(images[0])
+        
+        return jsonify({
+            "success": True,
+            "landmarks": landmarks
+        })
+        
+    except PayloadError as e:
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), e.status
+    except Exception as e:
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 500
+
+
+@app.route('/detect-landmarks/batch', methods=['POST'])
+@with_metrics('detect_landmarks_batch')
+@with_backpressure
+def detect_landmarks_batch():
+    """اكتشاف المعالم في عدة صور دفعة واحدة"""
+    recognizer = loaded_recognizer()
+    try:
+        images, _ = read_image_request('images')
+        
+        if not images:
+            return jsonify({
+                "success": False,
+                "error": "لم يتم تقديم صور"
+            }), 400
         
-        image_bytes = base64.b64decode(image_data)
+        if len(images) > MAX_BATCH_SIZE:
+            return jsonify({
+                "success": False,
+                "error": f"الحد الأقصى لعدد الصور هو {MAX_BATCH_SIZE}"
+            }), 400
         
-        landmarks = recognizer.detect_landmarks(image_bytes)
+        results = recognizer.detect_landmarks_batch(images)
         
         return jsonify({
             "success": True,
-            "landmarks": landmarks
+            "results": [{"landmarks": landmarks} for landmarks in results]
         })
         
+    except PayloadError as e:
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), e.status
     except Exception as e:
         return jsonify({
             "success": False,
@@ -110,18 +619,21 @@ def detect_landmarks():
 
 
 @app.route('/add-reference', methods=['POST'])
+@with_metrics('add_reference')
+@with_backpressure
 def add_reference():
     """إضافة صورة مرجعية لمكان"""
+    recognizer = loaded_recognizer()
     try:
-        data = request.get_json()
+        images, data = read_image_request('image')
         
-        if not data or 'image' not in data or 'place_id' not in data:
+        if not images or 'place_id' not in data:
             return jsonify({
                 "success": False,
                 "error": "بيانات ناقصة"
             }), 400
         
-        place_id = data['place_id']
+        place_id = str(data['place_id'])
         
         if place_id not in PLACES_DATA:
             return jsonify({
@@ -129,18 +641,27 @@ def add_reference():
                 "error": "معرف المكان غير صالح"
             }), 400
         
-        image_data = data['image']
-        if ',' in image_data:
-            image_data = image_data.split(',')[1]
-        
-        image_bytes = base64.b64decode(image_data)
+        wait = str(data.get('wait', '')).lower() in ('1', 'true')
+        if recognizer.shards is not None:
+            # المنسق لا يملك مخزناً: الصورة تُضاف في الـ shard المالك للمكان
+            status, payload = recognizer.shards.add_reference(
+                place_id, images[0], PLACES_DATA[place_id]['location'], wait
+            )
+            if recognizer.cache is not None and payload.get('success'):
+                recognizer.cache.clear()
+            return jsonify(payload), status
         
-        success = recognizer.add_reference_image_from_bytes(place_id, image_bytes)
+        version = recognizer.add_reference_image_from_bytes(place_id, images[0])
         
-        if success:
+        if version is not None:
+            # تُنشر الصورة في لقطة جديدة في الخلفية؛ wait=true لانتظار النشر قبل الرد
+            if wait:
+                recognizer.wait_for_snapshot(version, timeout=PUBLISH_WAIT_SECONDS)
             return jsonify({
                 "success": True,
-                "message": f"تم إضافة صورة مرجعية للمكان {PLACES_DATA[place_id]['name_ar']}"
+                "message": f"تم إضافة صورة مرجعية للمكان {PLACES_DATA[place_id]['name_ar']}",
+                "snapshotVersion": version,
+                "published": recognizer.snapshot.version >= version
             })
         else:
             return jsonify({
@@ -148,6 +669,62 @@ def add_reference():
                 "error": "فشل في إضافة الصورة المرجعية"
             }), 400
             
+    except PayloadError as e:
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), e.status
+    except Exception as e:
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 500
+
+
+@with_metrics('shard_match')
+def shard_match():
+    """مطابقة ميزات مستخرجة في المنسق مع مخزن هذا الـ shard (واجهة داخلية)
+
+    الجسم npz من sharding.encode_queries، والمعاملات في سلسلة الاستعلام
+    (mode, min_confidence, lat, lng, accuracy, anchors). يُسجل المسار فقط مع SHARD_SECRET،
+    ويُرفض الطلب دون ترويسة السر نفسه.
+    """
+    if not hmac.compare_digest(request.headers.get(SHARD_SECRET_HEADER, ''), SHARD_SECRET):
+        return jsonify({
+            "success": False,
+            "error": "غير مصرح"
+        }), 403
+    recognizer = loaded_recognizer()
+    try:
+        with metrics.stage('read'):
+            body = read_body_stream()
+        try:
+            query_features = decode_queries(bytes(body))
+        except (ValueError, KeyError, OSError):
+            raise PayloadError("حمولة ميزات غير صالحة")
+        data = request.args.to_dict()
+        mode = data.get('mode')
+        if mode is not None and mode not in RECOGNITION_MODES:
+            return jsonify({
+                "success": False,
+                "error": f"وضع التعرف غير مدعوم: {mode}"
+            }), 400
+        
+        results, version = recognizer.match_features(
+            query_features, parse_min_confidence(data), mode, parse_location(data),
+            with_anchors=data.get('anchors') in ('1', 'true')
+        )
+        return jsonify({
+            "success": True,
+            "results": results,
+            "snapshotVersion": version
+        })
+        
+    except PayloadError as e:
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), e.status
     except Exception as e:
         return jsonify({
             "success": False,
@@ -155,9 +732,42 @@ def add_reference():
         }), 500
 
 
+if SHARD_SECRET:
+    app.add_url_rule(SHARD_MATCH_PATH, view_func=shard_match, methods=['POST'])
+
+
+@app.route('/cache', methods=['GET'])
+def cache_stats():
+    """إحصائيات الذاكرة المؤقتة لنتائج التعرف"""
+    recognizer = loaded_recognizer()
+    return jsonify({
+        "success": True,
+        "enabled": recognizer.cache is not None,
+        "cache": recognizer.cache.stats() if recognizer.cache is not None else None
+    })
+
+
+@app.route('/tracking', methods=['GET'])
+def tracking_stats():
+    """إحصائيات جلسات تتبع الكاميرا"""
+    recognizer = loaded_recognizer()
+    return jsonify({
+        "success": True,
+        "enabled": recognizer.sessions is not None,
+        "tracking": recognizer.sessions.stats() if recognizer.sessions is not None else None
+    })
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """المقاييس بصيغة Prometheus النصية"""
+    return Response(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
+
+
 @app.route('/places', methods=['GET'])
 def get_places():
     """الحصول على قائمة الأماكن"""
+    recognizer = loaded_recognizer()
     return jsonify({
         "success": True,
         "places": recognizer.get_all_places()
@@ -167,6 +777,7 @@ def get_places():
 @app.route('/places/<place_id>', methods=['GET'])
 def get_place(place_id):
     """الحصول على تفاصيل مكان"""
+    recognizer = loaded_recognizer()
     if place_id not in PLACES_DATA:
         return jsonify({
             "success": False,
@@ -174,7 +785,15 @@ def get_place(place_id):
         }), 404
     
     place = PLACES_DATA[place_id]
-    has_reference = place_id in recognizer.reference_descriptors
+    snapshot = recognizer.snapshot
+    try:
+        summary = recognizer.reference_summary(place_id, snapshot)
+    except Exception as e:
+        metrics.ERRORS.inc(operation='shard_places')
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 502
     
     return jsonify({
         "success": True,
@@ -186,9 +805,10 @@ def get_place(place_id):
             "descriptionAr": place["description_ar"],
             "category": place["category"],
             "location": place["location"],
-            "hasReferenceImages": has_reference,
-            "referenceCount": len(recognizer.reference_features.get(place_id, []))
-        }
+            "hasReferenceImages": summary["has_reference_images"],
+            "referenceCount": summary["reference_count"]
+        },
+        "snapshotVersion": recognizer.snapshot_version(snapshot)
     })
 
 
@@ -196,4 +816,6 @@ if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5001))
     print(f"🚀 خدمة التعرف على الأماكن تعمل على المنفذ {port}")
     print(f"📍 عدد الأماكن المسجلة: {len(PLACES_DATA)}")
-    app.run(host='0.0.0.0', port=port, debug=True)
+    start_loading()
+    # خادم التطوير فقط؛ للإنتاج استخدم: gunicorn -c gunicorn.conf.py server:app
+    app.run(host='0.0.0.0', port=port, debug=os.environ.get('FLASK_DEBUG') == '1')
@@ -0,0 +1,384 @@
+"""
+توزيع الأماكن على عدة عمليات تعرف (shards) مع منسق يوزع الاستعلام ويجمع النتائج
+Sharded recognition: places partitioned by hash or geography, scatter-gather over HTTP
+
+كل shard خدمة عادية (server.py) بمجلد مرجعي يحتوي جزءاً من الأماكن. المنسق خدمة عادية
+أيضاً مع SHARD_URLS: يستخرج ميزات الاستعلام مرة واحدة، يرسلها إلى /shard/match في كل
+shard، ويختار أعلى ثقة بين مرشحيها مع تطبيق الحد الأدنى للثقة.
+
+تقسيم مخزن موجود (دون اتصال):
+    python sharding.py --reference-dir reference_images --shards 3 --strategy geo --output shards
+
+ثم تشغيل كل shard على مجلده والمنسق بعناوينها (بنفس السر المشترك):
+    SHARD_SECRET=... REFERENCE_DIR=shards/0 PORT=5101 python server.py   # وكذلك 1 و 2
+    SHARD_SECRET=... SHARD_URLS=http://127.0.0.1:5101,http://127.0.0.1:5102,http://127.0.0.1:5103 python server.py
+"""
+
+import argparse
+import http.client
+import io
+import json
+import math
+import os
+import shutil
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlencode, urlsplit
+
+import numpy as np
+
+import metrics
+from reference_store import KEYPOINT_DTYPE, ReferenceStore, StoreLock, StoreLockedError
+
+SHARD_STRATEGIES = ('hash', 'geo')
+
+# حجم خلية التقسيم الجغرافي بالدرجات (~11 كم عند 0.1)
+SHARD_CELL_DEGREES = float(os.environ.get('SHARD_CELL_DEGREES', 0.1))
+
+# مهلة طلب المطابقة لكل shard
+SHARD_TIMEOUT_MS = int(os.environ.get('SHARD_TIMEOUT_MS', 5000))
+
+SHARD_MATCH_PATH = '/shard/match'
+
+# سر مشترك بين المنسق والـ shards: يُرسل في ترويسة كل طلب داخلي، ودونه لا تُسجل
+# الخدمة مسار /shard/match أصلاً
+SHARD_SECRET = os.environ.get('SHARD_SECRET', '')
+SHARD_SECRET_HEADER = 'X-Shard-Secret'
+
+
+def cell_key(location: Dict, cell_degrees: float = SHARD_CELL_DEGREES) -> str:
+    """معرف خلية الشبكة الجغرافية التي يقع فيها الموقع"""
+    return f"{math.floor(location['lat'] / cell_degrees)}:{math.floor(location['lng'] / cell_degrees)}"
+
+
+def shard_of(key: str, shards: int) -> int:
+    """رقم shard ثابت لمفتاح (crc32 لا يتغير بين العمليات بخلاف hash())"""
+    return zlib.crc32(key.encode('utf-8')) % shards
+
+
+def place_shard(place_id: str, shards: int, strategy: str = 'hash',
+                location: Optional[Dict] = None, cell_degrees: float = SHARD_CELL_DEGREES) -> int:
+    """shard المكان: حسب معرفه، أو حسب خلية موقعه (الأماكن المتجاورة في نفس shard)"""
+    if strategy == 'geo' and location:
+        return shard_of(cell_key(location, cell_degrees), shards)
+    return shard_of(place_id, shards)
+
+
+def nearby_shards(location: Dict, shards: int, cell_degrees: float = SHARD_CELL_DEGREES) -> List[int]:
+    """shards الخلية التي يقع فيها الموقع والخلايا الثماني المحيطة بها"""
+    owners = set()
+    for dlat in (-1, 0, 1):
+        for dlng in (-1, 0, 1):
+            neighbour = {
+                'lat': location['lat'] + dlat * cell_degrees,
+                'lng': location['lng'] + dlng * cell_degrees
+            }
+            owners.add(shard_of(cell_key(neighbour, cell_degrees), shards))
+    return sorted(owners)
+
+
+def encode_queries(query_features: List[Tuple[np.ndarray, np.ndarray]]) -> bytes:
+    """ميزات عدة استعلامات في جسم npz واحد (النقاط والوصفات متتالية مع عدد صفوف كل استعلام)"""
+    buffer = io.BytesIO()
+    np.savez(
+        buffer,
+        counts=np.array([len(descriptors) for _, descriptors in query_features], dtype=np.int64),
+        keypoints=np.concatenate([keypoints for keypoints, _ in query_features]),
+        descriptors=np.vstack([descriptors for _, descriptors in query_features])
+    )
+    return buffer.getvalue()
+
+
+def decode_queries(body: bytes) -> List[Tuple[np.ndarray, np.ndarray]]:
+    """عكس encode_queries"""
+    with np.load(io.BytesIO(body), allow_pickle=False) as data:
+        counts, keypoints, descriptors = data['counts'], data['keypoints'], data['descriptors']
+    if keypoints.dtype != KEYPOINT_DTYPE or len(keypoints) != len(descriptors) or counts.sum() != len(descriptors):
+        raise ValueError("حمولة ميزات غير صالحة")
+    bounds = np.concatenate([[0], np.cumsum(counts)])
+    return [(keypoints[a:b], descriptors[a:b]) for a, b in zip(bounds[:-1], bounds[1:])]
+
+
+class ShardedMatcher:
+    """توزيع المطابقة على عدة shards وجمع أفضل المرشحين
+
+    الاتصالات HTTP تبقى مفتوحة لكل خيط ولكل shard. الـ shard الذي يفشل أو يتجاوز المهلة
+    يُحسب خطأً (ERRORS{operation="shard_match"} وما يماثلها) ويُعامل كأنه بلا نتيجة.
+    آخر رقم لقطة منشورة لكل shard يُحفظ من ردود المطابقة وفحص الجاهزية.
+    """
+
+    def __init__(self, urls: List[str], strategy: str = 'hash',
+                 cell_degrees: float = SHARD_CELL_DEGREES, timeout_ms: int = SHARD_TIMEOUT_MS,
+                 secret: str = SHARD_SECRET):
+        if strategy not in SHARD_STRATEGIES:
+            raise ValueError(f"استراتيجية تقسيم غير معروفة: {strategy}")
+        if not secret:
+            raise ValueError("وضع المنسق يتطلب SHARD_SECRET (نفس القيمة في جميع الـ shards)")
+        self.urls = [url.rstrip('/') for url in urls]
+        self.secret = secret
+        self.strategy = strategy
+        self.cell_degrees = cell_degrees
+        self.timeout = timeout_ms / 1000.0
+        self._executor = ThreadPoolExecutor(max_workers=len(self.urls) * 4, thread_name_prefix="shard")
+        self._local = threading.local()
+        self.versions: List[Optional[int]] = [None] * len(self.urls)
+
+    @classmethod
+    def from_env(cls) -> Optional['ShardedMatcher']:
+        """إنشاء المنسق من SHARD_URLS (فارغ = وضع عادي دون shards)"""
+        urls = [url.strip() for url in os.environ.get('SHARD_URLS', '').split(',') if url.strip()]
+        if not urls:
+            return None
+        return cls(urls, strategy=os.environ.get('SHARD_STRATEGY', 'hash'))
+
+    def owner(self, place_id: str, location: Optional[Dict] = None) -> int:
+        return place_shard(place_id, len(self.urls), self.strategy, location, self.cell_degrees)
+
+    @property
+    def version(self) -> int:
+        """مجموع آخر أرقام لقطات الـ shards (يزيد مع نشر أي إضافة في أي shard)"""
+        return sum(version or 0 for version in self.versions)
+
+    def _connections(self) -> Dict[int, http.client.HTTPConnection]:
+        return self._local.__dict__.setdefault('connections', {})
+
+    def _connection(self, shard: int) -> http.client.HTTPConnection:
+        connections = self._connections()
+        if shard not in connections:
+            parts = urlsplit(self.urls[shard])
+            connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+            connections[shard] = connection_class(parts.netloc, timeout=self.timeout)
+        return connections[shard]
+
+    def _request(self, shard: int, method: str, path: str, params: Optional[Dict] = None,
+                 body: Optional[bytes] = None, content_type: str = 'application/octet-stream',
+                 idempotent: bool = False) -> Tuple[int, Dict]:
+        """طلب HTTP على اتصال الخيط المفتوح
+
+        الطلبات المتكررة الأثر (idempotent) فقط تُعاد مرة واحدة على اتصال جديد إذا أغلق
+        الطرف الآخر الاتصال المفتوح. غيرها (مثل إضافة صورة) قد يكون وصل فلا يُكرر، ويُرسل
+        على اتصال جديد حتى لا يفشل بسبب اتصال خامل أغلقه الطرف الآخر.
+        """
+        target = f"{urlsplit(self.urls[shard]).path.rstrip('/')}{path}"
+        if params:
+            target += f"?{urlencode(params)}"
+        headers = {SHARD_SECRET_HEADER: self.secret}
+        if body is not None:
+            headers['Content-Type'] = content_type
+        attempts = 2 if idempotent else 1
+        if not idempotent and shard in self._connections():
+            self._connections().pop(shard).close()
+        for attempt in range(attempts):
+            connection = self._connection(shard)
+            try:
+                connection.request(method, target, body=body, headers=headers)
+                response = connection.getresponse()
+                return response.status, json.loads(response.read() or b'{}')
+            except Exception as e:
+                # الاتصال بعد أي فشل في حالة غير معروفة فلا يُعاد استخدامه
+                self._connections().pop(shard, None)
+                connection.close()
+                closed = isinstance(e, (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError))
+                if attempt + 1 == attempts or not closed:
+                    raise
+        raise ConnectionError(self.urls[shard])
+
+    def _get(self, shard: int, path: str) -> Dict:
+        status, payload = self._request(shard, 'GET', path, idempotent=True)
+        if status != 200 or not payload.get('success'):
+            raise RuntimeError(f"{self.urls[shard]}{path}: {status} {payload.get('error', '')}")
+        return payload
+
+    def _each_shard(self, operation: str, call: Callable[[int], object],
+                    shards: Optional[List[int]] = None) -> List:
+        """تنفيذ call(shard) على عدة shards بالتوازي؛ الفاشلة أو المتجاوزة للمهلة تُرجع None"""
+        shards = list(range(len(self.urls))) if shards is None else shards
+        futures = {shard: self._executor.submit(call, shard) for shard in shards}
+        wait(futures.values(), timeout=self.timeout)
+        gathered = []
+        for shard, future in futures.items():
+            try:
+                gathered.append(future.result(timeout=0))
+            except Exception as e:
+                future.cancel()
+                metrics.ERRORS.inc(operation=operation)
+                print(f"خطأ في shard {self.urls[shard]}: {e!r}")
+                gathered.append(None)
+        return gathered
+
+    def _match_shard(self, shard: int, body: bytes, params: Dict) -> List[Optional[Dict]]:
+        started = time.perf_counter()
+        status, payload = self._request(shard, 'POST', SHARD_MATCH_PATH, params, body, idempotent=True)
+        metrics.observe_stage(f'shard_{shard}', time.perf_counter() - started)
+        if status != 200 or not payload.get('success'):
+            raise RuntimeError(f"{self.urls[shard]}: {status} {payload.get('error', '')}")
+        self.versions[shard] = payload['snapshotVersion']
+        return payload['results']
+
+    def _scatter(self, shards: List[int], query_features: List[Tuple[np.ndarray, np.ndarray]],
+                 params: Dict) -> List[List[Optional[Dict]]]:
+        """إرسال نفس الاستعلامات إلى عدة shards بالتوازي؛ الفاشلة تُرجع نتائج فارغة"""
+        body = encode_queries(query_features)
+        gathered = self._each_shard('shard_match', lambda shard: self._match_shard(shard, body, params), shards)
+        return [results if results is not None else [None] * len(query_features) for results in gathered]
+
+    def match(self, query_features: List[Optional[Tuple[np.ndarray, np.ndarray]]], min_confidence: float,
+              mode: str, location: Optional[Dict] = None,
+              with_anchors: bool = False) -> List[Optional[Dict]]:
+        """أفضل مرشح لكل استعلام عبر جميع الـ shards (أعلى ثقة فوق min_confidence)
+
+        مع التقسيم الجغرافي وموقع للعميل تُسأل shards الخلايا القريبة أولاً، والباقية فقط
+        للاستعلامات التي لم تُطابق.
+        """
+        results: List[Optional[Dict]] = [None] * len(query_features)
+        params = {'mode': mode, 'min_confidence': min_confidence}
+        if location:
+            params.update(location)
+        if with_anchors:
+            params['anchors'] = 1
+
+        all_shards = list(range(len(self.urls)))
+        rounds = [all_shards]
+        if self.strategy == 'geo' and location:
+            nearby = nearby_shards(location, len(self.urls), self.cell_degrees)
+            rounds = [nearby, [shard for shard in all_shards if shard not in nearby]]
+
+        pending = [i for i, features in enumerate(query_features) if features is not None]
+        for shards in rounds:
+            if not pending or not shards:
+                continue
+            for shard_results in self._scatter(shards, [query_features[i] for i in pending], params):
+                for i, candidate in zip(pending, shard_results):
+                    if candidate is None or candidate['confidence'] < min_confidence:
+                        continue
+                    if results[i] is None or candidate['confidence'] > results[i]['confidence']:
+                        results[i] = candidate
+            pending = [i for i in pending if results[i] is None]
+        return results
+
+    def add_reference(self, place_id: str, image_bytes: bytes, location: Optional[Dict] = None,
+                      wait_for_publish: bool = False) -> Tuple[int, Dict]:
+        """تمرير صورة مرجعية إلى الـ shard المالك للمكان"""
+        params = {'place_id': place_id}
+        if wait_for_publish:
+            params['wait'] = 'true'
+        shard = self.owner(place_id, location)
+        status, payload = self._request(shard, 'POST', '/add-reference', params, image_bytes, 'image/jpeg')
+        payload['shard'] = shard
+        return status, payload
+
+    def places(self) -> List[Optional[List[Dict]]]:
+        """قائمة أماكن كل shard من /places (None للـ shard الفاشل)"""
+        return self._each_shard('shard_places', lambda shard: self._get(shard, '/places')['places'])
+
+    def place(self, place_id: str, location: Optional[Dict] = None) -> Dict:
+        """تفاصيل مكان من الـ shard المالك له"""
+        return self._get(self.owner(place_id, location), f'/places/{place_id}')['place']
+
+    def health(self) -> List[Dict]:
+        """حالة جاهزية كل shard ورقم لقطته المنشورة"""
+        def check(shard: int) -> Dict:
+            status, payload = self._request(shard, 'GET', '/health/ready', idempotent=True)
+            if status == 200:
+                self.versions[shard] = payload.get('snapshotVersion')
+            return {'status': payload.get('status', status), 'snapshotVersion': payload.get('snapshotVersion')}
+
+        return [
+            dict(state or {'status': 'unreachable', 'snapshotVersion': None}, url=url)
+            for url, state in zip(self.urls, self._each_shard('shard_health', check))
+        ]
+
+    def stats(self) -> Dict:
+        return {
+            "shards": self.urls,
+            "strategy": self.strategy,
+            "cellDegrees": self.cell_degrees if self.strategy == 'geo' else None,
+            "timeoutMs": round(self.timeout * 1000)
+        }
+
+
+def _copy_place(source: ReferenceStore, target: ReferenceStore, place_id: str):
+    """نسخ صور مكان كما هي (بنفس نوع الوصفات) إلى مخزن shard"""
+    descriptors = source.load_descriptors(place_id)
+    keypoints = source.load_keypoints(place_id)
+    if descriptors is None:
+        return
+    for image in source.images(place_id):
+        rows = slice(image['offset'], image['offset'] + image['rows'])
+        target.append(place_id, keypoints[rows], descriptors[rows], image['image_path'],
+                      image.get('dhash'), commit=False)
+
+
+def split_reference_dir(reference_images_dir: Path, output_dir: Path, shards: int,
+                        strategy: str = 'hash', cell_degrees: float = SHARD_CELL_DEGREES) -> Dict[str, int]:
+    """تقسيم مجلد مرجعي إلى output_dir/<رقم>/ لكل shard؛ يُرجع {معرف المكان: رقم shard}"""
+    # استيراد متأخر: place_recognition نفسه يستورد هذا الملف
+    from place_recognition import PLACES_DATA
+    from vocabulary import VOCABULARY_DIR, VisualVocabulary
+    from quantization import QUANTIZER_DIR
+
+    reference_images_dir = Path(reference_images_dir)
+    output_dir = Path(output_dir)
+    with StoreLock(reference_images_dir, exclusive=False):
+        sources = {
+            'store': ReferenceStore(reference_images_dir / "store"),
+            'store_orb': ReferenceStore(reference_images_dir / "store_orb", dim=32, dtype=np.uint8)
+        }
+        places = sorted(set(sources['store'].places()) | set(sources['store_orb'].places()))
+        assignment = {
+            place_id: place_shard(place_id, shards, strategy,
+                                  PLACES_DATA.get(place_id, {}).get('location'), cell_degrees)
+            for place_id in places
+        }
+
+        vocabulary = VisualVocabulary.load(reference_images_dir)
+        for shard in range(shards):
+            shard_dir = output_dir / str(shard)
+            if shard_dir.exists():
+                raise FileExistsError(f"المجلد موجود: {shard_dir}")
+            for name, source in sources.items():
+                target = ReferenceStore(shard_dir / name, dim=source.dim, dtype=source.dtype)
+                for place_id in places:
+                    if assignment[place_id] == shard:
+                        _copy_place(source, target, place_id)
+                target.commit()
+
+            # الكلمات البصرية والمكمم مشتركة؛ متجهات الصور تُبنى من مخزن الـ shard
+            if vocabulary is not None:
+                shard_vocabulary = VisualVocabulary(shard_dir / VOCABULARY_DIR, vocabulary.words)
+                shard_vocabulary.root.mkdir(parents=True, exist_ok=True)
+                np.save(shard_vocabulary.root / "words.npy", vocabulary.words)
+                shard_vocabulary.reindex(ReferenceStore(shard_dir / "store"))
+            if (reference_images_dir / QUANTIZER_DIR).exists():
+                shutil.copytree(reference_images_dir / QUANTIZER_DIR, shard_dir / QUANTIZER_DIR)
+
+            owned = [place_id for place_id in places if assignment[place_id] == shard]
+            print(f"shard {shard}: {len(owned)} مكان ({', '.join(owned)})")
+        return assignment
+
+
+def main():
+    parser = argparse.ArgumentParser(description="تقسيم المخزن المرجعي على عدة shards")
+    parser.add_argument('--reference-dir', default="reference_images", help="مجلد الصور المرجعية")
+    parser.add_argument('--output', required=True, help="مجلد الإخراج (مجلد فرعي لكل shard)")
+    parser.add_argument('--shards', type=int, required=True, help="عدد الـ shards")
+    parser.add_argument('--strategy', choices=SHARD_STRATEGIES, default='hash',
+                        help="hash حسب معرف المكان، أو geo حسب خلية الموقع")
+    parser.add_argument('--cell-degrees', type=float, default=SHARD_CELL_DEGREES,
+                        help="حجم خلية التقسيم الجغرافي بالدرجات (يجب أن يطابق SHARD_CELL_DEGREES في المنسق)")
+    args = parser.parse_args()
+
+    if args.shards < 1:
+        parser.error("عدد الـ shards يجب أن يكون 1 على الأقل")
+    try:
+        split_reference_dir(Path(args.reference_dir), Path(args.output), args.shards, args.strategy, args.cell_degrees)
+    except StoreLockedError as e:
+        parser.exit(1, f"{e}\n")
+
+
+if __name__ == '__main__':
+    main()
@@ -40,4 +40,11 @@ echo ""
 echo "للإيقاف اضغط Ctrl+C"
 echo "========================================"
 
-python3 server.py
+if [ "$FLASK_DEBUG" = "1" ]; then
+    python3 server.py
+elif [ "$SERVER_MODE" = "asgi" ]; then
+    # خادم غير متزامن مع تجميع طلبات التعرف
+    exec gunicorn -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker asgi:app
+else
+    exec gunicorn -c gunicorn.conf.py server:app
+fi
@@ -0,0 +1,61 @@
+"""
+أدوات مشتركة للاختبارات: صور اصطناعية غنية بالنقاط المميزة ومحرك تعرف على مجلد مؤقت
+Shared fixtures: synthetic textured images and a recognizer over a temporary reference directory
+"""
+
+import sys
+from pathlib import Path
+
+import cv2
+import numpy as np
+import pytest
+
+# ملفات الخدمة وحدات مستقلة في مجلدها (دون حزمة)
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from place_recognition import PlaceRecognizer  # noqa: E402
+
+
+def textured_image(seed: int, size=(480, 640)) -> np.ndarray:
+    """صورة من أشكال عشوائية متداخلة (زوايا وحواف كافية لـ SIFT و ORB)"""
+    rng = np.random.default_rng(seed)
+    height, width = size
+    image = np.full((height, width, 3), 255, dtype=np.uint8)
+    for _ in range(80):
+        color = tuple(int(c) for c in rng.integers(0, 256, 3))
+        x, y = int(rng.integers(0, width)), int(rng.integers(0, height))
+        if rng.random() < 0.5:
+            w, h = int(rng.integers(10, 120)), int(rng.integers(10, 120))
+            cv2.rectangle(image, (x, y), (x + w, y + h), color, -1)
+        else:
+            cv2.circle(image, (x, y), int(rng.integers(5, 60)), color, -1)
+    return image
+
+
+def encode_jpeg(image: np.ndarray) -> bytes:
+    return cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, 95])[1].tobytes()
+
+
+def view_of(image: np.ndarray) -> bytes:
+    """لقطة أخرى للمشهد نفسه: قص وتحجيم"""
+    height, width = image.shape[:2]
+    crop = image[height // 10:height - height // 10, width // 10:width - width // 10]
+    return encode_jpeg(cv2.resize(crop, (width * 3 // 4, height * 3 // 4)))
+
+
+@pytest.fixture(scope='session')
+def scenes():
+    """صورة مرجعية لكل من الأماكن 1 و 2 و 3"""
+    return {place_id: textured_image(seed) for seed, place_id in enumerate(('1', '2', '3'))}
+
+
+@pytest.fixture
+def recognizer(tmp_path, scenes):
+    """محرك تعرف (دون مجمع عمليات أو ذاكرة مؤقتة) بمرجع للمكانين 1 و 2"""
+    instance = PlaceRecognizer(str(tmp_path / "reference_images"), default_mode='sift')
+    for place_id in ('1', '2'):
+        version = instance.add_reference_image_from_bytes(place_id, encode_jpeg(scenes[place_id]))
+        assert version is not None
+    assert instance.wait_for_snapshot(version, timeout=30)
+    yield instance
+    instance.store_lock.release()
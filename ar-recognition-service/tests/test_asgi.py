@@ -0,0 +1,158 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('starlette')
+
+import asgi  # noqa: E402
+from asgi import DEADLINE_HEADER, RequestCoalescer  # noqa: E402
+from place_recognition import RecognitionQuery  # noqa: E402
+from starlette.requests import Request  # noqa: E402
+
+
+class FakeRecognizer:
+    """يسجل الدفعات ويُرجع "الوضع:الصورة" لكل استعلام (أو None للصور التي تبدأ بـ miss)"""
+    default_mode = 'sift'
+    snapshot = object()
+
+    def __init__(self):
+        self.batches = []
+        self.release = threading.Event()
+        self.release.set()
+        self.error = None
+
+    def snapshot_version(self, snapshot):
+        return 7
+
+    def recognize_queries(self, queries, mode, snapshot):
+        self.release.wait(5)
+        if self.error is not None:
+            raise self.error
+        images = [bytes(query.image_bytes).decode() for query in queries]
+        self.batches.append((mode, images))
+        return [None if image.startswith('miss') else f'{mode}:{image}' for image in images]
+
+
+@pytest.fixture
+def fake():
+    return FakeRecognizer()
+
+
+def query(image: str, deadline=None) -> RecognitionQuery:
+    return RecognitionQuery(image.encode(), 0.3, None, deadline)
+
+
+def test_requests_within_window_share_one_batch_per_mode(fake):
+    async def main():
+        coalescer = RequestCoalescer(lambda: fake, window_ms=50, max_batch=16, threads=1)
+        first = coalescer.submit([query('a')], 'sift')
+        second = coalescer.submit([query('b'), query('c')], 'sift')
+        orb = coalescer.submit([query('d')], 'orb')
+        return await asyncio.gather(first, second, orb)
+
+    first, second, orb = asyncio.run(main())
+    assert sorted(fake.batches) == [('orb', ['d']), ('sift', ['a', 'b', 'c'])]
+    assert first[:2] == (['sift:a'], 7) and second[0] == ['sift:b', 'sift:c']
+    assert (first[3], second[3], orb[3]) == (3, 3, 1)
+    assert first[2]['coalesce_wait'] >= 0.04
+
+
+def test_full_batch_is_dispatched_without_waiting_for_window(fake):
+    async def main():
+        coalescer = RequestCoalescer(lambda: fake, window_ms=10000, max_batch=2, threads=1)
+        futures = [coalescer.submit([query('a')], 'sift'), coalescer.submit([query('b')], 'sift')]
+        return await asyncio.wait_for(asyncio.gather(*futures), 2)
+
+    results = asyncio.run(main())
+    assert [result[0] for result in results] == [['sift:a'], ['sift:b']]
+
+
+def test_expired_and_cancelled_requests_are_not_dispatched(fake):
+    async def main():
+        coalescer = RequestCoalescer(lambda: fake, window_ms=20, max_batch=16, threads=1)
+        expired = coalescer.submit([query('late', deadline=time.monotonic() - 1)], 'sift')
+        gone = coalescer.submit([query('gone')], 'sift')
+        gone.cancel()
+        live = coalescer.submit([query('live'), query('late', deadline=0.0)], 'sift')
+        only_expired = coalescer.submit([query('late', deadline=0.0)], 'orb')
+        return await expired, await live, await only_expired
+
+    expired, live, only_expired = asyncio.run(main())
+    assert expired is None and only_expired is None
+    # الطلب الحي يُرسل كاملاً، والتحقق من مهلة كل استعلام يتم في recognize_queries
+    assert fake.batches == [('sift', ['live', 'late'])]
+    assert live[3] == 2
+
+
+def test_batch_failure_reaches_every_waiting_request(fake):
+    fake.error = RuntimeError("boom")
+
+    async def main():
+        coalescer = RequestCoalescer(lambda: fake, window_ms=10, max_batch=16, threads=1)
+        futures = [coalescer.submit([query('a')], 'sift'), coalescer.submit([query('b')], 'sift')]
+        return await asyncio.gather(*futures, return_exceptions=True)
+
+    assert [str(result) for result in asyncio.run(main())] == ['boom', 'boom']
+
+
+def run_request(coalescer, headers=(), disconnect=False, linger=0.0):
+    """تشغيل coalesced_recognize بطلب صورة خام؛ العميل ينقطع فور إرسال الجسم إذا طُلب
+
+    linger: مدة إبقاء الحلقة بعد الرد حتى تنتهي نافذة التجميع.
+    """
+    async def main():
+        sent = False
+
+        async def receive():
+            nonlocal sent
+            if not sent:
+                sent = True
+                return {'type': 'http.request', 'body': b'miss-frame', 'more_body': False}
+            if disconnect:
+                return {'type': 'http.disconnect'}
+            await asyncio.sleep(3600)
+
+        scope = {
+            'type': 'http', 'method': 'POST', 'path': '/recognize', 'query_string': b'mode=sift',
+            'headers': [(b'content-type', b'image/jpeg')] + [(k.lower().encode(), v.encode()) for k, v in headers],
+        }
+        asgi.coalescer = coalescer
+        response = await asgi.coalesced_recognize(Request(scope, receive), 'image')
+        await asyncio.sleep(linger)
+        return response
+    return asyncio.run(main())
+
+
+@pytest.fixture
+def restore_coalescer():
+    original = asgi.coalescer
+    yield
+    asgi.coalescer = original
+
+
+def test_coalesced_request_round_trip(fake, restore_coalescer):
+    payload, status, timings = run_request(RequestCoalescer(lambda: fake, window_ms=5, threads=1))
+    assert status == 200
+    assert payload == {'success': True, 'recognized': False, 'message': 'لم يتم التعرف على المكان',
+                       'snapshotVersion': 7}
+    assert timings['batchSize'] == 1
+
+
+def test_client_disconnect_cancels_queued_work(fake, restore_coalescer):
+    coalescer = RequestCoalescer(lambda: fake, window_ms=50, threads=1)
+    payload, status, _ = run_request(coalescer, disconnect=True, linger=0.2)
+    assert status == 504 and payload['success'] is False
+    # الطلب أُلغي قبل انتهاء النافذة فلا يصل للمحرك
+    assert fake.batches == []
+
+
+def test_deadline_header_bounds_the_wait(fake, restore_coalescer):
+    fake.release.clear()
+    started = time.monotonic()
+    payload, status, _ = run_request(RequestCoalescer(lambda: fake, window_ms=5, threads=1),
+                                     headers=[(DEADLINE_HEADER, '100')])
+    assert status == 504
+    assert time.monotonic() - started < 1
+    fake.release.set()
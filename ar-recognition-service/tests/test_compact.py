@@ -0,0 +1,123 @@
+import numpy as np
+import pytest
+
+import place_recognition
+from budget import MIN_REFERENCE_ROWS, append_quotas
+from compact import image_quotas, row_owners, select_rows
+from conftest import encode_jpeg, textured_image, view_of
+from reference_store import ReferenceStore
+from vocabulary import VisualVocabulary
+
+
+def owners_for(sizes):
+    images = []
+    offset = 0
+    for rows in sizes:
+        images.append({'offset': offset, 'rows': rows})
+        offset += rows
+    return row_owners(images, offset)
+
+
+def test_image_quotas_redistribute_unused_share():
+    np.testing.assert_array_equal(image_quotas(np.array([100, 100, 100]), 90), [30, 30, 30])
+    # الصورة الصغيرة تأخذ كل صفوفها وما يتبقى يذهب للباقي
+    np.testing.assert_array_equal(image_quotas(np.array([100, 12, 100]), 90), [39, 12, 39])
+    np.testing.assert_array_equal(image_quotas(np.array([20, 30]), 200), [20, 30])
+
+
+def test_select_rows_keeps_highest_scores_within_quota():
+    sizes = [40, 40, 15]
+    owners = owners_for(sizes)
+    scores = np.random.default_rng(0).random(len(owners))
+    keep = select_rows(scores, np.zeros(len(owners)), owners, len(sizes), 60)
+
+    assert sorted(keep) == [0, 1, 2]
+    assert {i: len(rows) for i, rows in keep.items()} == {0: 22, 1: 23, 2: 15}
+    for i, rows in keep.items():
+        assert np.all(owners[rows] == i)
+        assert np.all(np.diff(rows) > 0)
+        others = np.setdiff1d(np.flatnonzero(owners == i), rows)
+        if len(others):
+            assert scores[rows].min() >= scores[others].max()
+
+
+def test_select_rows_drops_small_and_redundant_images_first():
+    sizes = [30, 30, 30, MIN_REFERENCE_ROWS - 1]
+    owners = owners_for(sizes)
+    repeats = np.zeros(len(owners))
+    repeats[owners == 1] = 3  # الصورة 1 مكررة في صور المكان الأخرى
+    keep = select_rows(np.ones(len(owners)), repeats, owners, len(sizes), 2 * MIN_REFERENCE_ROWS)
+
+    # ميزانية تكفي صورتين: تُحذف الأكثر تكراراً، والصورة الأصغر من الحد الأدنى لا تُحتفظ بها
+    assert sorted(keep) == [0, 2]
+    assert all(len(rows) == MIN_REFERENCE_ROWS for rows in keep.values())
+
+
+def test_select_rows_rejects_budget_below_minimum():
+    owners = owners_for([30])
+    with pytest.raises(ValueError):
+        select_rows(np.ones(30), np.zeros(30), owners, 1, MIN_REFERENCE_ROWS - 1)
+
+
+def test_append_quotas_share_budget_with_the_new_image():
+    np.testing.assert_array_equal(append_quotas(np.array([40, 30]), np.zeros(1), 100), [40, 30])
+    np.testing.assert_array_equal(append_quotas(np.array([100, 100, 100]), np.zeros(2), 90), [30, 30, 30])
+
+
+def test_append_quotas_evict_least_matched_then_oldest_images():
+    sizes = np.array([30, 30, 30, 30])
+    # ميزانية تكفي صورتين: تبقى الصورة الجديدة والقديمة الأكثر مطابقة
+    np.testing.assert_array_equal(
+        append_quotas(sizes, np.array([0, 5, 0]), 2 * MIN_REFERENCE_ROWS),
+        [0, MIN_REFERENCE_ROWS, 0, MIN_REFERENCE_ROWS]
+    )
+    # دون مطابقات تُحذف الأقدم أولاً
+    np.testing.assert_array_equal(
+        append_quotas(sizes, np.zeros(3), 3 * MIN_REFERENCE_ROWS),
+        [0, MIN_REFERENCE_ROWS, MIN_REFERENCE_ROWS, MIN_REFERENCE_ROWS]
+    )
+
+
+def test_service_append_keeps_place_within_budget(recognizer, scenes, monkeypatch):
+    root = recognizer.reference_images_dir
+    vocabulary = VisualVocabulary(root / "vocabulary", np.random.default_rng(0).random((16, 128)).astype(np.float32) * 64)
+    vocabulary.root.mkdir()
+    np.save(vocabulary.root / "words.npy", vocabulary.words)
+    vocabulary.reindex(recognizer.store)
+    recognizer.vocabulary = vocabulary
+
+    budget = recognizer.store.images('1')[0]['rows']
+    monkeypatch.setattr(place_recognition, 'PLACE_DESCRIPTOR_BUDGET', budget)
+    # مطابقة ناجحة تسجل الصفوف المتوافقة حتى تبقى عند تقليص الصورة
+    assert recognizer.recognize(view_of(scenes['1'])).place_id == '1'
+    hit_rows = np.flatnonzero(recognizer._place_hits('sift', '1'))
+    assert len(hit_rows) > 0
+    hit_x = np.array(recognizer.snapshot.keypoints('sift', '1')['x'][hit_rows])
+
+    version = recognizer.add_reference_image_from_bytes('1', encode_jpeg(textured_image(10)))
+    assert version is not None
+    store = ReferenceStore(root / "store")
+    images = store.images('1')
+    assert len(images) == 2
+    assert sum(image['rows'] for image in images) <= budget
+    assert store.manifest['places']['1']['generation'] == 1
+    assert not (root / "store" / "1" / "descriptors.bin").exists()
+    assert len(recognizer._place_hits('sift', '1')) == store.manifest['places']['1']['rows']
+    assert recognizer._place_hits('sift', '1').sum() > 0
+
+    # الصفوف التي طابقت بقيت في الجيل الجديد
+    assert np.isin(hit_x, store.load_keypoints('1')['x'][:images[0]['rows']]).all()
+    orb_store = ReferenceStore(root / "store_orb", dim=32, dtype=np.uint8)
+    assert orb_store.manifest['places']['1']['rows'] <= budget
+
+    # متجهات المفردات أُعيد بناؤها لمقاطع المكان الجديدة
+    reloaded = VisualVocabulary.load(root)
+    assert sorted(image for image in reloaded.images if image[0] == '1') == [
+        ('1', image['offset'], image['rows']) for image in images
+    ]
+
+    assert recognizer.wait_for_snapshot(version, timeout=30)
+    assert int(recognizer.snapshot.indexes['sift'].place_sizes.sum()) == sum(
+        store.manifest['places'][place_id]['rows'] for place_id in store.places()
+    )
+    assert recognizer.recognize(view_of(scenes['1'])).place_id == '1'
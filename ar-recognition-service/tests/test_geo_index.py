@@ -0,0 +1,49 @@
+from conftest import view_of
+from geo_index import GeoIndex
+from place_recognition import PLACES_DATA
+
+# إزاحات شمالاً من (24, 46): درجة العرض ≈ 111.2 كم
+PLACES = {
+    'a': {'location': {'lat': 24.0, 'lng': 46.0}},
+    'b': {'location': {'lat': 24.005, 'lng': 46.0}},    # ~0.56 كم
+    'c': {'location': {'lat': 24.03, 'lng': 46.0}},     # ~3.3 كم
+    'd': {'location': {'lat': 24.25, 'lng': 46.0}},     # ~28 كم
+    'e': {'location': {'lat': 26.0, 'lng': 46.0}},      # ~222 كم
+    'no-location': {},
+}
+
+
+def test_within_uses_haversine_metres():
+    index = GeoIndex(PLACES)
+    assert index.place_ids == ['a', 'b', 'c', 'd', 'e']
+    assert index.within(24.0, 46.0, 500) == ['a']
+    assert index.within(24.0, 46.0, 600) == ['a', 'b']
+    assert index.within(24.0, 46.0, 30000) == ['a', 'b', 'c', 'd']
+
+
+def test_candidate_sets_widen_then_fall_back_to_all_places():
+    index = GeoIndex(PLACES)
+    location = {'lat': 24.0, 'lng': 46.0}
+    # 1 كم ثم 4 كم؛ 16 كم لا يضيف جديداً فلا يُكرر، و 64 كم تتجاوز الحد الأقصى
+    assert list(index.candidate_sets(location)) == [['a', 'b'], ['a', 'b', 'c'], None]
+    # الدقة تحدد نصف القطر الأول (2 × accuracy)
+    assert list(index.candidate_sets(dict(location, accuracy=1000))) == [
+        ['a', 'b'], ['a', 'b', 'c'], ['a', 'b', 'c', 'd'], None
+    ]
+
+
+def test_candidate_sets_without_nearby_places():
+    index = GeoIndex(PLACES)
+    assert list(index.candidate_sets(None)) == [None]
+    assert list(index.candidate_sets({'lat': 10.0, 'lng': 10.0})) == [None]
+    # نطاق يشمل جميع الأماكن لا يختلف عن البحث دون موقع
+    assert list(GeoIndex({'a': PLACES['a'], 'b': PLACES['b']}).candidate_sets({'lat': 24.0, 'lng': 46.0})) == [None]
+    assert list(GeoIndex({}).candidate_sets({'lat': 24.0, 'lng': 46.0})) == [None]
+
+
+def test_recognition_falls_back_when_nearby_places_do_not_match(recognizer, scenes):
+    near_two = dict(PLACES_DATA['2']['location'], accuracy=10)
+    match = recognizer.recognize(view_of(scenes['1']), min_confidence=0.1, location=near_two)
+    assert match is not None and match.place_id == '1'
+    match = recognizer.recognize(view_of(scenes['2']), min_confidence=0.1, location=near_two)
+    assert match is not None and match.place_id == '2'
@@ -0,0 +1,108 @@
+import cv2
+import numpy as np
+import pytest
+
+from budget import MIN_REFERENCE_ROWS
+from conftest import encode_jpeg, textured_image
+from ingest import _budget, ingest_directory, recover
+from reference_store import ReferenceStore, StoreLock, StoreLockedError
+from test_reference_store import make_block
+from vocabulary import VisualVocabulary
+
+
+def orb_block(rows, seed):
+    keypoints, descriptors = make_block(rows, seed, dim=32)
+    return keypoints, descriptors.astype(np.uint8)
+
+
+@pytest.fixture
+def stores(tmp_path):
+    return (ReferenceStore(tmp_path / "store"),
+            ReferenceStore(tmp_path / "store_orb", dim=32, dtype=np.uint8))
+
+
+def test_recover_drops_orb_images_whose_sift_commit_was_lost(tmp_path, stores):
+    store, orb_store = stores
+    store.append('1', *make_block(20, 0), 'a.jpg', image_hash=1)
+    store.append('1', *make_block(20, 1), 'a.jpg', image_hash=1)
+    # إدخال توقف بعد نشر ORB وقبل نشر SIFT: b.jpg ونسخة ثالثة من a.jpg في ORB فقط
+    orb_store.append('1', *orb_block(15, 0), 'a.jpg', image_hash=1)
+    orb_store.append('1', *orb_block(15, 1), 'b.jpg', image_hash=2)
+    orb_store.append('1', *orb_block(15, 2), 'a.jpg', image_hash=1)
+    orb_store.append('1', *orb_block(15, 3), 'a.jpg', image_hash=1)
+    orb_store.append('2', *orb_block(15, 4), 'c.jpg', image_hash=3)
+
+    assert recover(store, orb_store, None) == {'orb_dropped': 3, 'vocabulary_added': 0}
+    reopened = ReferenceStore(tmp_path / "store_orb", dim=32, dtype=np.uint8)
+    assert [(i['image_path'], i['offset']) for i in reopened.images('1')] == [('a.jpg', 0), ('a.jpg', 15)]
+    np.testing.assert_array_equal(reopened.load_descriptors('1')[15:], orb_block(15, 2)[1])
+    assert reopened.images('2') == []
+    assert sorted(p.name for p in (tmp_path / "store_orb" / "1").iterdir()) == ['descriptors.1.bin', 'keypoints.1.bin']
+
+    assert recover(store, reopened, None) == {'orb_dropped': 0, 'vocabulary_added': 0}
+
+
+def test_recover_adds_published_sift_images_to_vocabulary(tmp_path, stores):
+    store, orb_store = stores
+    root = tmp_path / "vocabulary"
+    root.mkdir()
+    vocabulary = VisualVocabulary(root, np.random.default_rng(0).random((8, 128)).astype(np.float32) * 255)
+    store.append('1', *make_block(20, 0), 'a.jpg')
+    vocabulary.sync(store)
+    # توقف بعد نشر SIFT وقبل كتابة المفردات
+    store.append('1', *make_block(20, 1), 'b.jpg')
+    store.append('2', *make_block(20, 2), 'c.jpg')
+
+    assert recover(store, orb_store, vocabulary) == {'orb_dropped': 0, 'vocabulary_added': 2}
+    assert sorted(vocabulary.images) == [('1', 0, 20), ('1', 20, 20), ('2', 0, 20)]
+    assert recover(store, orb_store, vocabulary)['vocabulary_added'] == 0
+
+
+def test_budget_shares_what_is_left_of_the_place():
+    images = [None] * 4
+    assert _budget(images, 0, None) == [None] * 4
+    assert _budget(images, 100, 500) == [100] * 4
+    # لا تكفي الحد الأدنى لكل صورة: أول الصور فقط
+    assert _budget(images, 470, 500) == [MIN_REFERENCE_ROWS] * 3 + [0]
+    assert _budget(images, 600, 500) == [0] * 4
+
+
+def test_ingest_directory_dedupes_and_reports(tmp_path):
+    source = tmp_path / "photos"
+    for place_id in ('1', '2'):
+        (source / place_id).mkdir(parents=True)
+    image = textured_image(0)
+    (source / '1' / 'a.jpg').write_bytes(encode_jpeg(image))
+    # نسخة بجودة أقل من الصورة نفسها تُستبعد كشبه مكررة
+    (source / '1' / 'b.jpg').write_bytes(cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, 60])[1].tobytes())
+    (source / '2' / 'c.png').write_bytes(cv2.imencode('.png', textured_image(1))[1].tobytes())
+    (source / '2' / 'broken.jpg').write_bytes(b'not an image')
+    (source / '2' / 'notes.txt').write_text('ignored')
+
+    root = tmp_path / "reference_images"
+    report = ingest_directory(source, root, workers=1, max_descriptors=300)
+    assert (report['images'], report['added'], report['duplicates']) == (4, 2, 1)
+    assert report['failed'] == [str(source / '2' / 'broken.jpg')]
+
+    store = ReferenceStore(root / "store")
+    assert sorted(store.places()) == ['1', '2']
+    assert all(store.manifest['places'][p]['rows'] <= 300 for p in store.places())
+    assert all('dhash' in image for p in store.places() for image in store.images(p))
+
+    # إعادة الإدخال لا تضيف الصور الموجودة في المخزن
+    again = ingest_directory(source, root, workers=1)
+    assert (again['added'], again['duplicates']) == (0, 3)
+
+
+def test_ingest_directory_refuses_unknown_places_and_locked_store(tmp_path):
+    source = tmp_path / "photos"
+    (source / 'nowhere').mkdir(parents=True)
+    (source / 'nowhere' / 'a.jpg').write_bytes(encode_jpeg(textured_image(0)))
+    with pytest.raises(ValueError):
+        ingest_directory(source, tmp_path / "reference_images")
+
+    (source / 'nowhere').rename(source / '1')
+    (tmp_path / "reference_images").mkdir()
+    with StoreLock(tmp_path / "reference_images", exclusive=False):
+        with pytest.raises(StoreLockedError):
+            ingest_directory(source, tmp_path / "reference_images")
@@ -0,0 +1,102 @@
+import numpy as np
+import pytest
+
+from quantization import PQ_CENTROIDS, ProductQuantizer, QuantizedIndex, train_quantizer
+from reference_store import ReferenceStore
+from test_reference_store import make_block
+
+
+@pytest.fixture(scope='module')
+def trained(tmp_path_factory):
+    """مخزن بثلاثة أماكن عشوائية ومكمم مدرب عليه (4 قوائم، 8 فضاءات جزئية)"""
+    root = tmp_path_factory.mktemp("reference_images")
+    store = ReferenceStore(root / "store")
+    blocks = {}
+    for seed, place_id in enumerate('123'):
+        keypoints, descriptors = make_block(200, seed)
+        store.append(place_id, keypoints[:100], descriptors[:100], 'a.jpg')
+        store.append(place_id, keypoints[100:], descriptors[100:], 'b.jpg')
+        blocks[place_id] = descriptors
+    quantizer = train_quantizer(root, lists=4, subspaces=8, sample_size=600)
+    return root, quantizer, blocks
+
+
+def perturbed(block, rows, seed=0):
+    rng = np.random.default_rng(seed)
+    return block[rows] + rng.normal(0, 2, (len(rows), block.shape[1])).astype(np.float32)
+
+
+def make_index(quantizer, blocks):
+    index = QuantizedIndex(quantizer, probes=quantizer.lists, rerank=16)
+    index.build(blocks)
+    return index
+
+
+def test_trained_quantizer_round_trips_and_shapes(trained):
+    root, quantizer, blocks = trained
+    loaded = ProductQuantizer.load(root)
+    np.testing.assert_array_equal(loaded.coarse, quantizer.coarse)
+    np.testing.assert_array_equal(loaded.codebooks, quantizer.codebooks)
+    assert (loaded.lists, loaded.subspaces, loaded.dim) == (4, 8, 128)
+    assert ProductQuantizer.load(root / "missing") is None
+
+    vectors = blocks['1'][:10]
+    assert quantizer.encode(vectors).shape == (10, 8)
+    assert quantizer.encode(vectors).dtype == np.uint8
+    assert quantizer.probe(vectors, 2).shape == (10, 2)
+    assert quantizer.probe(vectors, 99).shape == (10, 4)
+    assert quantizer.tables(vectors).shape == (10, 8, PQ_CENTROIDS)
+
+
+def test_train_rejects_too_few_descriptors(tmp_path):
+    ReferenceStore(tmp_path / "store").append('1', *make_block(50, 0), 'a.jpg')
+    with pytest.raises(ValueError):
+        train_quantizer(tmp_path, lists=4, subspaces=8, sample_size=50)
+
+
+def test_vote_finds_the_source_rows(trained):
+    _, quantizer, blocks = trained
+    index = make_index(quantizer, blocks)
+    assert index.nbytes < sum(block.nbytes for block in blocks.values()) / 10
+
+    rows = np.arange(0, 200, 5)
+    votes, counts, good = index.vote([perturbed(blocks['2'], rows), None])
+    assert counts.tolist() == [40, 0]
+    assert index.place_ids[int(np.argmax(votes[0]))] == '2'
+    assert votes[0].sum() >= 36
+    assert not votes[1].any()
+    label = index.place_ids.index('2')
+    assert np.all(good[:, 2] == label)
+    np.testing.assert_array_equal(good[:, 3], rows[good[:, 1]])
+
+
+def test_candidates_restrict_places_and_segments(trained):
+    _, quantizer, blocks = trained
+    index = make_index(quantizer, blocks)
+    query = perturbed(blocks['1'], np.arange(200))
+
+    votes, _, _ = index.vote([query], candidates=['2', '3'])
+    assert votes[0][index.place_ids.index('1')] == 0
+
+    # مقطع الصورة الثانية فقط: كل المطابقات من صفوفها
+    votes, _, good = index.vote([query], candidates=[('1', 100, 100)])
+    assert votes[0][index.place_ids.index('1')] >= 90
+    assert good[:, 3].min() >= 100
+    np.testing.assert_array_equal(good[:, 3], good[:, 1])
+
+    votes, _, good = index.vote([query], candidates=['unknown'])
+    assert not votes.any() and len(good) == 0
+
+
+def test_query_candidates_keep_queries_apart(trained):
+    _, quantizer, blocks = trained
+    index = make_index(quantizer, blocks)
+    rows = np.arange(0, 200, 4)
+    queries = [perturbed(blocks['1'], rows), perturbed(blocks['3'], rows, seed=1), perturbed(blocks['3'], rows, seed=2)]
+
+    votes, _, good = index.vote(queries, query_candidates=[['1'], ['1'], None])
+    one, three = index.place_ids.index('1'), index.place_ids.index('3')
+    assert votes[0][one] >= 45
+    assert votes[1][three] == 0
+    assert votes[2][three] >= 45
+    assert set(good[good[:, 0] == 1, 2]) <= {one}
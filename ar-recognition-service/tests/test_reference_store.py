@@ -0,0 +1,162 @@
+import numpy as np
+import pytest
+
+from conftest import encode_jpeg
+from place_recognition import PlaceRecognizer
+from reference_store import KEYPOINT_DTYPE, ReferenceStore
+from vocabulary import VisualVocabulary
+
+
+def make_block(rows: int, seed: int, dim: int = 128):
+    rng = np.random.default_rng(seed)
+    keypoints = np.zeros(rows, dtype=KEYPOINT_DTYPE)
+    keypoints['x'] = np.arange(rows)
+    keypoints['response'] = rng.random(rows)
+    descriptors = rng.integers(0, 256, (rows, dim)).astype(np.float32)
+    return keypoints, descriptors
+
+
+def test_append_records_offsets_and_survives_reopen(tmp_path):
+    store = ReferenceStore(tmp_path)
+    first = make_block(20, 0)
+    second = make_block(15, 1)
+    store.append('1', *first, 'a.jpg', image_hash=7)
+    store.append('1', *second, 'b.jpg')
+
+    reopened = ReferenceStore(tmp_path)
+    assert reopened.places() == ['1']
+    assert [(i['image_path'], i['offset'], i['rows']) for i in reopened.images('1')] == [
+        ('a.jpg', 0, 20), ('b.jpg', 20, 15)
+    ]
+    assert reopened.images('1')[0]['dhash'] == 7
+    np.testing.assert_array_equal(reopened.load_descriptors('1'), np.vstack([first[1], second[1]]))
+    np.testing.assert_array_equal(reopened.load_keypoints('1')['x'][20:], second[0]['x'])
+
+
+def test_append_rejects_mismatched_rows(tmp_path):
+    store = ReferenceStore(tmp_path)
+    keypoints, descriptors = make_block(20, 0)
+    with pytest.raises(ValueError):
+        store.append('1', keypoints[:10], descriptors, 'a.jpg')
+    with pytest.raises(ValueError):
+        store.append('1', keypoints, descriptors[:, :64], 'a.jpg')
+
+
+def test_uncommitted_append_is_invisible_and_truncated(tmp_path):
+    store = ReferenceStore(tmp_path)
+    committed = make_block(20, 0)
+    store.append('1', *committed, 'a.jpg')
+    # إدخال توقف قبل نشر ملف الفهرس: الكتلة مكتوبة لكنها غير منشورة
+    store.append('1', *make_block(30, 1), 'lost.jpg', commit=False)
+    descriptors_path = tmp_path / '1' / 'descriptors.bin'
+    assert descriptors_path.stat().st_size == 50 * 128 * 4
+
+    recovered = ReferenceStore(tmp_path)
+    assert len(recovered.images('1')) == 1
+    assert len(recovered.load_descriptors('1')) == 20
+
+    latest = make_block(5, 2)
+    record = recovered.append('1', *latest, 'b.jpg')
+    assert record['offset'] == 20
+    assert descriptors_path.stat().st_size == 25 * 128 * 4
+    assert (tmp_path / '1' / 'keypoints.bin').stat().st_size == 25 * KEYPOINT_DTYPE.itemsize
+    np.testing.assert_array_equal(ReferenceStore(tmp_path).load_descriptors('1')[20:], latest[1])
+
+
+def test_refresh_rereads_manifest_written_by_another_store(tmp_path):
+    first = ReferenceStore(tmp_path)
+    second = ReferenceStore(tmp_path)
+    first.append('1', *make_block(20, 0), 'a.jpg')
+
+    assert not first.changed()
+    assert second.changed()
+    assert second.refresh()
+    assert not second.refresh()
+    second.append('1', *make_block(10, 1), 'b.jpg')
+
+    reopened = ReferenceStore(tmp_path)
+    assert [i['image_path'] for i in reopened.images('1')] == ['a.jpg', 'b.jpg']
+    assert len(reopened.load_descriptors('1')) == 30
+
+
+@pytest.fixture
+def shared_dir(tmp_path, scenes):
+    """مجلد مراجع بصورة للمكان 3 ومفردات بصرية صغيرة، كما يراه عاملا خدمة"""
+    root = tmp_path / "reference_images"
+    seed = PlaceRecognizer(str(root))
+    seed.add_reference_image_from_bytes('3', encode_jpeg(scenes['3']))
+    rng = np.random.default_rng(0)
+    vocabulary = VisualVocabulary(root / "vocabulary", rng.integers(0, 64, (16, 128)).astype(np.float32))
+    vocabulary.root.mkdir()
+    np.save(vocabulary.root / "words.npy", vocabulary.words)
+    vocabulary.reindex(seed.store)
+    seed.store_lock.release()
+    return root
+
+
+def test_workers_sharing_a_store_keep_each_others_images(shared_dir, scenes):
+    a = PlaceRecognizer(str(shared_dir))
+    b = PlaceRecognizer(str(shared_dir))
+    version_a = a.add_reference_image_from_bytes('1', encode_jpeg(scenes['1']))
+    assert a.wait_for_snapshot(version_a, timeout=30)
+    version_b = b.add_reference_image_from_bytes('2', encode_jpeg(scenes['2']))
+
+    store = ReferenceStore(shared_dir / "store")
+    assert sorted(store.places()) == ['1', '2', '3']
+    orb_store = ReferenceStore(shared_dir / "store_orb", dim=32, dtype=np.uint8)
+    assert sorted(orb_store.places()) == ['1', '2', '3']
+
+    # متجهات المفردات على القرص تطابق صور المخزن صفاً بصف
+    vocabulary = VisualVocabulary.load(shared_dir)
+    assert sorted(vocabulary.images) == sorted(
+        (place_id, image['offset'], image['rows'])
+        for place_id in store.places() for image in store.images(place_id)
+    )
+    for (place_id, offset, rows), histogram in zip(vocabulary.images, vocabulary.histograms):
+        block = store.load_descriptors(place_id)[offset:offset + rows]
+        np.testing.assert_array_equal(histogram, vocabulary.histogram(block))
+
+    # b قرأ إضافة a قبل الإلحاق، و a يراها بعد فحص المخزن
+    assert b.wait_for_snapshot(version_b, timeout=30)
+    assert {'1', '2', '3'} <= set(b.snapshot.indexes['sift'].place_ids)
+    assert '2' not in a.snapshot.indexes['sift'].place_ids
+    assert a.refresh_from_disk()
+    assert a.wait_for_snapshot(version_a + 1, timeout=30)
+    assert '2' in a.snapshot.indexes['sift'].place_ids
+    assert not a.refresh_from_disk()
+    for recognizer in (a, b):
+        recognizer.store_lock.release()
+
+
+def test_rewrite_place_publishes_new_generation_on_commit(tmp_path):
+    store = ReferenceStore(tmp_path)
+    blocks = [make_block(20, seed) for seed in range(3)]
+    for i, block in enumerate(blocks):
+        store.append('1', *block, f'{i}.jpg')
+
+    stale = store.rewrite_place('1', {0: np.array([3, 1]), 2: np.arange(20)})
+    assert stale == [tmp_path / '1' / 'descriptors.bin', tmp_path / '1' / 'keypoints.bin']
+    # قبل commit يبقى الجيل السابق هو المنشور
+    assert ReferenceStore(tmp_path).manifest['places']['1'].get('generation', 0) == 0
+
+    store.commit()
+    reopened = ReferenceStore(tmp_path)
+    place = reopened.manifest['places']['1']
+    assert place['generation'] == 1
+    assert place['rows'] == 22
+    assert [(i['image_path'], i['offset'], i['rows']) for i in reopened.images('1')] == [
+        ('0.jpg', 0, 2), ('2.jpg', 2, 20)
+    ]
+    np.testing.assert_array_equal(
+        reopened.load_descriptors('1'),
+        np.vstack([blocks[0][1][[1, 3]], blocks[2][1]])
+    )
+    np.testing.assert_array_equal(reopened.load_keypoints('1')['x'][:2], [1, 3])
+
+    for path in stale:
+        path.unlink()
+    stale = reopened.rewrite_place('1', {1: np.arange(5)})
+    reopened.commit()
+    assert stale == [tmp_path / '1' / 'descriptors.1.bin', tmp_path / '1' / 'keypoints.1.bin']
+    assert ReferenceStore(tmp_path).manifest['places']['1']['generation'] == 2
+    assert (tmp_path / '1' / 'descriptors.2.bin').exists()
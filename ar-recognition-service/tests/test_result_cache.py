@@ -0,0 +1,47 @@
+from conftest import encode_jpeg, view_of
+from result_cache import RecognitionCache, is_missing
+
+
+def test_lru_eviction_and_expiry():
+    cache = RecognitionCache(max_entries=2, ttl_seconds=10)
+    cache.put('a', 1)
+    cache.put('b', None)
+    assert cache.get('a') == 1
+    cache.put('c', 3)  # يُخرج b (الأقدم استخداماً)
+    assert is_missing(cache.get('b'))
+    assert cache.get('a') == 1 and cache.get('c') == 3
+    assert cache.evictions == 1
+
+    cache.put('none', None)
+    assert cache.get('none') is None and not is_missing(cache.get('none'))
+
+    expired = RecognitionCache(ttl_seconds=-1)
+    expired.put('a', 1)
+    assert is_missing(expired.get('a'))
+
+
+def test_cache_key_includes_snapshot_version(recognizer, scenes):
+    image = view_of(scenes['1'])
+    key = recognizer._cache_key(image, 0.3, 'sift', None, 1)
+    assert key is not None
+    assert recognizer._cache_key(image, 0.3, 'sift', None, 2) != key
+    assert recognizer._cache_key(image, 0.3, 'orb', None, 1) != key
+    assert recognizer._cache_key(b'not an image', 0.3, 'sift', None, 1) is None
+
+
+def test_results_are_invalidated_when_the_snapshot_changes(recognizer, scenes):
+    recognizer.cache = RecognitionCache()
+    query = view_of(scenes['3'])
+
+    assert recognizer.recognize(query, 0.1) is None
+    assert recognizer.recognize(query, 0.1) is None
+    assert recognizer.cache.stats()['hits'] == 1
+
+    version = recognizer.add_reference_image_from_bytes('3', encode_jpeg(scenes['3']))
+    assert recognizer.wait_for_snapshot(version, timeout=30)
+    assert recognizer.cache.invalidations == 1
+
+    # النتيجة المخزنة "لم يتم التعرف" تخص اللقطة السابقة ولا تُعاد
+    match = recognizer.recognize(query, 0.1)
+    assert match is not None and match.place_id == '3'
+    assert recognizer.cache.stats()['hits'] == 1
@@ -0,0 +1,150 @@
+import base64
+import io
+
+import pytest
+
+import server
+from conftest import view_of
+from worker_pool import ExtractionPool, ExtractionUnavailableError
+
+
+@pytest.fixture
+def client(recognizer, monkeypatch):
+    monkeypatch.setattr(server, 'recognizer', recognizer)
+    return server.app.test_client()
+
+
+@pytest.fixture
+def query(scenes):
+    return view_of(scenes['1'])
+
+
+def assert_recognized(response, place_id='1'):
+    assert response.status_code == 200, response.get_json()
+    payload = response.get_json()
+    assert payload['success'] and payload['recognized']
+    assert payload['place']['id'] == place_id
+
+
+def test_recognize_json_base64(client, query):
+    encoded = base64.b64encode(query).decode()
+    assert_recognized(client.post('/recognize', json={'image': encoded, 'min_confidence': 0.1}))
+    # بادئة data URL من canvas.toDataURL
+    assert_recognized(client.post('/recognize', json={
+        'image': f'data:image/jpeg;base64,{encoded}', 'min_confidence': 0.1
+    }))
+
+
+def multipart(query):
+    return {'data': {'image': (io.BytesIO(query), 'frame.jpg'), 'min_confidence': '0.1'},
+            'content_type': 'multipart/form-data'}
+
+
+def test_recognize_multipart(client, query, recognizer, monkeypatch):
+    received = []
+    recognize_queries = recognizer.recognize_queries
+
+    def spy(queries, *args, **kwargs):
+        received.extend(type(q.image_bytes) for q in queries)
+        return recognize_queries(queries, *args, **kwargs)
+    monkeypatch.setattr(recognizer, 'recognize_queries', spy)
+    assert_recognized(client.post('/recognize', **multipart(query)))
+    # الملف يُقرأ من مخزن المحلل في الذاكرة دون نسخه
+    assert received == [memoryview]
+
+
+def test_recognize_multipart_through_extraction_pool(client, query, recognizer):
+    recognizer.extraction_pool = ExtractionPool(1)
+    try:
+        assert_recognized(client.post('/recognize', **multipart(query)))
+    finally:
+        recognizer.extraction_pool.shutdown()
+        recognizer.extraction_pool = None
+
+
+def test_recognize_raw_body(client, query):
+    response = client.post('/recognize?min_confidence=0.1&mode=sift', data=query,
+                           content_type='image/jpeg')
+    assert_recognized(response)
+    response = client.post('/recognize?min_confidence=0.1', data=query,
+                           content_type='application/octet-stream')
+    assert_recognized(response)
+
+
+def test_recognize_unknown_place(client, scenes):
+    response = client.post('/recognize?min_confidence=0.1', data=view_of(scenes['3']),
+                           content_type='image/jpeg')
+    assert response.status_code == 200
+    assert response.get_json()['recognized'] is False
+
+
+@pytest.mark.parametrize('kwargs', [
+    {'json': {}},
+    {'json': {'image': None}},
+    {'data': b'', 'content_type': 'image/jpeg'},
+    {'data': {'other': (io.BytesIO(b'x'), 'a.jpg')}, 'content_type': 'multipart/form-data'},
+], ids=['json-missing', 'json-null', 'raw-empty', 'multipart-wrong-field'])
+def test_recognize_without_image(client, kwargs):
+    response = client.post('/recognize', **kwargs)
+    assert response.status_code == 400
+    assert response.get_json()['success'] is False
+
+
+@pytest.mark.parametrize('image', [
+    'abcde', 'data:image/jpeg;base64,abc', 'صورة', 42
+], ids=['bad-length', 'bad-padding', 'non-ascii', 'not-a-string'])
+def test_recognize_malformed_base64(client, image):
+    response = client.post('/recognize', json={'image': image})
+    assert response.status_code == 400
+    assert response.get_json()['success'] is False
+
+
+@pytest.mark.parametrize('query_string', [
+    'mode=surf', 'min_confidence=high', 'lat=24.7', 'lat=north&lng=46.6'
+], ids=['mode', 'min-confidence', 'location-missing-lng', 'location-not-a-number'])
+def test_recognize_invalid_parameters(client, query, query_string):
+    response = client.post(f'/recognize?{query_string}', data=query, content_type='image/jpeg')
+    assert response.status_code == 400
+    assert response.get_json()['success'] is False
+
+
+def test_recognize_batch_formats(client, scenes):
+    images = [view_of(scenes['1']), view_of(scenes['3']), view_of(scenes['2'])]
+    expected = [('1', True), (None, False), ('2', True)]
+
+    encoded = [base64.b64encode(image).decode() for image in images]
+    multipart = {'images': [(io.BytesIO(image), f'{i}.jpg') for i, image in enumerate(images)],
+                 'min_confidence': '0.1'}
+    for response in (
+        client.post('/recognize/batch', json={'images': encoded, 'min_confidence': 0.1}),
+        client.post('/recognize/batch', data=multipart, content_type='multipart/form-data'),
+    ):
+        assert response.status_code == 200, response.get_json()
+        results = response.get_json()['results']
+        assert [(r.get('place', {}).get('id'), r['recognized']) for r in results] == expected
+
+
+@pytest.mark.parametrize('images', [['abcde'], [42]], ids=['malformed', 'not-a-string'])
+def test_recognize_batch_rejects_invalid_items(client, images):
+    response = client.post('/recognize/batch', json={'images': images})
+    assert response.status_code == 400
+    assert response.get_json()['success'] is False
+
+
+def test_recognize_batch_limits(client, query, monkeypatch):
+    assert client.post('/recognize/batch', json={'images': []}).status_code == 400
+    monkeypatch.setattr(server, 'MAX_BATCH_SIZE', 2)
+    encoded = base64.b64encode(query).decode()
+    response = client.post('/recognize/batch', json={'images': [encoded] * 3})
+    assert response.status_code == 400
+    response = client.post('/recognize/batch', json={'images': [encoded], 'mode': 'surf'})
+    assert response.status_code == 400
+
+
+def test_recognize_extraction_failure_is_unavailable(client, query, recognizer, monkeypatch):
+    def unavailable(*args, **kwargs):
+        raise ExtractionUnavailableError("انتهت مهلة استخراج الميزات")
+    monkeypatch.setattr(recognizer, 'recognize_queries', unavailable)
+    response = client.post('/recognize', data=query, content_type='image/jpeg')
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
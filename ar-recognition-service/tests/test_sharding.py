@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+
+from reference_store import KEYPOINT_DTYPE
+from sharding import decode_queries, encode_queries
+
+
+def make_query(rows: int, dim: int, dtype, seed: int):
+    rng = np.random.default_rng(seed)
+    keypoints = np.zeros(rows, dtype=KEYPOINT_DTYPE)
+    keypoints['x'] = rng.random(rows) * 640
+    keypoints['octave'] = rng.integers(0, 4, rows)
+    descriptors = rng.integers(0, 256, (rows, dim)).astype(dtype)
+    return keypoints, descriptors
+
+
+@pytest.mark.parametrize('dim,dtype', [(128, np.float32), (32, np.uint8)], ids=['sift', 'orb'])
+def test_encode_decode_round_trip(dim, dtype):
+    queries = [make_query(rows, dim, dtype, seed) for seed, rows in enumerate((40, 0, 7))]
+    decoded = decode_queries(encode_queries(queries))
+
+    assert len(decoded) == len(queries)
+    for (keypoints, descriptors), (expected_keypoints, expected_descriptors) in zip(decoded, queries):
+        assert keypoints.dtype == KEYPOINT_DTYPE
+        assert descriptors.dtype == expected_descriptors.dtype
+        assert descriptors.shape == expected_descriptors.shape
+        np.testing.assert_array_equal(keypoints, expected_keypoints)
+        np.testing.assert_array_equal(descriptors, expected_descriptors)
+
+
+def test_decode_rejects_inconsistent_payload():
+    keypoints, descriptors = make_query(10, 128, np.float32, 0)
+    with pytest.raises(ValueError):
+        decode_queries(encode_queries([(keypoints[:5], descriptors)]))
+    with pytest.raises((ValueError, OSError)):
+        decode_queries(b'not an npz payload')
@@ -0,0 +1,30 @@
+from conftest import encode_jpeg, view_of
+
+
+def test_recognizes_reference_places(recognizer, scenes):
+    for place_id in ('1', '2'):
+        match = recognizer.recognize(view_of(scenes[place_id]), 0.1)
+        assert match is not None and match.place_id == place_id
+    assert recognizer.recognize(view_of(scenes['3']), 0.1) is None
+
+
+def test_snapshot_is_isolated_from_later_additions(recognizer, scenes):
+    old = recognizer.snapshot
+    old_images = {mode: dict(places) for mode, places in old.images.items()}
+
+    version = recognizer.add_reference_image_from_bytes('3', encode_jpeg(scenes['3']))
+    assert version == old.version + 1
+    assert recognizer.wait_for_snapshot(version, timeout=30)
+    new = recognizer.snapshot
+
+    assert new is not old and new.version == version
+    assert '3' in new.indexes['sift'].place_ids
+    # اللقطة السابقة كما نُشرت: لا صور ولا فهرس للمكان الجديد
+    assert '3' not in old.indexes['sift'].place_ids
+    assert old.images == old_images
+    assert old.keypoints('sift', '3') is None
+
+    query = view_of(scenes['3'])
+    assert recognizer.recognize(query, 0.1, snapshot=old) is None
+    match = recognizer.recognize(query, 0.1, snapshot=new)
+    assert match is not None and match.place_id == '3'
@@ -0,0 +1,103 @@
+import numpy as np
+
+import tracking
+from conftest import encode_jpeg, view_of
+from tracking import TrackingSessions, TrackingState
+
+
+def make_state(place_id='1', edge=100, frames=0):
+    points = np.zeros((20, 2), dtype=np.float32)
+    return TrackingState(place_id=place_id, mode='sift', keyframe_confidence=0.8, keyframe_points=20,
+                         gray=np.zeros((edge, edge), dtype=np.uint8), points=points,
+                         reference=points.copy(), frames=frames)
+
+
+def test_sessions_expire_after_ttl(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(tracking.time, 'monotonic', lambda: now[0])
+    sessions = TrackingSessions(ttl_seconds=10)
+    sessions.put('a', make_state())
+    now[0] += 9
+    assert sessions.get('a') is not None
+    now[0] += 11
+    assert sessions.get('a') is None
+    assert sessions.stats()['sessions'] == 0
+    assert sessions.stats()['bytes'] == 0
+
+
+def test_sessions_evict_least_recently_used_by_count():
+    sessions = TrackingSessions(max_sessions=2)
+    sessions.put('a', make_state())
+    sessions.put('b', make_state())
+    sessions.get('a')
+    sessions.put('a', make_state('2'))
+    sessions.put('c', make_state())
+    assert sessions.get('b') is None
+    assert sessions.get('a').place_id == '2'
+    assert sessions.get('c') is not None
+
+
+def test_sessions_stay_within_byte_budget():
+    state = make_state()
+    sessions = TrackingSessions(max_sessions=100, max_bytes=3 * state.nbytes)
+    for session_id in 'abcde':
+        sessions.put(session_id, make_state())
+    stats = sessions.stats()
+    assert stats['sessions'] == 3
+    assert stats['bytes'] == 3 * state.nbytes <= stats['maxBytes']
+    assert [sessions.get(s) is not None for s in 'abcde'] == [False, False, True, True, True]
+
+    # استبدال جلسة لا يضاعف حسابها، والجلسة الأكبر من الحد تبقى وحدها
+    sessions.put('e', make_state())
+    assert sessions.stats()['bytes'] == 3 * state.nbytes
+    sessions.put('big', make_state(edge=400))
+    assert sessions.stats()['sessions'] == 1
+    sessions.drop('big')
+    assert sessions.stats()['bytes'] == 0
+
+
+def test_stats_count_tracked_and_keyframes():
+    sessions = TrackingSessions()
+    sessions.put('a', make_state(), keyframe=True)
+    sessions.put('a', make_state(frames=1))
+    sessions.put('a', make_state(frames=2))
+    stats = sessions.stats()
+    assert (stats['keyframes'], stats['trackedFrames'], stats['trackedRate']) == (1, 2, round(2 / 3, 4))
+
+
+def test_track_follows_a_small_camera_shift(scenes):
+    gray = tracking.decode_frame(encode_jpeg(scenes['1']))
+    points = np.array([(x, y) for x in range(60, 420, 40) for y in range(60, 300, 40)], dtype=np.float32)
+    state = TrackingState(place_id='1', mode='sift', keyframe_confidence=0.9, keyframe_points=len(points),
+                          gray=gray, points=points, reference=points * 2)
+
+    shifted = np.roll(gray, (3, 5), axis=(0, 1))
+    tracked = tracking.track(state, shifted)
+    assert tracked is not None
+    assert tracked.frames == 1
+    assert np.all(np.abs(tracked.points - tracked.reference / 2 - [5, 3]) < 0.5)
+
+    assert tracking.track(state, gray[:200]) is None
+    assert tracking.track(state, np.zeros_like(gray)) is None
+
+
+def test_recognize_tracked_seeds_then_tracks(recognizer, scenes):
+    recognizer.sessions = TrackingSessions()
+    frame = view_of(scenes['1'])
+    match, outcome = recognizer.recognize_tracked('cam', frame, min_confidence=0.1)
+    assert (match.place_id, outcome) == ('1', 'keyframe')
+    match, outcome = recognizer.recognize_tracked('cam', frame, min_confidence=0.1)
+    assert (match.place_id, outcome) == ('1', 'tracked')
+
+    # إطار لا يشبه المكان: يفقد التتبع فيُعاد التعرف الكامل وتُحذف الجلسة
+    match, outcome = recognizer.recognize_tracked('cam', view_of(scenes['3']), min_confidence=0.1)
+    assert (match, outcome) == (None, 'keyframe')
+    assert recognizer.sessions.get('cam') is None
+
+
+def test_recognize_tracked_restarts_on_mode_change(recognizer, scenes):
+    recognizer.sessions = TrackingSessions()
+    frame = view_of(scenes['1'])
+    recognizer.recognize_tracked('cam', frame, min_confidence=0.1)
+    _, outcome = recognizer.recognize_tracked('cam', frame, min_confidence=0.1, mode='orb')
+    assert outcome == 'keyframe'
@@ -0,0 +1,88 @@
+import cv2
+import numpy as np
+
+import place_recognition
+from conftest import view_of
+from descriptor_index import DescriptorIndex
+from vocabulary import VisualVocabulary
+
+
+def make_vocabulary(root, words=4, dim=8):
+    root.mkdir(exist_ok=True)
+    vocabulary = VisualVocabulary(root, np.eye(words, dim, dtype=np.float32) * 10)
+    np.save(root / "words.npy", vocabulary.words)
+    return vocabulary
+
+
+def descriptors_near(words, counts, seed=0):
+    """وصفات حول الكلمات البصرية بعدد counts[k] للكلمة k"""
+    rng = np.random.default_rng(seed)
+    rows = np.repeat(np.arange(len(counts)), counts)
+    return (words[rows] + rng.normal(0, 0.5, (len(rows), words.shape[1]))).astype(np.float32)
+
+
+def test_histogram_assigns_nearest_word(tmp_path):
+    vocabulary = make_vocabulary(tmp_path)
+    descriptors = descriptors_near(vocabulary.words, [3, 0, 2, 1])
+    np.testing.assert_array_equal(vocabulary.histogram(descriptors), [3, 0, 2, 1])
+
+
+def test_shortlist_ranks_similar_images_and_filters_places(tmp_path):
+    vocabulary = make_vocabulary(tmp_path / "vocabulary")
+    words = vocabulary.words
+    vocabulary.add_images([
+        ('1', 0, 20, descriptors_near(words, [20, 0, 0, 0])),
+        ('1', 20, 20, descriptors_near(words, [0, 20, 0, 0])),
+        ('2', 0, 20, descriptors_near(words, [0, 0, 20, 0])),
+        ('3', 0, 20, descriptors_near(words, [0, 10, 0, 10])),
+    ])
+    query = descriptors_near(words, [0, 12, 0, 2], seed=1)
+    assert vocabulary.shortlist(query, 2) == [('1', 20, 20), ('3', 0, 20)]
+    assert vocabulary.shortlist(query, 1, places=['2', '3']) == [('3', 0, 20)]
+    assert len(vocabulary.shortlist(query, 10, places=['1'])) == 2
+    assert vocabulary.shortlist(query, 5, places=['9']) == []
+
+    # التحميل من القرص يعيد نفس الترتيب، والكتابة من كائن آخر تُكتشف
+    loaded = VisualVocabulary.load(tmp_path)
+    assert loaded.shortlist(query, 2) == vocabulary.shortlist(query, 2)
+    assert not loaded.changed()
+    vocabulary.add_image('2', 20, 20, descriptors_near(words, [0, 0, 0, 20]))
+    assert loaded.changed()
+    assert len(VisualVocabulary.load(tmp_path).images) == 5
+
+
+def test_vote_keeps_each_query_to_its_own_candidates():
+    rng = np.random.default_rng(0)
+    blocks = {place_id: rng.integers(0, 256, (60, 128)).astype(np.float32) for place_id in ('1', '2')}
+    index = DescriptorIndex.kdtree()
+    index.build(blocks)
+    queries = [blocks['1'][:30] + 1, blocks['2'][30:] + 1]
+    label = {place_id: index.place_ids.index(place_id) for place_id in blocks}
+
+    votes, _, matches = index.vote(queries, query_candidates=[[('1', 0, 30)], [('2', 30, 30)]])
+    assert votes[0, label['1']] >= 25 and votes[0, label['2']] == 0
+    assert votes[1, label['2']] >= 25 and votes[1, label['1']] == 0
+    assert set(matches[matches[:, 0] == 1, 3]) <= set(range(30, 60))
+
+    # مرشحو استعلام لا يصوتون لاستعلام آخر
+    votes, _, _ = index.vote(queries, query_candidates=[[('2', 0, 60)], None])
+    assert votes[0, label['1']] == 0
+    assert votes[1, label['2']] >= 25
+
+
+def test_batched_queries_use_their_own_shortlists(recognizer, scenes, monkeypatch):
+    block = np.vstack([recognizer.store.load_descriptors(p) for p in recognizer.store.places()])
+    cv2.setRNGSeed(0)
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 20, 1e-3)
+    _, _, words = cv2.kmeans(block.astype(np.float32), 32, None, criteria, 1, cv2.KMEANS_PP_CENTERS)
+    vocabulary = VisualVocabulary(recognizer.reference_images_dir / "vocabulary", words)
+    vocabulary.root.mkdir()
+    np.save(vocabulary.root / "words.npy", words)
+    vocabulary.reindex(recognizer.store)
+    recognizer.vocabulary = vocabulary
+    recognizer._publish_snapshot()
+
+    # قائمة مختصرة من صورة واحدة لكل استعلام
+    monkeypatch.setattr(place_recognition, 'SHORTLIST_SIZE', 1)
+    matches = recognizer.recognize_batch([view_of(scenes['1']), view_of(scenes['2'])], min_confidence=0.1)
+    assert [match.place_id for match in matches] == ['1', '2']
@@ -0,0 +1,43 @@
+import os
+import time
+
+import pytest
+
+from worker_pool import ExtractionPool, ExtractionUnavailableError, PoolSaturatedError
+
+
+@pytest.fixture
+def pool():
+    instance = ExtractionPool(1, timeout=0.5)
+    yield instance
+    instance.shutdown()
+
+
+def test_admit_rejects_beyond_max_pending():
+    pool = ExtractionPool(1, max_pending=2)
+    with pool.admit(), pool.admit():
+        assert pool.pending == 2
+        with pytest.raises(PoolSaturatedError):
+            with pool.admit():
+                pass
+    assert pool.pending == 0
+    with pool.admit():
+        assert pool.pending == 1
+
+
+def test_run_and_map_in_worker_process(pool):
+    assert pool.run(os.getpid) != os.getpid()
+    assert pool.map(abs, [-1, 2, -3]) == [1, 2, 3]
+    # عروض memoryview تُرسل كبايتات
+    assert pool.run(bytes, memoryview(b'frame')) == b'frame'
+
+
+def test_timeout_is_unavailable(pool):
+    with pytest.raises(ExtractionUnavailableError):
+        pool.run(time.sleep, 2)
+
+
+def test_crashed_worker_is_replaced(pool):
+    with pytest.raises(ExtractionUnavailableError):
+        pool.run(os._exit, 1)
+    assert pool.run(abs, -4) == 4
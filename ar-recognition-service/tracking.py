@@ -0,0 +1,214 @@
+"""
+تتبع المكان بين إطارات الكاميرا المتتالية دون تعرف كامل
+Session-based frame tracking: optical flow from the last keyframe's verified matches
+
+بعد تعرف واثق (إطار مفتاحي) تُحفظ نقاط الاستعلام المتوافقة هندسياً مع الصورة المرجعية.
+الإطارات التالية في نفس الجلسة تتبع هذه النقاط بالتدفق البصري (Lucas-Kanade) ويُعاد
+التحقق بتماثل RANSAC إلى إحداثيات المرجع؛ يعود التعرف الكامل عندما تقل النقاط المتتبعة.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+from typing import Dict, Optional, Tuple
+
+import cv2
+import numpy as np
+
+import feature_extraction
+
+# أطول ضلع لإطارات التتبع (أصغر من الاستخراج لأن التدفق البصري لا يحتاج التفاصيل الدقيقة)
+TRACKING_MAX_EDGE = int(os.environ.get('TRACKING_MAX_EDGE', 480))
+
+# نسبة النقاط المتبقية من الإطار المفتاحي التي يُعد التتبع دونها مفقوداً
+TRACKING_MIN_RATIO = float(os.environ.get('TRACKING_MIN_RATIO', 0.5))
+
+# تعرف كامل إجباري كل عدد من الإطارات لتصحيح الانجراف
+TRACKING_KEYFRAME_INTERVAL = int(os.environ.get('TRACKING_KEYFRAME_INTERVAL', 30))
+
+MIN_TRACKED_POINTS = 12
+
+# حد ذاكرة جلسات التتبع في كل عامل بالميجابايت (إطار 480 بكسل ≈ 170 كيلوبايت لكل جلسة)
+TRACKING_MAX_MB = float(os.environ.get('TRACKING_MAX_MB', 64))
+
+# أقصى خطأ (بالبكسل) في فحص التتبع ذهاباً وإياباً، وعتبة RANSAC في إحداثيات المرجع
+FORWARD_BACKWARD_MAX_ERROR = 1.0
+TRACKING_REPROJ_THRESHOLD = 5.0
+
+LK_PARAMS = dict(
+    winSize=(21, 21),
+    maxLevel=3,
+    criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 20, 0.03)
+)
+
+
+@dataclass(frozen=True)
+class TrackingState:
+    """حالة جلسة تتبع: آخر إطار ونقاطه المتتبعة ومقابلاتها في الصورة المرجعية"""
+    place_id: str
+    mode: str
+    keyframe_confidence: float
+    keyframe_points: int
+    gray: np.ndarray
+    points: np.ndarray
+    reference: np.ndarray
+    frames: int = 0
+
+    @property
+    def ratio(self) -> float:
+        return len(self.points) / self.keyframe_points
+
+    @property
+    def confidence(self) -> float:
+        """ثقة الإطار المفتاحي مخفضة بنسبة النقاط التي ما زالت متتبعة"""
+        return self.keyframe_confidence * min(self.ratio, 1.0)
+
+    def needs_keyframe(self) -> bool:
+        return self.frames >= TRACKING_KEYFRAME_INTERVAL
+
+    @property
+    def nbytes(self) -> int:
+        return self.gray.nbytes + self.points.nbytes + self.reference.nbytes
+
+
+def decode_frame(image_bytes: bytes) -> Optional[np.ndarray]:
+    """إطار رمادي بدقة التتبع"""
+    return feature_extraction.decode_gray(image_bytes, TRACKING_MAX_EDGE)
+
+
+def seed(place_id: str, mode: str, confidence: float, gray: np.ndarray,
+         anchors: np.ndarray, image_bytes: bytes) -> Optional[TrackingState]:
+    """بدء التتبع من إطار مفتاحي
+
+    anchors: مصفوفة (N, 4) من [x الاستعلام، y الاستعلام، x المرجع، y المرجع] للنقاط المتوافقة،
+    وإحداثيات الاستعلام فيها بدقة الاستخراج فتُحوّل لدقة التتبع.
+    """
+    extraction_edge = feature_extraction.decoded_long_edge(image_bytes)
+    if gray is None or anchors is None or not extraction_edge or len(anchors) < MIN_TRACKED_POINTS:
+        return None
+    scale = max(gray.shape[:2]) / extraction_edge
+    return TrackingState(
+        place_id=place_id,
+        mode=mode,
+        keyframe_confidence=confidence,
+        keyframe_points=len(anchors),
+        gray=gray,
+        points=np.ascontiguousarray(anchors[:, :2] * scale, dtype=np.float32),
+        reference=np.ascontiguousarray(anchors[:, 2:], dtype=np.float32)
+    )
+
+
+def track(state: TrackingState, gray: np.ndarray) -> Optional[TrackingState]:
+    """تتبع نقاط الجلسة إلى الإطار الجديد؛ None إذا فُقد التتبع"""
+    if gray is None or gray.shape != state.gray.shape:
+        return None
+
+    previous = state.points.reshape(-1, 1, 2)
+    points, status, _ = cv2.calcOpticalFlowPyrLK(state.gray, gray, previous, None, **LK_PARAMS)
+    if points is None:
+        return None
+    # فحص ذهاباً وإياباً يستبعد النقاط التي انزلقت إلى بنية أخرى
+    back, back_status, _ = cv2.calcOpticalFlowPyrLK(gray, state.gray, points, None, **LK_PARAMS)
+    error = np.linalg.norm(back.reshape(-1, 2) - state.points, axis=1)
+    good = (status.ravel() == 1) & (back_status.ravel() == 1) & (error < FORWARD_BACKWARD_MAX_ERROR)
+    if good.sum() < MIN_TRACKED_POINTS:
+        return None
+
+    current = points.reshape(-1, 2)[good]
+    reference = state.reference[good]
+    homography, mask = cv2.findHomography(current, reference, cv2.RANSAC, TRACKING_REPROJ_THRESHOLD)
+    if homography is None or mask is None:
+        return None
+
+    inliers = mask.ravel().astype(bool)
+    tracked = replace(
+        state,
+        gray=gray,
+        points=np.ascontiguousarray(current[inliers]),
+        reference=np.ascontiguousarray(reference[inliers]),
+        frames=state.frames + 1
+    )
+    if len(tracked.points) < MIN_TRACKED_POINTS or tracked.ratio < TRACKING_MIN_RATIO:
+        return None
+    return tracked
+
+
+class TrackingSessions:
+    """جلسات التتبع في الذاكرة (LRU مع مدة صلاحية منذ آخر إطار)
+
+    الجلسات محلية لكل عملية: إذا وصل إطار لعملية أخرى يُجرى تعرف كامل ويبدأ التتبع فيها.
+    كل جلسة تحتفظ بآخر إطار رمادي، فيُحد عددها وحجمها الكلي (max_bytes) معاً.
+    """
+
+    def __init__(self, max_sessions: int = 1024, ttl_seconds: float = 30.0,
+                 max_bytes: int = int(TRACKING_MAX_MB * 1024 * 1024)):
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self._sessions: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self.tracked = 0
+        self.keyframes = 0
+
+    @classmethod
+    def from_env(cls) -> Optional['TrackingSessions']:
+        """إنشاء الجلسات من المتغيرات البيئية (TRACKING_SESSIONS=0 للتعطيل)"""
+        max_sessions = int(os.environ.get('TRACKING_SESSIONS', 1024))
+        if max_sessions <= 0:
+            return None
+        return cls(
+            max_sessions=max_sessions,
+            ttl_seconds=float(os.environ.get('TRACKING_SESSION_TTL', 30)),
+            max_bytes=int(TRACKING_MAX_MB * 1024 * 1024)
+        )
+
+    def _release(self, entry: Optional[Tuple[float, TrackingState]]):
+        """خصم حجم جلسة محذوفة (تحت القفل)"""
+        if entry is not None:
+            self._bytes -= entry[1].nbytes
+
+    def get(self, session_id: str) -> Optional[TrackingState]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                return None
+            if entry[0] < now:
+                self._release(self._sessions.pop(session_id))
+                return None
+            return entry[1]
+
+    def put(self, session_id: str, state: TrackingState, keyframe: bool = False):
+        with self._lock:
+            self._release(self._sessions.pop(session_id, None))
+            self._sessions[session_id] = (time.monotonic() + self.ttl_seconds, state)
+            self._bytes += state.nbytes
+            while len(self._sessions) > 1 and (
+                len(self._sessions) > self.max_sessions or self._bytes > self.max_bytes
+            ):
+                self._release(self._sessions.popitem(last=False)[1])
+            if keyframe:
+                self.keyframes += 1
+            else:
+                self.tracked += 1
+
+    def drop(self, session_id: str):
+        with self._lock:
+            self._release(self._sessions.pop(session_id, None))
+
+    def stats(self) -> Dict:
+        with self._lock:
+            frames = self.tracked + self.keyframes
+            return {
+                "sessions": len(self._sessions),
+                "maxSessions": self.max_sessions,
+                "bytes": self._bytes,
+                "maxBytes": self.max_bytes,
+                "ttlSeconds": self.ttl_seconds,
+                "trackedFrames": self.tracked,
+                "keyframes": self.keyframes,
+                "trackedRate": round(self.tracked / frames, 4) if frames else 0.0
+            }
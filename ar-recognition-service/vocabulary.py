@@ -0,0 +1,227 @@
+"""
+مفردات بصرية (Bag of Visual Words) لقائمة مختصرة سريعة من الصور المرجعية
+Visual vocabulary with a per-image TF-IDF index for shortlisting reference images
+
+التدريب (دون اتصال):
+    python vocabulary.py --reference-dir reference_images --words 1024
+"""
+
+import argparse
+import json
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from reference_store import (
+    ReferenceStore, StoreLock, StoreLockedError, append_block, file_signature, write_json_atomic
+)
+
+VOCABULARY_DIR = "vocabulary"
+
+
+class VisualVocabulary:
+    """كلمات بصرية (مراكز k-means) مع متجهات TF-IDF لكل صورة مرجعية"""
+
+    def __init__(self, root: Path, words: np.ndarray):
+        self.root = Path(root)
+        self.words = np.ascontiguousarray(words, dtype=np.float32)
+        self._words_sq = np.einsum('ij,ij->i', self.words, self.words)
+        # كل صف في histograms.bin يقابل صورة: (place_id, offset, rows)
+        self.images: List[Tuple[str, int, int]] = []
+        self.histograms = np.empty((0, len(self.words)), dtype=np.float32)
+        self.idf = np.ones(len(self.words), dtype=np.float32)
+        self.vectors = np.empty((0, len(self.words)), dtype=np.float32)
+        self._signature = None
+
+    @property
+    def size(self) -> int:
+        return len(self.words)
+
+    @classmethod
+    def load(cls, reference_images_dir: Path) -> Optional['VisualVocabulary']:
+        """تحميل المفردات المدربة إن وُجدت"""
+        root = Path(reference_images_dir) / VOCABULARY_DIR
+        words_file = root / "words.npy"
+        images_file = root / "images.json"
+        if not words_file.exists() or not images_file.exists():
+            return None
+
+        vocabulary = cls(root, np.load(words_file))
+        with open(images_file, 'r', encoding='utf-8') as f:
+            vocabulary.images = [tuple(image) for image in json.load(f)['images']]
+        vocabulary.histograms = np.fromfile(
+            root / "histograms.bin", dtype=np.float32,
+            count=len(vocabulary.images) * vocabulary.size
+        ).reshape(len(vocabulary.images), vocabulary.size)
+        vocabulary._reweight()
+        vocabulary._signature = file_signature(images_file)
+        return vocabulary
+
+    def changed(self) -> bool:
+        """هل كتبت عملية أخرى المفردات بعد تحميلها أو آخر كتابة من هذا الكائن
+
+        الإلحاق يقص histograms.bin إلى عدد الصور المعروفة هنا، فالمفردات التي تغيرت تُعاد
+        قراءتها (VisualVocabulary.load) قبل الإلحاق بدلاً من الكتابة فوق صور العملية الأخرى.
+        """
+        return file_signature(self.root / "images.json") != self._signature
+
+    def assign(self, descriptors: np.ndarray) -> np.ndarray:
+        """أقرب كلمة بصرية لكل وصف (مسافة إقليدية)"""
+        descriptors = np.asarray(descriptors, dtype=np.float32)
+        distances = self._words_sq[None, :] - 2.0 * descriptors @ self.words.T
+        return np.argmin(distances, axis=1)
+
+    def histogram(self, descriptors: np.ndarray) -> np.ndarray:
+        return np.bincount(self.assign(descriptors), minlength=self.size).astype(np.float32)
+
+    def _tfidf(self, histograms: np.ndarray) -> np.ndarray:
+        totals = histograms.sum(axis=1, keepdims=True)
+        vectors = histograms / np.maximum(totals, 1.0) * self.idf[None, :]
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    def _reweight(self):
+        """إعادة حساب IDF ومتجهات الصور"""
+        n_images = len(self.histograms)
+        document_frequency = (self.histograms > 0).sum(axis=0)
+        self.idf = np.log((n_images + 1) / (document_frequency + 1)).astype(np.float32) + 1.0
+        self.vectors = self._tfidf(self.histograms).astype(np.float32)
+
+    def add_image(self, place_id: str, offset: int, rows: int, descriptors: np.ndarray):
+        """إلحاق متجه صورة مرجعية جديدة"""
+        self.add_images([(place_id, offset, rows, descriptors)])
+
+    def add_images(self, entries: List[Tuple[str, int, int, np.ndarray]]):
+        """إلحاق متجهات عدة صور بكتابة واحدة وإعادة وزن واحدة"""
+        if not entries:
+            return
+        histograms = np.vstack([self.histogram(entry[3]) for entry in entries])
+        append_block(
+            self.root / "histograms.bin",
+            histograms,
+            len(self.images) * self.size * 4
+        )
+        # الحقول تُستبدل ولا تُعدّل في مكانها حتى تبقى النسخ المنشورة في اللقطات ثابتة
+        self.images = self.images + [(place_id, offset, rows) for place_id, offset, rows, _ in entries]
+        write_json_atomic(self.root / "images.json", {'images': self.images})
+        self._signature = file_signature(self.root / "images.json")
+        self.histograms = np.vstack([self.histograms, histograms])
+        self._reweight()
+
+    def replace_place(self, place_id: str, entries: List[Tuple[str, int, int, np.ndarray]]):
+        """استبدال متجهات جميع صور مكان أُعيدت كتابته (إلحاق تجاوز ميزانية المكان)"""
+        others = np.array([image[0] != place_id for image in self.images], dtype=bool)
+        images = [image for image in self.images if image[0] != place_id]
+        histograms = self.histograms[others]
+        if entries:
+            images += [(image_place, offset, rows) for image_place, offset, rows, _ in entries]
+            histograms = np.vstack([histograms] + [self.histogram(entry[3])[None, :] for entry in entries])
+        self._save(images, histograms)
+
+    def sync(self, store: ReferenceStore) -> int:
+        """إضافة متجهات صور المخزن الناقصة (إدخال توقف بعد نشر المخزن)؛ يُرجع عددها"""
+        known = set(self.images)
+        entries = []
+        for place_id in store.places():
+            block = store.load_descriptors(place_id)
+            for image in store.images(place_id):
+                start, rows = image['offset'], image['rows']
+                if (place_id, start, rows) not in known:
+                    entries.append((place_id, start, rows, block[start:start + rows]))
+        self.add_images(entries)
+        return len(entries)
+
+    def reindex(self, store: ReferenceStore):
+        """إعادة بناء متجهات جميع الصور من المخزن بالكلمات الحالية (بعد التدريب أو الضغط)"""
+        images = []
+        histograms = []
+        for place_id in store.places():
+            block = store.load_descriptors(place_id)
+            for image in store.images(place_id):
+                start, rows = image['offset'], image['rows']
+                images.append((place_id, start, rows))
+                histograms.append(self.histogram(block[start:start + rows]))
+
+        self._save(images, (
+            np.vstack(histograms).astype(np.float32) if histograms
+            else np.empty((0, self.size), dtype=np.float32)
+        ))
+
+    def _save(self, images: List[Tuple[str, int, int]], histograms: np.ndarray):
+        """كتابة جميع متجهات الصور وقائمتها بدلاً من الإلحاق"""
+        self.images = images
+        self.histograms = histograms
+        self.histograms.tofile(self.root / "histograms.bin")
+        write_json_atomic(self.root / "images.json", {'images': images})
+        self._signature = file_signature(self.root / "images.json")
+        self._reweight()
+
+    def shortlist(self, descriptors: np.ndarray, size: int,
+                  places: Optional[List[str]] = None) -> List[Tuple[str, int, int]]:
+        """أفضل الصور المرجعية تشابهاً مع الاستعلام حسب TF-IDF"""
+        if not self.images:
+            return []
+        query = self._tfidf(self.histogram(descriptors)[None, :])[0]
+        scores = self.vectors @ query
+        if places is not None:
+            allowed = set(places)
+            mask = np.array([image[0] in allowed for image in self.images])
+            scores = np.where(mask, scores, -np.inf)
+        size = min(size, int(np.isfinite(scores).sum()))
+        if size == 0:
+            return []
+        top = np.argpartition(-scores, size - 1)[:size]
+        top = top[np.argsort(-scores[top])]
+        return [self.images[i] for i in top]
+
+
+def train_vocabulary(reference_images_dir: Path, n_words: int, sample_size: int,
+                     seed: int = 0) -> VisualVocabulary:
+    """تدريب المفردات بـ k-means على عينة من وصفات SIFT المخزنة وبناء متجهات الصور"""
+    with StoreLock(reference_images_dir):
+        store = ReferenceStore(Path(reference_images_dir) / "store")
+        blocks: Dict[str, np.ndarray] = {
+            place_id: store.load_descriptors(place_id) for place_id in store.places()
+        }
+        total = sum(len(block) for block in blocks.values() if block is not None)
+        if total < n_words:
+            raise ValueError(f"عدد الوصفات ({total}) أقل من عدد الكلمات ({n_words})")
+
+        rng = np.random.default_rng(seed)
+        fraction = min(1.0, sample_size / total)
+        sample = np.vstack([
+            block[np.sort(rng.choice(len(block), max(1, int(len(block) * fraction)), replace=False))]
+            for block in blocks.values() if block is not None
+        ]).astype(np.float32)
+
+        print(f"تدريب {n_words} كلمة بصرية على {len(sample)} وصف...")
+        cv2.setRNGSeed(seed)
+        criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 20, 1e-3)
+        _, _, words = cv2.kmeans(sample, n_words, None, criteria, 1, cv2.KMEANS_PP_CENTERS)
+
+        root = Path(reference_images_dir) / VOCABULARY_DIR
+        root.mkdir(parents=True, exist_ok=True)
+        vocabulary = VisualVocabulary(root, words)
+
+        np.save(root / "words.npy", vocabulary.words)
+        vocabulary.reindex(store)
+        print(f"تم بناء فهرس {len(vocabulary.images)} صورة مرجعية في {root}")
+        return vocabulary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="تدريب المفردات البصرية للقائمة المختصرة")
+    parser.add_argument('--reference-dir', default="reference_images", help="مجلد الصور المرجعية")
+    parser.add_argument('--words', type=int, default=1024, help="عدد الكلمات البصرية")
+    parser.add_argument('--sample', type=int, default=200000, help="عدد الوصفات المستخدمة في التدريب")
+    args = parser.parse_args()
+    try:
+        train_vocabulary(Path(args.reference_dir), args.words, args.sample)
+    except StoreLockedError as e:
+        parser.exit(1, f"{e}\n")
+
+
+if __name__ == '__main__':
+    main()
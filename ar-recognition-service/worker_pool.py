@@ -0,0 +1,120 @@
+"""
+مجمع عمليات لاستخراج الميزات مع تحكم في الضغط
+Process pool for CPU-bound feature extraction with bounded admission
+"""
+
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FuturesTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+import cv2
+
+
+class PoolSaturatedError(Exception):
+    """المجمع ممتلئ ولا يقبل طلبات جديدة حالياً"""
+
+
+class ExtractionUnavailableError(Exception):
+    """تعذر الاستخراج مؤقتاً: تجاوز المهلة أو انهارت إحدى عمليات المجمع"""
+
+
+def _init_worker():
+    # كل عملية تستخدم خيطاً واحداً لتجنب تنافس خيوط OpenCV بين العمليات
+    cv2.setNumThreads(1)
+
+
+def _picklable(value):
+    """عروض memoryview على مخزن الطلب لا تُرسل إلى عملية أخرى فتُنسخ (الإرسال ينسخ على أي حال)"""
+    return bytes(value) if isinstance(value, memoryview) else value
+
+
+class ExtractionPool:
+    """مجمع عمليات لفك الترميز واستخراج الميزات"""
+
+    def __init__(self, workers: int, max_pending: Optional[int] = None,
+                 timeout: float = 30.0):
+        self.workers = workers
+        self.max_pending = max_pending or workers * 4
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    @classmethod
+    def from_env(cls) -> Optional['ExtractionPool']:
+        """إنشاء المجمع من المتغيرات البيئية (0 عمال = تعطيل)"""
+        workers = int(os.environ.get('EXTRACTION_WORKERS', os.cpu_count() or 1))
+        if workers <= 0:
+            return None
+        max_pending = int(os.environ.get('MAX_PENDING_REQUESTS', 0)) or None
+        timeout = float(os.environ.get('EXTRACTION_TIMEOUT', 30))
+        return cls(workers, max_pending, timeout)
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        # يُنشأ عند أول استخدام (بعد أي fork من خادم الإنتاج)
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=_init_worker
+                )
+            return self._executor
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    @contextmanager
+    def admit(self):
+        """حجز مكان لطلب، أو رفعه PoolSaturatedError إذا امتلأ الطابور"""
+        if not self._slots.acquire(blocking=False):
+            raise PoolSaturatedError("الخدمة مشغولة، حاول لاحقاً")
+        with self._lock:
+            self._pending += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._pending -= 1
+            self._slots.release()
+
+    @contextmanager
+    def _unavailable_on_failure(self, executor: ProcessPoolExecutor):
+        """تحويل المهلة وانهيار العمليات إلى ExtractionUnavailableError
+
+        المجمع المنهار لا يقبل مهاماً بعد ذلك، فيُستبدل بمجمع جديد عند الطلب التالي.
+        """
+        try:
+            yield
+        except FuturesTimeoutError as e:
+            raise ExtractionUnavailableError("انتهت مهلة استخراج الميزات") from e
+        except BrokenProcessPool as e:
+            with self._lock:
+                if self._executor is executor:
+                    self._executor = None
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise ExtractionUnavailableError("توقفت إحدى عمليات الاستخراج") from e
+
+    def run(self, fn: Callable, *args):
+        """تشغيل دالة في إحدى عمليات المجمع وانتظار نتيجتها"""
+        executor = self._get_executor()
+        with self._unavailable_on_failure(executor):
+            return executor.submit(fn, *map(_picklable, args)).result(timeout=self.timeout)
+
+    def map(self, fn: Callable, items):
+        """تشغيل دالة على عدة عناصر بالتوازي"""
+        executor = self._get_executor()
+        with self._unavailable_on_failure(executor):
+            return list(executor.map(fn, map(_picklable, items), timeout=self.timeout))
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(cancel_futures=True)
+                self._executor = None
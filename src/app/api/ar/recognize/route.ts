@@ -98,7 +98,7 @@ const PLACES_DATA: Record<string, {
 export async function POST(request: NextRequest) {
     try {
         const body = await request.json();
-        const { image, min_confidence = 0.3 } = body;
+        const { image, min_confidence = 0.3, session_id } = body;
 
         if (!image) {
             return NextResponse.json({
@@ -116,7 +116,8 @@ export async function POST(request: NextRequest) {
                 },
                 body: JSON.stringify({
                     image,
-                    min_confidence
+                    min_confidence,
+                    session_id
                 }),
                 signal: AbortSignal.timeout(10000) // timeout 10 seconds
             });
@@ -125,6 +126,19 @@ export async function POST(request: NextRequest) {
                 const result = await response.json();
                 return NextResponse.json(result);
             }
+
+            // الخدمة تعمل لكنها لم تُكمل تحميل المخزن: لا نعرض نتيجة تجريبية عشوائية
+            if (response.status === 503) {
+                const result = await response.json();
+                return NextResponse.json({
+                    success: false,
+                    starting: true,
+                    error: result.error || 'خدمة OpenCV قيد التشغيل'
+                }, {
+                    status: 503,
+                    headers: { 'Retry-After': response.headers.get('Retry-After') || '1' }
+                });
+            }
         } catch (serviceError) {
             console.log('خدمة OpenCV غير متاحة، استخدام التعرف التجريبي');
         }
@@ -210,6 +224,17 @@ export async function GET() {
                 fallback: false
             });
         }
+
+        // 503 أثناء تحميل المخزن: الخدمة تبدأ ولم تتوقف
+        const health = await response.json().catch(() => null);
+        if (response.status === 503 && health?.status === 'loading') {
+            return NextResponse.json({
+                status: 'starting',
+                service: 'OpenCV Recognition Service',
+                fallback: false,
+                message: 'خدمة OpenCV قيد التشغيل، يرجى الانتظار'
+            });
+        }
     } catch {
         // الخدمة غير متاحة
     }
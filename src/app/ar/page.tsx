@@ -20,7 +20,7 @@ interface Place {
 }
 
 interface ServiceStatus {
-    status: 'online' | 'offline';
+    status: 'online' | 'starting' | 'offline';
     service: string;
     fallback: boolean;
     message?: string;
@@ -33,13 +33,18 @@ export default function ARExperiencePage() {
     const [discoveredPlaces, setDiscoveredPlaces] = useState<Place[]>([]);
     const [totalScans, setTotalScans] = useState(0);
 
-    // فحص حالة الخدمة
+    // فحص حالة الخدمة (يُعاد أثناء تشغيلها حتى تصبح جاهزة)
     useEffect(() => {
+        let retry: ReturnType<typeof setTimeout> | undefined;
+
         async function checkServiceStatus() {
             try {
                 const response = await fetch('/api/ar/recognize');
-                const status = await response.json();
+                const status: ServiceStatus = await response.json();
                 setServiceStatus(status);
+                if (status.status === 'starting') {
+                    retry = setTimeout(checkServiceStatus, 2000);
+                }
             } catch {
                 setServiceStatus({
                     status: 'offline',
@@ -50,6 +55,7 @@ export default function ARExperiencePage() {
         }
 
         checkServiceStatus();
+        return () => clearTimeout(retry);
     }, []);
 
     // معالجة المكان المعترف به
@@ -94,7 +100,9 @@ export default function ARExperiencePage() {
                     <span>
                         {serviceStatus.status === 'online'
                             ? (language === 'ar' ? 'OpenCV متصل' : 'OpenCV Connected')
-                            : (language === 'ar' ? 'وضع تجريبي' : 'Demo Mode')
+                            : serviceStatus.status === 'starting'
+                                ? (language === 'ar' ? 'جارٍ تشغيل OpenCV...' : 'OpenCV Starting...')
+                                : (language === 'ar' ? 'وضع تجريبي' : 'Demo Mode')
                         }
                     </span>
                 </div>
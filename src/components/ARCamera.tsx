@@ -23,6 +23,8 @@ interface RecognitionResult {
     recognized: boolean;
     place?: Place;
     message?: string;
+    // "tracked" أو "keyframe" عندما تتتبع الخدمة جلسة الكاميرا
+    tracking?: 'tracked' | 'keyframe';
 }
 
 interface ARCameraProps {
@@ -30,13 +32,16 @@ interface ARCameraProps {
     language?: 'en' | 'ar';
     autoScan?: boolean;
     scanInterval?: number;
+    // الفاصل أثناء تتبع مكان متعرف عليه (الإطارات المتتبعة رخيصة في الخدمة)
+    trackingInterval?: number;
 }
 
 export default function ARCamera({
     onPlaceRecognized,
     language = 'ar',
     autoScan = false,
-    scanInterval = 3000
+    scanInterval = 3000,
+    trackingInterval = 300
 }: ARCameraProps) {
     const videoRef = useRef<HTMLVideoElement>(null);
     const canvasRef = useRef<HTMLCanvasElement>(null);
@@ -47,7 +52,15 @@ export default function ARCamera({
     const [cameraPermission, setCameraPermission] = useState<'pending' | 'granted' | 'denied'>('pending');
     const [facingMode, setFacingMode] = useState<'user' | 'environment'>('environment');
     const [scanHistory, setScanHistory] = useState<Place[]>([]);
+    const [isTracking, setIsTracking] = useState(false);
     const autoScanIntervalRef = useRef<NodeJS.Timeout | null>(null);
+    // معرف جلسة التتبع: الإطارات المتتالية تُتتبع في الخدمة دون تعرف كامل
+    // (المهيئ الكسول يُنشئ المعرف مرة واحدة لكل تركيب بدلاً من كل عرض)
+    const [sessionId] = useState(() =>
+        typeof crypto !== 'undefined' && 'randomUUID' in crypto
+            ? crypto.randomUUID()
+            : Math.random().toString(36).slice(2)
+    );
 
     // بدء تشغيل الكاميرا
     const startCamera = useCallback(async () => {
@@ -143,6 +156,7 @@ export default function ARCamera({
             videoRef.current.srcObject = null;
             setIsStreaming(false);
         }
+        setIsTracking(false);
     }, []);
 
     // التقاط صورة من الكاميرا
@@ -182,12 +196,16 @@ export default function ARCamera({
                 },
                 body: JSON.stringify({
                     image: imageData,
-                    min_confidence: 0.3
+                    min_confidence: 0.3,
+                    session_id: sessionId
                 }),
             });
 
             const result: RecognitionResult = await response.json();
 
+            // جلسة التتبع تبقى نشطة ما دام المكان متعرفاً عليه في خدمة تدعم التتبع
+            setIsTracking(Boolean(result.success && result.recognized && result.tracking));
+
             if (result.success && result.recognized && result.place) {
                 setRecognizedPlace(result.place);
                 setScanHistory(prev => {
@@ -205,6 +223,7 @@ export default function ARCamera({
                 setRecognizedPlace(null);
             }
         } catch (err) {
+            setIsTracking(false);
             console.error('خطأ في التعرف:', err);
             setError(language === 'ar'
                 ? 'فشل في الاتصال بخدمة التعرف'
@@ -212,7 +231,7 @@ export default function ARCamera({
         } finally {
             setIsScanning(false);
         }
-    }, [isStreaming, isScanning, captureFrame, onPlaceRecognized, language]);
+    }, [isStreaming, isScanning, captureFrame, onPlaceRecognized, language, sessionId]);
 
     // تبديل الكاميرا الأمامية/الخلفية
     const toggleCamera = useCallback(async () => {
@@ -238,21 +257,22 @@ export default function ARCamera({
         return icons[category] || '📍';
     };
 
-    // بدء/إيقاف الفحص التلقائي
+    // بدء/إيقاف الفحص التلقائي (فاصل قصير أثناء التتبع، والمؤقت يُعاد مع كل تغيير)
     useEffect(() => {
-        if (autoScan && isStreaming && !autoScanIntervalRef.current) {
-            autoScanIntervalRef.current = setInterval(recognizePlace, scanInterval);
-        } else if (!autoScan && autoScanIntervalRef.current) {
-            clearInterval(autoScanIntervalRef.current);
-            autoScanIntervalRef.current = null;
+        if (autoScan && isStreaming) {
+            autoScanIntervalRef.current = setInterval(
+                recognizePlace,
+                isTracking ? trackingInterval : scanInterval
+            );
         }
 
         return () => {
             if (autoScanIntervalRef.current) {
                 clearInterval(autoScanIntervalRef.current);
+                autoScanIntervalRef.current = null;
             }
         };
-    }, [autoScan, isStreaming, recognizePlace, scanInterval]);
+    }, [autoScan, isStreaming, recognizePlace, isTracking, scanInterval, trackingInterval]);
 
     // بدء الكاميرا عند تغيير الوضع (فقط إذا كان الإذن ممنوح مسبقاً)
     useEffect(() => {